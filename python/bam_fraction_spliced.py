@@ -0,0 +1,61 @@
+import os
+import argparse
+import logging
+import sys
+
+from txseq.tasks.bam import fraction_spliced
+
+# <------------------------------ Logging ------------------------------------>
+
+L = logging.getLogger(__name__)
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+log_handler.setLevel(logging.INFO)
+L.addHandler(log_handler)
+L.setLevel(logging.INFO)
+
+# <------------------------------ Arguments ---------------------------------->
+
+L.info("parsing arguments")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--bam", default=None, type=str,
+                    help="The (indexed) BAM file")
+parser.add_argument("--processes", default=1, type=int,
+                    help="Number of worker processes")
+parser.add_argument("--chunksize", default=10000000, type=int,
+                    help="The size (bp) of the regions read by the workers")
+parser.add_argument("--outfile", default=None, type=str,
+                    help="name of the fraction spliced outfile")
+parser.add_argument("--contigsoutfile", default=None, type=str,
+                    help="name of the per contig fraction spliced outfile")
+
+args = parser.parse_args()
+
+L.info("Running with arguments:")
+print(args)
+
+# <--------------------------- Sanity checks(s) ------------------------------>
+
+if args.bam is None or not os.path.exists(args.bam):
+    raise ValueError("BAM file not specified or missing")
+
+if args.outfile is None:
+    raise ValueError("Outfile not specified")
+
+# <------------------------ Count the spliced reads -------------------------->
+
+# Only uniquely mapped reads (NH:i:1) are counted. The BAM index is used
+# to split the file into regions that are read in parallel.
+
+L.info(">>>>> processing file: " + args.bam)
+
+counter = fraction_spliced(args.bam,
+                           processes=args.processes,
+                           chunk_size=args.chunksize)
+
+counter.write(args.outfile, args.contigsoutfile)
+
+L.info("fraction spliced: " + str(counter.fraction()))
+
+L.info("complete")
@@ -0,0 +1,130 @@
+import os
+import argparse
+import logging
+import sys
+
+from txseq.tasks.bam import refFlat, collect, rnaSeqMetrics, \
+    alignmentSummaryMetrics, insertSizeMetrics, libraryComplexity, \
+    fractionSpliced
+
+# <------------------------------ Logging ------------------------------------>
+
+L = logging.getLogger(__name__)
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+log_handler.setLevel(logging.INFO)
+L.addHandler(log_handler)
+L.setLevel(logging.INFO)
+
+# <------------------------------ Arguments ---------------------------------->
+
+L.info("parsing arguments")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--bam", default=None, type=str,
+                    help="The BAM file")
+parser.add_argument("--refflat", default=None, type=str,
+                    help="A (gzipped) refFlat geneset for the RNA-seq metrics")
+parser.add_argument("--strand", default="NONE", type=str,
+                    help=("The Picard strand specificity: NONE, "
+                          "FIRST_READ_TRANSCRIPTION_STRAND or "
+                          "SECOND_READ_TRANSCRIPTION_STRAND"))
+parser.add_argument("--threads", default=1, type=int,
+                    help="Number of BAM decompression threads")
+parser.add_argument("--rnaseqmetrics", default=None, type=str,
+                    help="name of the RNA-seq metrics outfile")
+parser.add_argument("--coveragehist", default=None, type=str,
+                    help="name of the coverage histogram outfile")
+parser.add_argument("--alignmentsummary", default=None, type=str,
+                    help="name of the alignment summary metrics outfile")
+parser.add_argument("--insertsize", default=None, type=str,
+                    help="name of the insert size metrics outfile")
+parser.add_argument("--insertsizehist", default=None, type=str,
+                    help="name of the insert size histogram outfile")
+parser.add_argument("--librarycomplexity", default=None, type=str,
+                    help="name of the library complexity outfile")
+parser.add_argument("--fractionspliced", default=None, type=str,
+                    help="name of the fraction spliced outfile")
+parser.add_argument("--fractionsplicedcontigs", default=None, type=str,
+                    help="name of the per contig fraction spliced outfile")
+
+args = parser.parse_args()
+
+L.info("Running with arguments:")
+print(args)
+
+# <--------------------------- Sanity checks(s) ------------------------------>
+
+if args.bam is None or not os.path.exists(args.bam):
+    raise ValueError("BAM file not specified or missing")
+
+if args.rnaseqmetrics is not None:
+
+    if args.refflat is None or not os.path.exists(args.refflat):
+        raise ValueError("refFlat file not specified or missing")
+
+    if args.coveragehist is None:
+        raise ValueError("Coverage histogram outfile not specified")
+
+if (args.insertsize is None) != (args.insertsizehist is None):
+    raise ValueError("Both of the insert size outfiles must be specified")
+
+# <---------------------------- Collect metrics ------------------------------>
+
+# The BAM file is read once and each record is passed to all of the
+# requested metric collectors.
+
+collectors = {}
+
+if args.rnaseqmetrics is not None:
+    L.info("reading the geneset")
+    collectors["rnaseq"] = rnaSeqMetrics(refFlat(args.refflat), args.strand)
+
+if args.alignmentsummary is not None:
+    collectors["alignment"] = alignmentSummaryMetrics()
+
+if args.insertsize is not None:
+    collectors["insert"] = insertSizeMetrics()
+
+if args.librarycomplexity is not None:
+    collectors["complexity"] = libraryComplexity()
+
+if args.fractionspliced is not None:
+    collectors["spliced"] = fractionSpliced()
+
+if len(collectors) == 0:
+    raise ValueError("No outfiles specified")
+
+L.info(">>>>> processing file: " + args.bam)
+
+n = collect(args.bam, list(collectors.values()), threads=args.threads)
+
+L.info("<<<<< finished processing " + str(n) + " records")
+
+# <----------------------------- Write outputs ------------------------------->
+
+outfiles = [args.rnaseqmetrics, args.coveragehist, args.alignmentsummary,
+            args.insertsize, args.insertsizehist, args.librarycomplexity,
+            args.fractionspliced, args.fractionsplicedcontigs]
+
+for outfile in outfiles:
+    if outfile is not None and os.path.dirname(outfile) != "":
+        os.makedirs(os.path.dirname(outfile), exist_ok=True)
+
+if "rnaseq" in collectors:
+    collectors["rnaseq"].write(args.rnaseqmetrics, args.coveragehist)
+
+if "alignment" in collectors:
+    collectors["alignment"].write(args.alignmentsummary)
+
+if "insert" in collectors:
+    collectors["insert"].write(args.insertsize, args.insertsizehist)
+
+if "complexity" in collectors:
+    collectors["complexity"].write(args.librarycomplexity)
+
+if "spliced" in collectors:
+    collectors["spliced"].write(args.fractionspliced,
+                                args.fractionsplicedcontigs)
+
+L.info("complete")
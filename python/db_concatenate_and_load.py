@@ -0,0 +1,76 @@
+import os
+import argparse
+import logging
+import sys
+
+from txseq.tasks.db import concatenate_and_load
+
+# <------------------------------ Logging ------------------------------------>
+
+L = logging.getLogger(__name__)
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+log_handler.setLevel(logging.INFO)
+L.addHandler(log_handler)
+L.setLevel(logging.INFO)
+
+# <------------------------------ Arguments ---------------------------------->
+
+L.info("parsing arguments")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--database", default="csvdb", type=str,
+                    help="The path to the sqlite database")
+parser.add_argument("--outfile", default=None, type=str,
+                    help=("The .load file. The table is named after it and "
+                          "the number of rows loaded is written to it"))
+parser.add_argument("--regex-filename", dest="regex_filename",
+                    default=None, type=str,
+                    help=("A regular expression that extracts the values "
+                          "of the cat column(s) from the file names"))
+parser.add_argument("--cat", default="track", type=str,
+                    help=("Comma separated names of the columns holding the "
+                          "values extracted from the file names"))
+parser.add_argument("--header", default=None, type=str,
+                    help=("Comma separated names of all of the columns, "
+                          "for files without a header line"))
+parser.add_argument("--no-titles", dest="has_titles", action="store_false",
+                    help="The files do not have a header line")
+parser.add_argument("--index", dest="indexes", action="append", default=[],
+                    help="A column to index (can be given more than once)")
+parser.add_argument("--incremental", action="store_true",
+                    help=("Only load the new or changed files to an "
+                          "existing table"))
+parser.add_argument("infiles", nargs="+",
+                    help="The tab-separated files to load")
+
+args = parser.parse_args()
+
+L.info("Running with arguments:")
+print(args)
+
+# <--------------------------- Sanity checks(s) ------------------------------>
+
+if args.outfile is None or not args.outfile.endswith(".load"):
+    raise ValueError("The outfile must be given and end with .load")
+
+for infile in args.infiles:
+    if not os.path.exists(infile):
+        raise ValueError("File to load: " + infile + " does not exist")
+
+# <--------------------------- Load the table -------------------------------->
+
+L.info("loading " + str(len(args.infiles)) + " files to " + args.database)
+
+loaded = concatenate_and_load(args.infiles, args.outfile, args.database,
+                              regex_filename=args.regex_filename,
+                              cat=args.cat,
+                              has_titles=args.has_titles,
+                              header=args.header,
+                              indexes=args.indexes,
+                              incremental=args.incremental)
+
+for table, n_rows in loaded.items():
+    L.info("loaded %i rows to %s" % (n_rows, table))
+
+L.info("complete")
@@ -0,0 +1,107 @@
+import os
+import argparse
+import logging
+import sys
+
+from txseq.tasks.intervals import intervals, read_contigs
+from txseq.tasks.gtf import stream_gtf, gtfWriter, tx2geneWriter, \
+    attributeTableWriter
+
+# <------------------------------ Logging ------------------------------------>
+
+L = logging.getLogger(__name__)
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+log_handler.setLevel(logging.INFO)
+L.addHandler(log_handler)
+L.setLevel(logging.INFO)
+
+# <------------------------------ Arguments ---------------------------------->
+
+L.info("parsing arguments")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--ensemblgtf", default=None, type=str,
+                    help=("An Ensembl GTF file"))
+parser.add_argument("--contigs", default="contigs", type=str,
+                    help='A text file with the contig names, one per line')
+parser.add_argument("--mask", default=None, type=str,
+                    help=("A bed file containing genomic intervals"
+                          " from which transcripts are to be excluded"))
+parser.add_argument("--attributes",
+                    default=("transcript_id,transcript_name,transcript_biotype,"
+                             "gene_id,gene_name,gene_biotype"),
+                    type=str,
+                    help='A comma separated list of the transcript attributes '
+                         'to extract')
+parser.add_argument("--outgtf", default=None, type=str,
+                    help=("name of the gzip compressed filtered GTF outfile"))
+parser.add_argument("--outtx2gene", default=None, type=str,
+                    help=("name of the transcript to gene map outfile"))
+parser.add_argument("--outtxinfo", default=None, type=str,
+                    help=("name of the gzip compressed transcript "
+                          "information outfile"))
+
+args = parser.parse_args()
+
+L.info("Running with arguments:")
+print(args)
+
+# <--------------------------- Sanity checks(s) ------------------------------>
+
+if args.ensemblgtf is None:
+    raise ValueError("Input GTF file path not given")
+
+if not os.path.exists(args.ensemblgtf):
+    raise ValueError("GTF file: " + args.ensemblgtf + " does not exist")
+
+if args.contigs is None or not os.path.exists(args.contigs):
+    raise ValueError("Contigs file not specified or missing")
+
+if args.mask is None or not os.path.exists(args.mask):
+    raise ValueError("Mask file not specified or missing")
+
+# <--------------------------- Process the GTF ------------------------------->
+
+# The GTF is read once. In the same pass:
+#
+# (1) records from primary contigs that are not in masked regions are
+#     written to the filtered GTF
+# (2) transcript_id -> gene_id mappings are collected from the filtered
+#     transcript records
+# (3) the transcript attributes are written for all of the transcript
+#     records (i.e. from the unfiltered geneset)
+
+L.info("reading in list of contigs to be included")
+contigs = read_contigs(args.contigs)
+
+L.info("reading in regions to mask")
+masks = intervals.from_bed(args.mask)
+
+take = [x.strip() for x in args.attributes.strip().split(",")]
+
+sinks = [gtfWriter(args.outgtf),
+         tx2geneWriter(args.outtx2gene),
+         attributeTableWriter(args.outtxinfo, take)]
+
+L.info(">>>>> processing file: " + args.ensemblgtf)
+
+summary = stream_gtf(args.ensemblgtf, sinks,
+                     contigs=contigs, masks=masks)
+
+L.info("Summary of excluded contig filtering:")
+for contig, count in summary["skipped_contigs"].items():
+    print("Filtered out " + str(count) + " entries on excluded contig " + contig)
+
+L.info("Summary of filtering of genes in masked regions on included contigs:")
+print("Filtered out " + str(summary["n_masked"]) + " entries in masked "
+      "region(s) on included contigs")
+for contig, genes in summary["masked_genes"].items():
+    print("Filtered out " + str(len(genes)) + " genes in masked region(s) "
+          "on included contig " + contig)
+    print("The filtered genes on contig " + contig + " were: ")
+    print(",".join(genes))
+
+L.info("<<<<< finished processing file: " + args.ensemblgtf)
+
+L.info("complete")
@@ -5,7 +5,8 @@ import logging
 import sys
 import gzip
 from Bio import SeqIO
-from Bio.Align import bed
+
+from txseq.tasks.intervals import intervals, read_contigs
 
 # <------------------------------ Logging ------------------------------------>
 
@@ -59,30 +60,10 @@ if not os.path.exists(args.mask) or args.mask is None:
 
 
 L.info("reading in list of contigs to be included")
-contigs = []
-
-with open(args.contigs,"r") as cf:
-
-    for line in cf:
-        if line != "":
-            contigs.append(line.strip())
+contigs = read_contigs(args.contigs)
 
 L.info("reading in regions to mask")
-masks = {}
-with open(args.mask) as mf:
-
-    intervals = bed.AlignmentIterator(mf)
-    
-    for interval in intervals:
-    
-        name = interval.target.id
-        start = interval.coordinates[0][0]
-        end = interval.coordinates[0][1]
-        
-        if name not in masks.keys():
-            masks[name] = []
-        
-        masks[name].append([min([start,end]),max([start,end])])
+masks = intervals.from_bed(args.mask)
 
 # Note from ensembl.org:
 #
@@ -150,32 +131,21 @@ with gzip.open(args.outfile, "wt") as out_file:
 
                 continue
             
-            in_masked = False    
-            
-            
-            if contig in masks.keys():
-            
-                contig_masks = masks[contig]
-            
-                for masked_region in contig_masks:
-            
-                    #print(masked_region)
-                    if x > masked_region[0] and y < masked_region[1]:
-                        
-                        gene = description.split(" ")[3].split(":")[1]
-                        
-                        if contig not in skipped_genes.keys():
-                            skipped_genes[contig] = {"genes": [gene],
-                                                     "ntx": 1}
-                        else:
-                            if gene not in skipped_genes[contig]["genes"]:
-                                skipped_genes[contig]["genes"].append(gene)
-                                
-                            skipped_genes[contig]["ntx"] += 1
-                        
-                        in_masked = True
-                        break
-            
+            in_masked = False
+
+            if masks.contains(contig, x, y):
+
+                gene = description.split(" ")[3].split(":")[1]
+
+                if contig not in skipped_genes.keys():
+                    skipped_genes[contig] = {"genes": {gene: None},
+                                             "ntx": 1}
+                else:
+                    skipped_genes[contig]["genes"][gene] = None
+                    skipped_genes[contig]["ntx"] += 1
+
+                in_masked = True
+
             # remove the version number from the transcript ID
             # to enable cross-referencing with the ensembl GTF...
             # (.. assume here that multiple versions of the same transcript
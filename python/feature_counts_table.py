@@ -7,6 +7,9 @@ import sqlite3
 import pandas as pd
 import numpy as np
 
+from txseq.tasks.matrix import sql_to_wide, update_wide
+from txseq.tasks.db import updated_tracks
+
 
 # <------------------------------ Logging ------------------------------------>
 
@@ -28,6 +31,12 @@ parser.add_argument("--table", default=None, type=str,
                     help=("The table name"))
 parser.add_argument("--outfile", default=None, type=str,
                     help=("name of the gzip compressed outfile"))
+parser.add_argument("--chunksize", default=None, type=int,
+                    help=("If given, stream the rows from the database in "
+                          "batches of this size to bound peak memory"))
+parser.add_argument("--incremental", action="store_true",
+                    help=("If the outfile exists, only update the columns of "
+                          "the samples (re)loaded since it was written"))
 
 args = parser.parse_args()
 
@@ -43,7 +52,7 @@ if not os.path.exists(args.database):
   
 # <--------------------------- fetch the counts ------------------------------>
 
-L.info("fetching the data from the database")
+L.info("fetching the data from the database and pivoting to a wide table")
 
 con = sqlite3.connect(args.database)
 
@@ -53,24 +62,31 @@ sql = '''select track, gene_id, counts
              from %(table)s t
           ''' % vars(args)
 
-df = pd.read_sql(sql, con)
-
-L.info("pivoting to a wide table")
-
-# df = df.pivot(index="gene_id", columns="track", values="counts")
-# df.to_csv(outfile, sep="\t", index=True, index_label="gene_id")
-
-
-out_df = pd.DataFrame(index=[x for x in df["gene_id"].unique()])
-
-for sample in [x for x in df["track"].unique()]:
+tracks = None
+
+if args.incremental and os.path.exists(args.outfile):
+    tracks = updated_tracks(args.database, args.table,
+                            os.path.getmtime(args.outfile))
+
+if tracks is None:
+    out_df = sql_to_wide(sql, con,
+                         index="gene_id",
+                         columns="track",
+                         values="counts",
+                         chunksize=args.chunksize)
+else:
+    updated, current = tracks
+    L.info("updating %i of %i samples" % (len(updated), len(current)))
+
+    out_df = pd.read_csv(args.outfile, sep="\t", index_col=0)
+    out_df = update_wide(out_df, sql, con,
+                         index="gene_id",
+                         columns="track",
+                         values="counts",
+                         updated=updated,
+                         tracks=current,
+                         chunksize=args.chunksize)
 
-    sample_df = df[df["track"]==sample].copy()
-    sample_df.index = sample_df["gene_id"]
-    
-    out_df[sample] = np.NaN
-    out_df.loc[sample_df.index, sample] = sample_df["counts"]
-    
 out_df = out_df.astype(int)
 
 out_df.to_csv(args.outfile, sep="\t", index=True, index_label="gene_id")
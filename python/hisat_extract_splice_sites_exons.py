@@ -0,0 +1,52 @@
+import os
+import argparse
+import logging
+import sys
+
+from txseq.tasks.gtf import stream_gtf, hisatWriter
+
+# <------------------------------ Logging ------------------------------------>
+
+L = logging.getLogger(__name__)
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+log_handler.setLevel(logging.INFO)
+L.addHandler(log_handler)
+L.setLevel(logging.INFO)
+
+# <------------------------------ Arguments ---------------------------------->
+
+L.info("parsing arguments")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--gtf", default=None, type=str,
+                    help="A (gzip compressed) GTF file")
+parser.add_argument("--exons", default=None, type=str,
+                    help="name of the exons outfile")
+parser.add_argument("--splicesites", default=None, type=str,
+                    help="name of the splice sites outfile")
+
+args = parser.parse_args()
+
+L.info("Running with arguments:")
+print(args)
+
+# <--------------------------- Sanity checks(s) ------------------------------>
+
+if args.gtf is None or not os.path.exists(args.gtf):
+    raise ValueError("GTF file not specified or missing")
+
+if args.exons is None or args.splicesites is None:
+    raise ValueError("Both of the outfiles must be specified")
+
+# <--------------------------- Process the GTF ------------------------------->
+
+# The GTF is read once to make both of the hisat2-build inputs.
+
+L.info(">>>>> processing file: " + args.gtf)
+
+stream_gtf(args.gtf, [hisatWriter(args.exons, args.splicesites)])
+
+L.info("<<<<< finished processing file: " + args.gtf)
+
+L.info("complete")
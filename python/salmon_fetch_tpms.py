@@ -7,6 +7,9 @@ import sqlite3
 import pandas as pd
 import numpy as np
 
+from txseq.tasks.matrix import sql_to_wide, update_wide
+from txseq.tasks.db import updated_tracks
+
 
 # <------------------------------ Logging ------------------------------------>
 
@@ -31,6 +34,12 @@ parser.add_argument("--idname", default="gene_id", type=str,
                          'or transcript identifiers')
 parser.add_argument("--outfile", default=None, type=str,
                     help=("name of the gzip compressed outfile"))
+parser.add_argument("--chunksize", default=None, type=int,
+                    help=("If given, stream the rows from the database in "
+                          "batches of this size to bound peak memory"))
+parser.add_argument("--incremental", action="store_true",
+                    help=("If the outfile exists, only update the columns of "
+                          "the samples (re)loaded since it was written"))
 
 args = parser.parse_args()
 
@@ -46,7 +55,7 @@ if not os.path.exists(args.database):
 # <--------------------------- fetch the TPMs ------------------------------>
 
 
-L.info("fetching the data from the database")
+L.info("fetching the data from the database and pivoting to a wide table")
 
 con = sqlite3.connect(args.database)
 
@@ -56,25 +65,32 @@ sql = '''select sample_id, Name %(idname)s, TPM tpm
             from %(table)s
         ''' % vars(args)
 
-df = pd.read_sql(sql, con)
-
-L.info("pivoting to a wide table")
-#df = df.pivot(index=args.idname, columns=["sample_id", "tpm"])
-# df.pivot uses too much memory.
-#df.to_csv(args.outfile, sep="\t", index=True, index_label=id_name)
-
-out_df = pd.DataFrame(index=[x for x in df[args.idname].unique()])
-#out_df[args.idname] = out_df.index
-
-for sample in [x for x in df["sample_id"].unique()]:
-
-    sample_df = df[df["sample_id"]==sample].copy()
-    sample_df.index = sample_df[args.idname]
-    
-    out_df[sample] = np.NaN
-    out_df.loc[sample_df.index, sample] = sample_df["tpm"]
-
-
+tracks = None
+
+if args.incremental and os.path.exists(args.outfile):
+    tracks = updated_tracks(args.database, args.table,
+                            os.path.getmtime(args.outfile))
+
+if tracks is None:
+    out_df = sql_to_wide(sql, con,
+                         index=args.idname,
+                         columns="sample_id",
+                         values="tpm",
+                         chunksize=args.chunksize)
+else:
+    updated, current = tracks
+    L.info("updating %i of %i samples" % (len(updated), len(current)))
+
+    out_df = pd.read_csv(args.outfile, sep="\t", index_col=0)
+    out_df = update_wide(out_df, sql, con,
+                         index=args.idname,
+                         columns="sample_id",
+                         values="tpm",
+                         updated=updated,
+                         tracks=current,
+                         chunksize=args.chunksize)
+
+L.info("saving the wide table")
 out_df.to_csv(args.outfile, sep="\t", index=True, index_label=args.idname)
 
 L.info("complete")
\ No newline at end of file
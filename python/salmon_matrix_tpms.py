@@ -0,0 +1,54 @@
+import os
+import argparse
+import logging
+import sys
+
+from txseq.tasks.matrix import read_matrix
+
+
+# <------------------------------ Logging ------------------------------------>
+
+L = logging.getLogger(__name__)
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+log_handler.setLevel(logging.INFO)
+L.addHandler(log_handler)
+L.setLevel(logging.INFO)
+
+# <------------------------------ Arguments ---------------------------------->
+
+L.info("parsing arguments")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--matrix", default=None, type=str,
+                    help=("The TPM matrix written by salmon_quant_matrices.py"))
+parser.add_argument("--idname", default="gene_id", type=str,
+                    help='the name of the column containing the gene '
+                         'or transcript identifiers')
+parser.add_argument("--outfile", default=None, type=str,
+                    help=("name of the gzip compressed outfile"))
+
+args = parser.parse_args()
+
+L.info("Running with arguments:")
+print(args)
+
+# <--------------------------- Sanity checks(s) ------------------------------>
+
+if args.matrix is None or not os.path.exists(args.matrix):
+    raise ValueError("TPM matrix: " + str(args.matrix) + " does not exist")
+
+if args.outfile is None:
+    raise ValueError("No outfile given")
+
+# <--------------------------- write the TPMs ------------------------------->
+
+L.info("reading the TPM matrix")
+
+df = read_matrix(args.matrix)
+
+L.info("writing the wide table of TPMs")
+
+df.to_csv(args.outfile, sep="\t", index=True, index_label=args.idname)
+
+L.info("complete")
@@ -0,0 +1,145 @@
+import os
+import argparse
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import numpy as np
+
+from txseq.tasks.matrix import write_matrix
+
+
+# <------------------------------ Logging ------------------------------------>
+
+L = logging.getLogger(__name__)
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+log_handler.setLevel(logging.INFO)
+L.addHandler(log_handler)
+L.setLevel(logging.INFO)
+
+# <------------------------------ Arguments ---------------------------------->
+
+L.info("parsing arguments")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--salmondir", default="salmon.dir", type=str,
+                    help=("The folder containing the per-sample salmon "
+                          "output folders"))
+parser.add_argument("--samples", default=None, type=str,
+                    help=("A comma separated list of the sample_ids"))
+parser.add_argument("--quantfile", default="quant.sf", type=str,
+                    help=("The name of the salmon quantification file, "
+                          "i.e. quant.sf or quant.genes.sf"))
+parser.add_argument("--idname", default="transcript_id", type=str,
+                    help='the name of the column containing the gene '
+                         'or transcript identifiers')
+parser.add_argument("--format", default="parquet", type=str,
+                    help=("The output format: parquet, feather, hdf5 or tsv"))
+parser.add_argument("--threads", default=1, type=int,
+                    help=("The number of files to read in parallel"))
+parser.add_argument("--outprefix", default=None, type=str,
+                    help=("The output file prefix. The matrices are saved to "
+                          "prefix.tpm.<ext>, prefix.numreads.<ext> and "
+                          "prefix.effectivelength.<ext>"))
+
+args = parser.parse_args()
+
+L.info("Running with arguments:")
+print(args)
+
+# <--------------------------- Sanity checks(s) ------------------------------>
+
+if args.samples is None:
+    raise ValueError("No sample_ids given")
+
+sample_ids = [x.strip() for x in args.samples.split(",")]
+
+quant_files = [os.path.join(args.salmondir, x, args.quantfile)
+               for x in sample_ids]
+
+for quant_file in quant_files:
+    if not os.path.exists(quant_file):
+        raise ValueError("Salmon file: " + quant_file + " does not exist")
+
+# <--------------------------- Read the quant files -------------------------->
+
+# The columns of the salmon quant.sf and quant.genes.sf files
+#
+# Name  Length  EffectiveLength  TPM  NumReads
+
+values = {"tpm": "TPM",
+          "numreads": "NumReads",
+          "effectivelength": "EffectiveLength"}
+
+
+def read_quant(quant_file):
+    '''
+    Read the identifiers and values from a salmon quantification file.
+    '''
+
+    return(pd.read_csv(quant_file, sep="\t",
+                       usecols=["Name"] + list(values.values()),
+                       dtype={"Name": str,
+                              "TPM": np.float64,
+                              "NumReads": np.float64,
+                              "EffectiveLength": np.float64}))
+
+
+L.info("reading " + str(len(quant_files)) + " salmon files")
+
+# All the samples are quantified against the same index so the rows
+# are normally in the same order in every file. The first file sets the
+# row order, other files are only re-indexed if their order differs.
+#
+# Files are read in batches so that only a few parsed files are held in
+# memory at once in addition to the output matrices.
+
+matrices = None
+batch_size = args.threads * 4
+
+with ThreadPoolExecutor(max_workers=args.threads) as pool:
+
+    for start in range(0, len(quant_files), batch_size):
+
+        batch = quant_files[start:start + batch_size]
+
+        for j, quant in enumerate(pool.map(read_quant, batch), start):
+
+            if matrices is None:
+                names = pd.Index(quant["Name"].values)
+
+                if not names.is_unique:
+                    raise ValueError("Non-unique identifiers in "
+                                     + quant_files[j])
+
+                matrices = {k: np.empty((len(names), len(sample_ids)),
+                                        dtype=np.float64)
+                            for k in values.keys()}
+
+            if np.array_equal(quant["Name"].values, names.values):
+                rows = slice(None)
+
+            else:
+                rows = names.get_indexer(quant["Name"].values)
+
+                if len(quant) != len(names) or (rows == -1).any():
+                    raise ValueError("Identifiers in " + quant_files[j] +
+                                     " do not match those of " +
+                                     quant_files[0])
+
+            for k, column in values.items():
+                matrices[k][rows, j] = quant[column].values
+
+# <--------------------------- Write the matrices ---------------------------->
+
+for k, matrix in matrices.items():
+
+    df = pd.DataFrame(matrix, index=names, columns=sample_ids)
+
+    path = write_matrix(df, args.outprefix + "." + k, fmt=args.format,
+                        index_label=args.idname)
+
+    L.info("saved " + path)
+
+L.info("complete")
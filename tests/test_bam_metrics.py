@@ -0,0 +1,193 @@
+'''test_bam_metrics - tests for the single pass BAM metrics in tasks.bam
+======================================================================
+
+Purpose
+-------
+
+Check that the tables written by the :mod:`txseq.tasks.bam` collectors
+(via python/bam_metrics.py) have the same columns and values as the
+tables that pipeline_bamqc loads from the Picard metrics files (i.e. as
+written by :func:`txseq.tasks.picard.write_metrics`).
+
+The fixture (tests/data/bam) is a small coordinate sorted paired end
+BAM file (built from fixture.sam) with a refFlat geneset. It includes a
+duplicate pair sequenced in the opposite orientation, a spliced pair, a
+read with an insertion and mismatch, low quality bases and an
+intergenic pair. The expected "fixture.*_metrics" files are in the
+Picard format. They were worked out from the Picard metric definitions
+for this fixture and follow the documented differences of tasks.bam
+(e.g. duplicates are identified from the alignment positions).
+
+'''
+import os
+import sys
+import subprocess
+import tempfile
+
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import txseq.tasks.picard as picard
+from txseq.tasks.bam import fraction_spliced
+
+DATA = os.path.join(ROOT, "tests", "data", "bam")
+BAM = os.path.join(DATA, "fixture.bam")
+
+
+def run_bam_metrics(outdir):
+    '''run python/bam_metrics.py on the fixture'''
+
+    outfiles = {"rnaseqmetrics": "rnaseq.metrics",
+                "coveragehist": "rnaseq.cov.hist",
+                "alignmentsummary": "alignment.summary.metrics",
+                "insertsize": "insert.size.metrics",
+                "insertsizehist": "insert.size.hist",
+                "librarycomplexity": "library.complexity.metrics",
+                "fractionspliced": "fraction.spliced",
+                "fractionsplicedcontigs": "fraction.spliced.contigs"}
+
+    outfiles = {k: os.path.join(outdir, v) for k, v in outfiles.items()}
+
+    cmd = [sys.executable, os.path.join(ROOT, "python", "bam_metrics.py"),
+           "--bam", BAM,
+           "--refflat", os.path.join(DATA, "geneset.refflat"),
+           "--strand", "NONE"]
+
+    for option, outfile in outfiles.items():
+        cmd += ["--" + option, outfile]
+
+    subprocess.run(cmd, check=True, capture_output=True,
+                   env=dict(os.environ, PYTHONPATH=ROOT))
+
+    return(outfiles)
+
+
+def picard_tables(metrics_file, outdir, **kwargs):
+    '''
+    return the tables written by picard.write_metrics (as loaded by
+    pipeline_bamqc) from a Picard metrics file.
+    '''
+
+    name = os.path.basename(metrics_file)
+    metrics_out = os.path.join(outdir, name + ".expected")
+    histogram_out = os.path.join(outdir, name + ".expected.hist")
+
+    picard.write_metrics(metrics_file, metrics_out=metrics_out,
+                         histogram_out=histogram_out, **kwargs)
+
+    return(metrics_out, histogram_out)
+
+
+def read_table(path):
+
+    if os.path.getsize(path) == 0:
+        return(None)
+
+    return(pd.read_csv(path, sep="\t"))
+
+
+def compare(path, expected_path):
+    '''the tables have the same columns and (numerically) the same values'''
+
+    table, expected = read_table(path), read_table(expected_path)
+
+    if expected is None:
+        assert table is None
+        return
+
+    assert list(table.columns) == list(expected.columns)
+
+    pd.testing.assert_frame_equal(table, expected, check_dtype=False,
+                                  check_exact=False, atol=1e-6)
+
+
+def test_bam_metrics():
+    '''each collector matches the Picard metrics for the fixture'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        outfiles = run_bam_metrics(tmp)
+
+        # rnaseq metrics (no transcripts are long enough for the
+        # coverage histogram, so as for Picard, none is written)
+        metrics, hist = picard_tables(
+            os.path.join(DATA, "fixture.rna_metrics"), tmp)
+        compare(outfiles["rnaseqmetrics"], metrics)
+        compare(outfiles["coveragehist"], hist)
+
+        metrics, hist = picard_tables(
+            os.path.join(DATA, "fixture.alignment_summary_metrics"), tmp)
+        compare(outfiles["alignmentsummary"], metrics)
+
+        metrics, hist = picard_tables(
+            os.path.join(DATA, "fixture.insert_size_metrics"), tmp,
+            first_row=True)
+        compare(outfiles["insertsize"], metrics)
+        compare(outfiles["insertsizehist"], hist)
+
+        metrics, hist = picard_tables(
+            os.path.join(DATA, "fixture.library_complexity_metrics"), tmp)
+        compare(outfiles["librarycomplexity"], metrics)
+
+        compare(outfiles["fractionsplicedcontigs"],
+                os.path.join(DATA, "fixture.fraction_spliced.contigs.tsv"))
+
+        # the numbers of reads are given for the confidence intervals
+        table = read_table(outfiles["fractionspliced"])
+        assert table.values.tolist() == [[0.1, 1, 9]]
+        assert list(table.columns) == ["fraction_spliced", "spliced",
+                                       "unspliced"]
+
+
+def test_duplicate_orientation():
+    '''a pair sequenced in the opposite orientation is a duplicate'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        outfiles = run_bam_metrics(tmp)
+
+        table = read_table(outfiles["librarycomplexity"])
+
+        assert table["READ_PAIR_DUPLICATES"].tolist() == [1]
+        assert table["PERCENT_DUPLICATION"].tolist() == [0.2]
+
+
+def test_fraction_spliced_regions():
+    '''the indexed (per region) count matches the single pass count'''
+
+    counter = fraction_spliced(BAM, processes=1, chunk_size=500)
+
+    assert counter.counts == {"chr1": [1, 7], "chr2": [0, 2]}
+    assert counter.fraction() == 0.1
+
+
+def test_combine_libraries():
+    '''the per-library EstimateLibraryComplexity rows are combined'''
+
+    with open(os.path.join(DATA, "fixture.library_complexity_metrics")) as f:
+        text = f.read().rstrip("\n")
+
+    # add a second library
+    text += "\nlib2\t2\t5\t0\t1\t2\t3\t0\t0.666667\t4\n"
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        metrics_file = os.path.join(tmp, "x.library_complexity_metrics")
+
+        with open(metrics_file, "w") as outfile:
+            outfile.write(text)
+
+        metrics_out = os.path.join(tmp, "x.library.complexity")
+        picard.write_metrics(metrics_file, metrics_out=metrics_out,
+                             level="sample")
+
+        table = read_table(metrics_out)
+
+    assert len(table) == 1
+    assert table["LIBRARY"].tolist() == ["lib2"]
+    assert table["READ_PAIRS_EXAMINED"].tolist() == [10]
+    assert table["READ_PAIR_DUPLICATES"].tolist() == [4]
+    assert table["ESTIMATED_LIBRARY_SIZE"].tolist() == [14]
+    assert abs(table["PERCENT_DUPLICATION"][0] - 10 / 22) < 1e-9
@@ -0,0 +1,68 @@
+'''test_cache - tests for the shared index cache in tasks.cache
+=============================================================
+
+Purpose
+-------
+
+Check that the entries of :class:`txseq.tasks.cache.indexCache` are
+fetched once stored and that the entries, the input digests and the
+lock files are given the permissions of the umask (rather than the
+private permissions of the temporary build directory) so that the
+cache can be shared.
+
+'''
+import os
+import sys
+import stat
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import txseq.tasks.cache as cache
+
+
+def mode(path):
+
+    return(stat.S_IMODE(os.stat(path).st_mode))
+
+
+def test_shared_permissions():
+    '''the cache files can be read by the group and others'''
+
+    umask = os.umask(0o022)
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+
+            genome = os.path.join(tmp, "genome.fa")
+            with open(genome, "w") as outfile:
+                outfile.write(">chr1\nACGT\n")
+
+            index_cache = cache.indexCache(os.path.join(tmp, "cache"))
+
+            key = index_cache.key({"genome": genome}, version="1",
+                                  options={"k": 31})
+
+            with index_cache.lock(key):
+
+                build_dir = index_cache.build_dir(key)
+
+                with open(os.path.join(build_dir, "index.txt"), "w") as f:
+                    f.write("index")
+
+                index_cache.store(key, build_dir)
+
+                assert index_cache.fetch(key, os.path.join(tmp, "out"))
+
+            with open(os.path.join(tmp, "out", "index.txt")) as infile:
+                assert infile.read() == "index"
+
+            cache_dir = index_cache.cache_dir
+
+            assert mode(index_cache.path(key)) == 0o755
+            assert mode(os.path.join(cache_dir, cache.DIGESTS_FILE)) == 0o644
+            assert mode(os.path.join(cache_dir, key + ".lock")) == 0o644
+
+    finally:
+        os.umask(umask)
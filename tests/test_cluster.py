@@ -0,0 +1,350 @@
+'''test_cluster - tests for resubmitting failed cluster jobs
+==========================================================
+
+Purpose
+-------
+
+Check that :mod:`txseq.tasks.cluster` reads the reason that a job
+failed from (canned) SLURM sacct and SGE qacct accounting output and
+that :meth:`txseq.tasks.setup.setup.escalate` and
+:meth:`txseq.tasks.setup.setup.run` resubmit jobs with more memory (or
+time) only when this is enabled and within the configured limits,
+starting from the memory predicted from the resource history (see
+:mod:`txseq.tasks.history`) when prediction is enabled.
+
+'''
+import os
+import sys
+import types
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import txseq.tasks.cluster as cluster
+import txseq.tasks.history as history
+from txseq.tasks.profile import recordColumns
+from txseq.tasks.setup import setup
+
+SACCT_OOM = """OUT_OF_MEMORY|02:00:00
+CANCELLED by 0|
+OUT_OF_MEMORY|
+"""
+
+SACCT_TIMEOUT = """TIMEOUT|1-00:30:00
+CANCELLED|
+COMPLETED|
+"""
+
+SACCT_FAILED = """FAILED|02:00:00
+FAILED|
+"""
+
+QACCT = """==============================================================
+qname        all.q
+hostname     node1
+jobnumber    123
+failed       %(failed)s
+exit_status  %(exit_status)s
+maxvmem      %(maxvmem)s
+"""
+
+
+def canned(monkeypatch, output):
+    '''make the accounting commands return *output*'''
+
+    commands = []
+
+    def _command(cmd):
+        commands.append(cmd)
+        return(output)
+
+    monkeypatch.setattr(cluster, "_command", _command)
+
+    return(commands)
+
+
+def qacct(failed="0", exit_status="0", maxvmem="1.000G"):
+
+    return(QACCT % locals())
+
+
+def test_time():
+    '''time limits are parsed and formatted'''
+
+    assert cluster.parse_time("1-02:03:04") == 93784
+    assert cluster.parse_time("02:03:04") == 7384
+    assert cluster.parse_time("03:04") == 184
+    assert cluster.parse_time("UNLIMITED") is None
+    assert cluster.format_time(93784) == "1-02:03:04"
+    assert cluster.format_time(7384.5) == "0-02:03:04"
+
+
+def test_failed_job_id():
+    '''the job id is read from the P.run() error'''
+
+    assert cluster.failed_job_id(
+        RuntimeError("Job 12345 has exited with exit status 1")) == "12345"
+    assert cluster.failed_job_id(
+        OSError("---- job 77.1 failed")) == "77.1"
+    assert cluster.failed_job_id(RuntimeError("no such file")) is None
+
+
+def test_slurm_failure(monkeypatch):
+    '''the sacct job and step states are read'''
+
+    commands = canned(monkeypatch, SACCT_OOM)
+    assert cluster.slurm_failure("1") == {"reason": "memory",
+                                          "time_limit": 7200}
+    assert commands[0][:3] == ["sacct", "-j", "1"]
+
+    canned(monkeypatch, SACCT_TIMEOUT)
+    assert cluster.slurm_failure("1") == {"reason": "time",
+                                          "time_limit": 88200}
+
+    canned(monkeypatch, SACCT_FAILED)
+    assert cluster.slurm_failure("1")["reason"] is None
+
+    canned(monkeypatch, None)
+    assert cluster.slurm_failure("1") == {"reason": None,
+                                          "time_limit": None}
+
+
+def test_sge_failure(monkeypatch):
+    '''the qacct failure, exit status and peak memory are read'''
+
+    # the peak memory reached the request
+    for maxvmem in ["7.900G", "7900.000M", "7900000K", "0.0079T",
+                    "7900000000"]:
+        canned(monkeypatch, qacct(failed="100 : assumedly after job",
+                                  exit_status="137", maxvmem=maxvmem))
+        assert cluster.sge_failure("123", memory_gb=8)["reason"] == \
+            "memory", maxvmem
+
+    # killed by a signal, well within the memory request
+    canned(monkeypatch, qacct(exit_status="137", maxvmem="1.000G"))
+    assert cluster.sge_failure("123", memory_gb=8)["reason"] is None
+
+    # the run time limit
+    canned(monkeypatch, qacct(failed="37  : qmaster enforced h_rt limit",
+                              maxvmem="1.000G"))
+    assert cluster.sge_failure("123", memory_gb=8)["reason"] == "time"
+
+    canned(monkeypatch, qacct(exit_status="152"))
+    assert cluster.sge_failure("123", memory_gb=8)["reason"] == "time"
+
+    # the job did not fail
+    canned(monkeypatch, qacct(maxvmem="8.000G"))
+    assert cluster.sge_failure("123", memory_gb=8)["reason"] is None
+
+
+def test_job_failure(monkeypatch):
+    '''the accounting of the queue manager is used'''
+
+    error = RuntimeError("Job 42 has exited with exit status 1")
+
+    canned(monkeypatch, SACCT_OOM)
+    assert cluster.job_failure(error, "slurm") == {
+        "reason": "memory", "time_limit": 7200, "job_id": "42"}
+
+    canned(monkeypatch, qacct(exit_status="137", maxvmem="4G"))
+    assert cluster.job_failure(error, "sge", memory_gb=4)["reason"] == \
+        "memory"
+
+    # without a job id, the error message is used
+    assert cluster.job_failure(RuntimeError("state TIMEOUT"),
+                               "slurm")["reason"] == "time"
+
+
+def make_task(tmp, memory="4G", cpu=1):
+
+    return(setup(None, os.path.join(tmp, "task", "x.sentinel"), {},
+                 memory=memory, cpu=cpu))
+
+
+PARAMS = {"resources_escalate": True,
+          "resources_escalate_factor": 2,
+          "resources_escalate_cap": "16G",
+          "resources_escalate_retries": 3,
+          "cluster_queue_manager": "slurm"}
+
+
+def test_escalate_memory(monkeypatch):
+    '''the memory is multiplied up to the cap'''
+
+    error = RuntimeError("Job 42 has exited with exit status 1")
+    canned(monkeypatch, SACCT_OOM)
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        t = make_task(tmp, memory="6G", cpu=2)
+        assert t.resources == {"job_memory": "3G", "job_threads": 2}
+
+        t.escalate(error, PARAMS)
+        assert t.resources == {"job_memory": "6G", "job_threads": 2}
+
+        # the cap is reached
+        t.escalate(error, PARAMS)
+        assert t.resources == {"job_memory": "8G", "job_threads": 2}
+
+        with pytest.raises(RuntimeError):
+            t.escalate(error, PARAMS)
+
+        assert t.job_escalations == 2
+
+
+def test_escalate_retries(monkeypatch):
+    '''at most "resources_escalate_retries" resubmissions are made'''
+
+    error = RuntimeError("Job 42 has exited with exit status 1")
+    canned(monkeypatch, SACCT_OOM)
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        t = make_task(tmp, memory="1G")
+        params = dict(PARAMS, resources_escalate_retries=2)
+
+        t.escalate(error, params)
+        t.escalate(error, params)
+
+        with pytest.raises(RuntimeError):
+            t.escalate(error, params)
+
+        assert t.resources["job_memory"] == "4G"
+
+
+def test_escalate_time(monkeypatch):
+    '''on SLURM, the time limit is multiplied'''
+
+    error = RuntimeError("Job 42 has exited with exit status 1")
+    canned(monkeypatch, SACCT_TIMEOUT)
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        t = make_task(tmp)
+
+        t.escalate(error, dict(PARAMS, cluster_options="--account=x"))
+
+        assert t.resources == {"job_memory": "4G", "job_threads": 1,
+                               "job_options": "--account=x --time=2-01:00:00"}
+
+
+def test_escalate_disabled(monkeypatch):
+    '''other failures, or any failure when disabled, are raised'''
+
+    error = RuntimeError("Job 42 has exited with exit status 1")
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        t = make_task(tmp)
+
+        canned(monkeypatch, SACCT_OOM)
+        with pytest.raises(RuntimeError):
+            t.escalate(error, dict(PARAMS, resources_escalate=False))
+
+        canned(monkeypatch, SACCT_FAILED)
+        with pytest.raises(RuntimeError):
+            t.escalate(error, PARAMS)
+
+        assert t.resources["job_memory"] == "4G"
+
+
+def fake_run(monkeypatch, calls, failures):
+    '''replace cgat-core's P.run() with one that fails *failures* times'''
+
+    def run(statement, **kwargs):
+        calls.append(kwargs)
+        if len(calls) <= failures:
+            raise RuntimeError("Job %i has exited with exit status 1"
+                               % len(calls))
+
+    cgatcore = types.ModuleType("cgatcore")
+    cgatcore.pipeline = types.ModuleType("cgatcore.pipeline")
+    cgatcore.pipeline.run = run
+
+    monkeypatch.setitem(sys.modules, "cgatcore", cgatcore)
+    monkeypatch.setitem(sys.modules, "cgatcore.pipeline", cgatcore.pipeline)
+
+
+def test_run(monkeypatch):
+    '''the statement is resubmitted with the escalated resources'''
+
+    calls = []
+    fake_run(monkeypatch, calls, failures=2)
+
+    canned(monkeypatch, SACCT_OOM)
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        t = make_task(tmp)
+        t.run("true", PARAMS, job_condaenv="x")
+
+    assert [x["job_memory"] for x in calls] == ["4G", "8G", "16G"]
+    assert calls[0]["job_condaenv"] == "x"
+
+    # without escalation the first failure is raised
+    calls.clear()
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        t = make_task(tmp)
+
+        with pytest.raises(RuntimeError):
+            t.run("true", {})
+
+    assert len(calls) == 1
+
+
+def predicted_task(infile, params):
+
+    return(setup(infile, infile + ".out.sentinel", params,
+                 memory="2G", cpu=1))
+
+
+def test_run_predicted(monkeypatch):
+    '''a job started with the predicted memory is resubmitted with more'''
+
+    monkeypatch.delenv("TXSEQ_HISTORY", raising=False)
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        history_file = os.path.join(tmp, "history.sqlite")
+
+        # five successful SGE jobs that used 1G per 1000 input bytes
+        # (the exit status is parsed from the log as a float)
+        records, jobs = recordColumns(), recordColumns()
+
+        for i in range(1, 6):
+            out_file = os.path.join(tmp, "s%i" % i)
+            records.add({"task": __name__ + ".predicted_task",
+                         "job_id": 100 + i,
+                         "statement": "run > " + out_file,
+                         "max_rss": i * 1E6, "exit_status": 0})
+            jobs.add({"task": __name__ + ".predicted_task",
+                      "out_file": out_file, "input_bytes": i * 1000})
+
+        history.record(records.to_frame(), jobs.to_frame(), "x", "sge",
+                       history_file=history_file, project=tmp)
+
+        infile = os.path.join(tmp, "input.txt")
+        with open(infile, "w") as outfile:
+            outfile.write("x" * 3000)
+
+        params = dict(PARAMS, cluster_queue_manager="sge",
+                      resources_predict=True,
+                      resources_history=history_file)
+
+        # 3G predicted, times the margin of 1.5
+        t = predicted_task(infile, params)
+        assert t.resources == {"job_memory": "5G", "job_threads": 1}
+
+        # the job runs out of memory once
+        calls = []
+        fake_run(monkeypatch, calls, failures=1)
+        canned(monkeypatch, qacct(exit_status="137", maxvmem="5G"))
+
+        t.run("true", params)
+
+    assert [x["job_memory"] for x in calls] == ["5G", "10G"]
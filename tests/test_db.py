@@ -0,0 +1,288 @@
+'''test_db - tests for loading tables to the database with tasks.db
+=================================================================
+
+Purpose
+-------
+
+Check that :class:`txseq.tasks.db.tableLoader` loads per-sample tables
+laid out as by cgat-core P.concatenate_and_load(), that the indexes are
+only created once all of the rows have been inserted, that the database
+is left in WAL mode, that in incremental mode only the rows of the
+samples that were added, changed or removed are replaced (as recorded
+in the manifest) and that python/db_concatenate_and_load.py (run by
+the pipelines as a job) writes the same table.
+
+'''
+import os
+import sys
+import time
+import sqlite3
+import subprocess
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import txseq.tasks.db as db
+
+
+def write_quant(path, rows, columns=("Name", "TPM", "NumReads")):
+    '''write a per-sample tab-separated table'''
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, "w") as outfile:
+        outfile.write("\t".join(columns) + "\n")
+        for row in rows:
+            outfile.write("\t".join([str(x) for x in row]) + "\n")
+
+    return(path)
+
+
+def write_samples(tmp):
+
+    return([write_quant(os.path.join(tmp, "salmon.dir", "s1", "quant.sf"),
+                        [("t1", 1.5, 10), ("t2", 0, 0)]),
+            write_quant(os.path.join(tmp, "salmon.dir", "s2", "quant.sf"),
+                        [("t1", 2.5, 20), ("t2", "na", 5)]),
+            write_quant(os.path.join(tmp, "salmon.dir", "s3", "quant.sf"),
+                        [("t1", 3.5)], columns=("Name", "TPM"))])
+
+
+def fetch(database, sql):
+
+    con = sqlite3.connect(database)
+
+    try:
+        return(con.execute(sql).fetchall())
+    finally:
+        con.close()
+
+
+def test_concatenate_and_load():
+    '''the files are loaded with the track column(s) first'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        database = os.path.join(tmp, "csvdb")
+        outfile = os.path.join(tmp, "salmon.transcripts.load")
+
+        loaded = db.concatenate_and_load(write_samples(tmp), outfile,
+                                         database,
+                                         regex_filename=".*/(.*)/quant.sf",
+                                         cat="sample_id",
+                                         indexes=["Name"])
+
+        assert loaded == {"salmon_transcripts": 5}
+
+        assert [x[1] for x in fetch(
+            database, "PRAGMA table_info(salmon_transcripts)")] == \
+            ["sample_id", "Name", "TPM", "NumReads"]
+
+        # missing values and columns are NULL
+        assert fetch(database, "SELECT * FROM salmon_transcripts "
+                               "ORDER BY sample_id, Name") == [
+            ("s1", "t1", 1.5, 10), ("s1", "t2", 0.0, 0),
+            ("s2", "t1", 2.5, 20), ("s2", "t2", None, 5),
+            ("s3", "t1", 3.5, None)]
+
+        with open(outfile) as infile:
+            assert infile.read().splitlines()[1:] == [
+                "table\trows", "salmon_transcripts\t5"]
+
+
+def test_no_titles():
+    '''files without a header line are loaded with the given names'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        database = os.path.join(tmp, "csvdb")
+
+        infiles = []
+        for track in ["a", "b"]:
+            infiles.append(os.path.join(tmp, track + ".counts"))
+            with open(infiles[-1], "w") as outfile:
+                outfile.write("g1\t1\ng2\t2\n")
+
+        db.concatenate_and_load(infiles, os.path.join(tmp, "counts.load"),
+                                database,
+                                regex_filename=".*/(.*).counts",
+                                has_titles=False,
+                                header="track,gene_id,counts")
+
+        assert fetch(database, "SELECT * FROM counts ORDER BY track") == [
+            ("a", "g1", 1), ("a", "g2", 2), ("b", "g1", 1), ("b", "g2", 2)]
+
+
+def test_deferred_indexes(monkeypatch):
+    '''the indexes are created after all of the rows are inserted'''
+
+    statements = []
+    connect = db.connect
+
+    def traced(database, **kwargs):
+        con = connect(database, **kwargs)
+        con.set_trace_callback(statements.append)
+        return(con)
+
+    monkeypatch.setattr(db, "connect", traced)
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        database = os.path.join(tmp, "csvdb")
+
+        db.concatenate_and_load(write_samples(tmp),
+                                os.path.join(tmp, "quant.load"), database,
+                                regex_filename=".*/(.*)/quant.sf",
+                                cat="sample_id",
+                                indexes=["Name", "not_a_column"])
+
+        indexes = fetch(database, "SELECT name, sql FROM sqlite_master "
+                                  "WHERE type='index' ORDER BY name")
+
+    assert [x[0] for x in indexes] == ["quant_index1", "quant_index2"]
+    assert "sample_id" in indexes[0][1] and "Name" in indexes[1][1]
+
+    inserts = [i for i, x in enumerate(statements)
+               if x.startswith('INSERT INTO "quant"')]
+    creates = [i for i, x in enumerate(statements)
+               if x.startswith("CREATE INDEX")]
+
+    assert len(inserts) > 0 and len(creates) == 2
+    assert min(creates) > max(inserts)
+
+
+def test_wal_mode():
+    '''the database is left in WAL mode'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        database = os.path.join(tmp, "csvdb")
+
+        db.concatenate_and_load(write_samples(tmp),
+                                os.path.join(tmp, "quant.load"), database,
+                                regex_filename=".*/(.*)/quant.sf",
+                                cat="sample_id")
+
+        assert fetch(database, "PRAGMA journal_mode") == [("wal",)]
+
+
+def test_rollback():
+    '''a failed load leaves the existing tables unchanged'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        database = os.path.join(tmp, "csvdb")
+        infiles = write_samples(tmp)
+
+        db.concatenate_and_load(infiles[:1], os.path.join(tmp, "quant.load"),
+                                database,
+                                regex_filename=".*/(.*)/quant.sf",
+                                cat="sample_id")
+
+        loader = db.tableLoader(database)
+        loader.add("quant", infiles, regex_filename=".*/(.*)/quant.sf",
+                   cat="sample_id")
+        loader.add("other", infiles, regex_filename="no_match",
+                   cat="sample_id")
+
+        with pytest.raises(ValueError):
+            loader.load()
+
+        assert fetch(database, "SELECT COUNT(*) FROM quant") == [(2,)]
+
+
+def test_load_script():
+    '''python/db_concatenate_and_load.py loads the same table'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        infiles = write_samples(tmp)
+
+        expected = os.path.join(tmp, "expected.db")
+        db.concatenate_and_load(infiles, os.path.join(tmp, "quant.load"),
+                                expected,
+                                regex_filename=".*/(.*)/quant.sf",
+                                cat="sample_id", indexes=["Name"])
+
+        database = os.path.join(tmp, "csvdb")
+        outfile = os.path.join(tmp, "salmon.dir", "quant.load")
+
+        subprocess.run([sys.executable,
+                        os.path.join(ROOT, "python",
+                                     "db_concatenate_and_load.py"),
+                        "--database=" + database,
+                        "--outfile=" + outfile,
+                        "--regex-filename=.*/(.*)/quant.sf",
+                        "--cat=sample_id",
+                        "--index=Name"] + infiles,
+                       check=True, capture_output=True,
+                       env=dict(os.environ, PYTHONPATH=ROOT))
+
+        sql = "SELECT * FROM quant ORDER BY sample_id, Name"
+
+        assert fetch(database, sql) == fetch(expected, sql)
+        assert os.path.exists(outfile)
+
+
+def incremental_load(database, infiles):
+
+    loader = db.tableLoader(database, incremental=True)
+    loader.add("quant", infiles, regex_filename=".*/(.*)/quant.sf",
+               cat="sample_id", indexes=["Name"])
+
+    return(loader.load(), loader.updated["quant"])
+
+
+def test_incremental():
+    '''only the rows of the new, changed or removed samples are replaced'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        database = os.path.join(tmp, "csvdb")
+        infiles = write_samples(tmp)
+
+        # the first load creates the table
+        assert incremental_load(database, infiles[:2]) == \
+            ({"quant": 4}, None)
+
+        sql = "SELECT rowid, * FROM quant WHERE sample_id='%s' ORDER BY Name"
+        s1_rows = fetch(database, sql % "s1")
+
+        # s2 is changed and s3 is added
+        write_quant(infiles[1], [("t1", 9.5, 90), ("t3", 1.0, 1)])
+        stat = os.stat(infiles[1])
+        os.utime(infiles[1], (stat.st_atime, stat.st_mtime + 10))
+
+        since = time.time()
+
+        assert incremental_load(database, infiles) == \
+            ({"quant": 3}, ["s2", "s3"])
+
+        # the unchanged rows (and their rowids) are kept
+        assert fetch(database, sql % "s1") == s1_rows
+
+        assert fetch(database, "SELECT sample_id, Name, TPM FROM quant "
+                               "WHERE sample_id != 's1' "
+                               "ORDER BY sample_id, Name") == [
+            ("s2", "t1", 9.5), ("s2", "t3", 1.0), ("s3", "t1", 3.5)]
+
+        assert db.updated_tracks(database, "quant", since) == \
+            (["s2", "s3"], ["s1", "s2", "s3"])
+
+        # nothing has changed
+        assert incremental_load(database, infiles) == ({"quant": 0}, [])
+
+        # s1 is removed
+        since = time.time()
+
+        assert incremental_load(database, infiles[1:]) == \
+            ({"quant": 0}, ["s1"])
+
+        assert fetch(database, "SELECT DISTINCT sample_id FROM quant "
+                               "ORDER BY sample_id") == [("s2",), ("s3",)]
+
+        assert db.updated_tracks(database, "quant", since) == \
+            ([], ["s2", "s3"])
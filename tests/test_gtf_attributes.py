@@ -0,0 +1,164 @@
+'''test_gtf_attributes - regression tests for the single pass GTF sinks
+=======================================================================
+
+Purpose
+-------
+
+Check that :func:`txseq.tasks.gtf.stream_gtf` with the
+:class:`~txseq.tasks.gtf.attributeTableWriter` and
+:class:`~txseq.tasks.gtf.gtfWriter` sinks gives the same outputs as the
+original (per-record) implementations of the transcript attribute
+table and of the filtered GTF file (formerly
+python/ensembl_extract_gtf_attributes.py and python/ensembl_filter_gtf.py),
+which are reproduced below as references.
+
+'''
+import os
+import sys
+import copy
+import gzip
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import txseq.tasks.gtf as gtf
+from txseq.tasks.intervals import intervals
+
+ATTRIBUTES = ["transcript_id", "transcript_name", "transcript_biotype",
+              "gene_id", "gene_name", "gene_biotype", "tag"]
+
+GTF = '''#!genome-build GRCm39
+#!genome-version GRCm39
+1\tensembl\tgene\t3143476\t3144545\t.\t+\t.\tgene_id "ENSMUSG00000102693"; gene_version "2"; gene_name "4933401J01Rik"; gene_source "havana"; gene_biotype "TEC";
+1\thavana\ttranscript\t3143476\t3144545\t.\t+\t.\tgene_id "ENSMUSG00000102693"; gene_version "2"; transcript_id "ENSMUST00000193812"; transcript_version "2"; gene_name "4933401J01Rik"; gene_source "havana"; gene_biotype "TEC"; transcript_name "4933401J01Rik-201"; transcript_source "havana"; transcript_biotype "TEC"; tag "basic"; tag "Ensembl_canonical";
+1\thavana\texon\t3143476\t3144545\t.\t+\t.\tgene_id "ENSMUSG00000102693"; gene_version "2"; transcript_id "ENSMUST00000193812"; transcript_version "2"; exon_number "1"; gene_name "4933401J01Rik"; transcript_name "4933401J01Rik-201";
+1\tensembl\ttranscript\t3172239\t3172348\t.\t+\t.\tgene_id "ENSMUSG00000064842"; gene_version "3"; transcript_id "ENSMUST00000082908"; transcript_version "3"; gene_source "ensembl"; gene_biotype "snRNA"; transcript_source "ensembl"; transcript_biotype "snRNA";
+MT\tinsdc\ttranscript\t2751\t3707\t.\t+\t.\tgene_id "ENSMUSG00000064341"; transcript_id "ENSMUST00000082392"; gene_name "mt-Nd1"; gene_biotype "protein_coding"; transcript_name "mt-Nd1-201"; transcript_biotype "protein_coding"; tag "basic";
+X\thavana\ttranscript\t100\t200\t.\t-\t.\tgene_id "ENSMUSG00000000001"; transcript_id "ENSMUST00000000001"; gene_name "Gene with spaces"; transcript_biotype "lncRNA";
+'''
+
+
+def reference(gtf, take):
+    '''the original implementation of the transcript attribute table'''
+
+    attrs_template = {}
+    for fname in take:
+        attrs_template[fname] = 'NA'
+
+    out_lines = ["\t".join(take) + '\n']
+
+    for record in gzip.open(gtf, "rt"):
+
+        if record.startswith("#"):
+            continue
+
+        fields = record.split("\t")
+
+        if fields[2] != "transcript":
+            continue
+
+        attrs = copy.deepcopy(attrs_template)
+
+        gtfattrs = [x.strip() for x in fields[8].replace("; ", ";").split(";")]
+        for gtfattr in gtfattrs:
+            if gtfattr != "":
+                attr_bits = gtfattr.strip().split(" ", 1)
+                key, value = [x.strip("\'\"") for x in attr_bits]
+                attrs[key] = value
+
+        out = [attrs[x] for x in take]
+        out_lines.append("\t".join(out) + "\n")
+
+    return "".join(out_lines)
+
+
+def reference_filter(gtf_file, contigs, masks):
+    '''the original implementation of the GTF contig and mask filter'''
+
+    out_lines = []
+
+    for record in gzip.open(gtf_file, "rt"):
+
+        if record.startswith("#"):
+            continue
+
+        fields = record.split("\t")
+
+        if fields[0] not in contigs:
+            continue
+
+        start, end = int(fields[3]), int(fields[4])
+
+        masked = False
+        for contig, mask_start, mask_end in masks:
+            if contig == fields[0] and mask_start < start and \
+               end < mask_end:
+                masked = True
+
+        if not masked:
+            out_lines.append(record)
+
+    return "".join(out_lines)
+
+
+def write_gtf(tmp):
+
+    path = os.path.join(tmp, "geneset.gtf.gz")
+
+    with gzip.open(path, "wt") as gtf_file:
+        gtf_file.write(GTF)
+
+    return(path)
+
+
+def read(path):
+
+    with gzip.open(path, "rt") as infile:
+        return(infile.read())
+
+
+def test_extract_gtf_attributes():
+    '''the attribute table matches the reference implementation'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        gtf_file = write_gtf(tmp)
+        outfile = os.path.join(tmp, "transcript.info.tsv.gz")
+
+        gtf.stream_gtf(gtf_file,
+                       [gtf.attributeTableWriter(outfile, ATTRIBUTES)])
+
+        assert read(outfile) == reference(gtf_file, ATTRIBUTES)
+
+
+def test_filter_gtf():
+    '''the filtered GTF matches the reference implementation'''
+
+    contigs = set(["1", "X"])
+    mask_regions = [("1", 3172000, 3173000), ("X", 150, 1000)]
+
+    masks = intervals()
+    for region in mask_regions:
+        masks.add(*region)
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        gtf_file = write_gtf(tmp)
+        filtered = os.path.join(tmp, "filtered.gtf.gz")
+        attributes = os.path.join(tmp, "transcript.info.tsv.gz")
+
+        # the attribute table is not filtered
+        summary = gtf.stream_gtf(
+            gtf_file,
+            [gtf.gtfWriter(filtered),
+             gtf.attributeTableWriter(attributes, ATTRIBUTES)],
+            contigs=contigs, masks=masks)
+
+        assert read(filtered) == reference_filter(gtf_file, contigs,
+                                                  mask_regions)
+        assert read(attributes) == reference(gtf_file, ATTRIBUTES)
+
+    assert summary["skipped_contigs"] == {"MT": 1}
+    assert summary["n_masked"] == 1
+    assert summary["masked_genes"] == {"1": {"ENSMUSG00000064842": None}}
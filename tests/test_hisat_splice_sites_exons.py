@@ -0,0 +1,130 @@
+'''test_hisat_splice_sites_exons - regression test for hisat_extract_splice_sites_exons.py
+==========================================================================================
+
+Purpose
+-------
+
+Check that python/hisat_extract_splice_sites_exons.py gives the same
+outputs as the hisat2_extract_exons.py and hisat2_extract_splice_sites.py
+scripts distributed with HISAT2, whose logic is reproduced below as a
+reference.
+
+'''
+import os
+import sys
+import gzip
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = os.path.join(ROOT, "python", "hisat_extract_splice_sites_exons.py")
+
+GTF = '''#!genome-build GRCm39
+1\thavana\tgene\t100\t2000\t.\t+\t.\tgene_id "G1"; gene_name "A";
+1\thavana\ttranscript\t100\t2000\t.\t+\t.\tgene_id "G1"; transcript_id "T1";
+1\thavana\texon\t1500\t2000\t.\t+\t.\tgene_id "G1"; transcript_id "T1"; exon_number "3";
+1\thavana\texon\t100\t200\t.\t+\t.\tgene_id "G1"; transcript_id "T1"; exon_number "1";
+1\thavana\texon\t204\t400\t.\t+\t.\tgene_id "G1"; transcript_id "T1"; exon_number "2";
+1\thavana\texon\t100\t200\t.\t+\t.\tgene_id "G1"; transcript_id "T2";
+1\thavana\texon\t1500\t1800\t.\t+\t.\tgene_id "G1"; transcript_id "T2";
+10\thavana\texon\t50\t80\t.\t-\t.\tgene_id "G2"; transcript_id "T3";
+10\thavana\texon\t10\t20\t.\t-\t.\tgene_id "G2"; transcript_id "T3";
+10\thavana\texon\t30\t30\t.\t-\t.\tgene_id "G2"; transcript_id "T3";
+2\thavana\texon\t10\t20\t.\t+\t.\ttranscript_id "T4";
+'''
+
+
+def reference_transcripts(gtf):
+    '''the GTF parsing of the hisat2 scripts'''
+
+    trans = {}
+
+    for line in gzip.open(gtf, "rt"):
+
+        if not line.strip() or line.startswith("#"):
+            continue
+
+        chrom, source, feature, left, right, score, \
+            strand, frame, values = line.split("\t")
+        left, right = int(left) - 1, int(right) - 1
+
+        if feature != "exon" or left >= right:
+            continue
+
+        values_dict = {}
+        for attr in values.split(";"):
+            if attr.strip():
+                attr, _, val = attr.strip().partition(" ")
+                values_dict[attr] = val.strip('"')
+
+        if "gene_id" not in values_dict or \
+           "transcript_id" not in values_dict:
+            continue
+
+        transcript_id = values_dict["transcript_id"]
+        if transcript_id not in trans:
+            trans[transcript_id] = [chrom, strand, [[left, right]]]
+        else:
+            trans[transcript_id][2].append([left, right])
+
+    for tran, [chrom, strand, exons] in trans.items():
+        exons.sort()
+        tmp_exons = [exons[0]]
+        for i in range(1, len(exons)):
+            if exons[i][0] - tmp_exons[-1][1] <= 5:
+                tmp_exons[-1][1] = exons[i][1]
+            else:
+                tmp_exons.append(exons[i])
+        trans[tran] = [chrom, strand, tmp_exons]
+
+    return(trans)
+
+
+def reference(gtf):
+    '''the hisat2_extract_exons.py and hisat2_extract_splice_sites.py
+    outputs'''
+
+    trans = reference_transcripts(gtf)
+
+    exons = set()
+    junctions = set()
+    for chrom, strand, texons in trans.values():
+        for i in range(len(texons)):
+            exons.add((chrom, texons[i][0], texons[i][1], strand))
+        for i in range(1, len(texons)):
+            junctions.add((chrom, texons[i - 1][1], texons[i][0], strand))
+
+    return(["".join(["{}\t{}\t{}\t{}\n".format(*x) for x in sorted(rows)])
+            for rows in [exons, junctions]])
+
+
+def test_extract_splice_sites_exons():
+    '''the script outputs match the reference implementation'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        gtf = os.path.join(tmp, "geneset.gtf.gz")
+        exons = os.path.join(tmp, "genome.exon")
+        ss = os.path.join(tmp, "genome.ss")
+
+        with gzip.open(gtf, "wt") as gtf_file:
+            gtf_file.write(GTF)
+
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [ROOT] + [x for x in [env.get("PYTHONPATH")] if x])
+
+        subprocess.check_call([sys.executable, SCRIPT,
+                               "--gtf=" + gtf,
+                               "--exons=" + exons,
+                               "--splicesites=" + ss],
+                              env=env,
+                              stdout=subprocess.DEVNULL)
+
+        results = []
+        for path in [exons, ss]:
+            with open(path, "r") as out_file:
+                results.append(out_file.read())
+
+        assert results == reference(gtf)
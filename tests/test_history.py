@@ -0,0 +1,176 @@
+'''test_history - tests for the job resource history in tasks.history
+===================================================================
+
+Purpose
+-------
+
+Check that :func:`txseq.tasks.history.record` adds the job records
+parsed by :mod:`txseq.tasks.profile` to the history only once, that the
+jobs are matched to the task setup information by the output file in
+their statement, and that the memory used by the successful SLURM and
+SGE jobs is used to predict the memory of new jobs.
+
+'''
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import txseq.tasks.history as history
+from txseq.tasks.profile import recordColumns
+
+TASK = "pipeline_salmon.quant"
+
+
+def frame(rows):
+    '''return the rows as a data frame, as parsed from the log'''
+
+    columns = recordColumns()
+
+    for row in rows:
+        columns.add(row)
+
+    return(columns.to_frame())
+
+
+def sge_jobs(n, exit_status=0):
+    '''return the records and setup information of *n* SGE jobs'''
+
+    records, jobs = [], []
+
+    for i in range(1, n + 1):
+        out_file = "salmon.dir/s%i/quant.sf" % i
+
+        records.append({"task": TASK, "job_id": 100 + i,
+                        "statement": "salmon quant -o " + out_file,
+                        "max_rss": i * 1E6, "wall_t": 10,
+                        "exit_status": exit_status})
+
+        jobs.append({"task": TASK, "out_file": out_file,
+                     "sample": "s%i" % i, "input_bytes": i * 1000,
+                     "job_memory": "4G", "job_threads": 2})
+
+    return(frame(records), frame(jobs))
+
+
+def slurm_jobs(exit_codes):
+    '''return the records and setup information of SLURM jobs'''
+
+    records, jobs = [], []
+
+    for i, exit_code in enumerate(exit_codes, 1):
+        out_file = "salmon.dir/s%i/quant.sf" % i
+
+        records.append({"task": TASK, "job_id": "%i" % (200 + i),
+                        "statement": "salmon quant -o " + out_file,
+                        "MaxRSS": i * 1E9, "wall_t": 10,
+                        "ExitCode": exit_code})
+
+        jobs.append({"task": TASK, "out_file": out_file,
+                     "sample": "s%i" % i, "input_bytes": i * 1000})
+
+    return(frame(records), frame(jobs))
+
+
+def test_record_once():
+    '''profiling the same log twice does not duplicate the jobs'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        history_file = os.path.join(tmp, "history.sqlite")
+
+        records, jobs = sge_jobs(3)
+
+        assert history.record(records, jobs, "salmon", "sge",
+                              history_file=history_file, project=tmp) == 3
+
+        # the same jobs (and one new job)
+        records, jobs = sge_jobs(4)
+
+        assert history.record(records, jobs, "salmon", "sge",
+                              history_file=history_file, project=tmp) == 1
+
+        # the same jobs in another project are new
+        assert history.record(records, jobs, "salmon", "sge",
+                              history_file=history_file,
+                              project=os.path.join(tmp, "other")) == 4
+
+        assert len(history.query(history_file=history_file)) == 8
+        assert len(history.query(pipeline="salmon", sample="s4",
+                                 history_file=history_file)) == 2
+
+
+def test_match_jobs():
+    '''jobs are matched by the output file in their statement'''
+
+    records = frame([
+        {"task": "a", "statement": "run -o out/s1.txt"},
+        {"task": "a", "statement": "run -o out/s10.txt"},
+        {"task": "a", "statement": "run -o out/s1.txt.gz"},
+        {"task": "b", "statement": "run -o out/s1.txt"},
+        {"task": "a", "statement": "run -o elsewhere"}])
+
+    jobs = frame([
+        {"task": "a", "out_file": "out/s1.txt", "sample": "s1"},
+        {"task": "a", "out_file": "out/s10.txt", "sample": "s10"},
+        {"task": "a", "out_file": "out/s1.txt.gz", "sample": "s1_gz"},
+        {"task": "a", "out_file": None, "sample": "none"}])
+
+    matched = history.match_jobs(records, jobs)
+
+    assert matched["sample"].fillna("").tolist() == \
+        ["s1", "s10", "s1_gz", "", ""]
+
+    # the records are not changed
+    assert "sample" not in records.columns
+
+
+def test_slurm_exit_status():
+    '''only the successful SLURM jobs are used for the model'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        history_file = os.path.join(tmp, "history.sqlite")
+
+        # the failed job used the most memory
+        records, jobs = slurm_jobs(["0:0"] * 5 + ["0:9"])
+
+        history.record(records, jobs, "salmon", "slurm",
+                       history_file=history_file, project=tmp)
+
+        slope, intercept, n = history.memory_model(TASK, history_file)
+
+        assert n == 5
+        assert abs(slope * 5000 + intercept - 5) < 1e-6
+
+        assert history.predict_memory(TASK, 1000, min_jobs=6,
+                                      history_file=history_file) is None
+
+
+def test_sge_exit_status():
+    '''successful SGE jobs are used to predict the memory'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        history_file = os.path.join(tmp, "history.sqlite")
+
+        records, jobs = sge_jobs(5)
+
+        # the numeric exit status is parsed as a float
+        assert records["exit_status"].dtype == "float64"
+
+        assert history.record(records, jobs, "salmon", "sge",
+                              history_file=history_file,
+                              project=tmp) == 5
+
+        df = history.query(task="quant", history_file=history_file)
+        assert df["exit_status"].tolist() == ["0"] * 5
+        assert df["job_id"].tolist() == [str(100 + i) for i in range(1, 6)]
+
+        predicted = history.predict_memory(TASK, 6000,
+                                           history_file=history_file)
+
+        assert predicted is not None
+        assert abs(predicted - 6 * 1.5) < 1e-6
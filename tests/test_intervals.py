@@ -0,0 +1,118 @@
+'''test_intervals - tests for the masked region index in tasks.intervals
+=====================================================================
+
+Purpose
+-------
+
+Check that :meth:`txseq.tasks.intervals.intervals.contains` gives the
+same answers as the previous linear sweep over the masked regions of
+python/ensembl_filter_transcript_fasta.py for overlapping, nested and
+touching masks (where the region boundaries are excluded).
+
+'''
+import os
+import sys
+import random
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from txseq.tasks.intervals import intervals
+
+MASKS = {"overlapping": [(10, 30), (20, 40), (35, 50)],
+         "nested": [(10, 60), (20, 30), (25, 28), (40, 50)],
+         "touching": [(10, 20), (20, 30), (30, 40)],
+         # an earlier long interval covers the later short ones
+         "spanning": [(0, 100), (5, 10), (50, 55), (90, 95)]}
+
+
+def linear_sweep(masks, contig, start, end):
+    '''the previous masking test'''
+
+    x, y = min(start, end), max(start, end)
+
+    for masked_region in masks.get(contig, []):
+        if x > masked_region[0] and y < masked_region[1]:
+            return(True)
+
+    return(False)
+
+
+def make_index(masks):
+
+    index = intervals()
+
+    for contig, regions in masks.items():
+        for start, end in regions:
+            index.add(contig, start, end)
+
+    return(index)
+
+
+def test_contains():
+    '''every region on a grid is masked as by the linear sweep'''
+
+    index = make_index(MASKS)
+
+    for contig in list(MASKS) + ["other"]:
+        for start in range(0, 105):
+            for end in range(start, 105):
+                assert index.contains(contig, start, end) == \
+                    linear_sweep(MASKS, contig, start, end), \
+                    (contig, start, end)
+
+    # regions that span touching masks are not masked
+    assert not index.contains("touching", 15, 25)
+    assert index.contains("touching", 21, 29)
+
+
+def test_random_masks():
+    '''random masks (added in any order) match the linear sweep'''
+
+    rng = random.Random(1)
+
+    masks = {}
+    for i in range(200):
+        start = rng.randrange(0, 1000)
+        end = start + rng.randrange(0, 100)
+        # the start and end may be given in either order
+        masks.setdefault("chr1", []).append(
+            (start, end) if rng.random() < 0.5 else (end, start))
+
+    index = make_index(masks)
+    sorted_masks = {"chr1": [(min(x), max(x)) for x in masks["chr1"]]}
+
+    for i in range(5000):
+        start = rng.randrange(0, 1100)
+        end = start + rng.randrange(0, 50)
+
+        assert index.contains("chr1", start, end) == \
+            linear_sweep(sorted_masks, "chr1", start, end)
+
+    # intervals added after a query are used
+    index.add("chr1", 2000, 3000)
+    assert index.contains("chr1", 2500, 2600)
+
+
+def test_from_bed():
+    '''the masks are read from the first three columns of a BED file'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        bed_file = os.path.join(tmp, "masks.bed")
+
+        with open(bed_file, "w") as outfile:
+            outfile.write("track name=masks\n"
+                          "# a comment\n"
+                          "chrY\t10000\t2781479\tPAR1\n"
+                          "\n"
+                          "chrY\t56887902\t57217415\tPAR2\n")
+
+        index = intervals.from_bed(bed_file)
+
+    assert len(index) == 2
+    assert index.contigs() == ["chrY"]
+    assert index.contains("chrY", 20000, 30000)
+    assert not index.contains("chrY", 10000, 30000)
+    assert not index.contains("chrX", 20000, 30000)
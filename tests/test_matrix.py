@@ -0,0 +1,177 @@
+'''test_matrix - tests for building wide matrices with tasks.matrix
+=================================================================
+
+Purpose
+-------
+
+Check that the wide (feature x sample) tables built by
+:func:`txseq.tasks.matrix.sql_to_wide` (in one pass and in chunked
+mode) and updated by :func:`txseq.tasks.matrix.update_wide` are the
+same as those built by the previous per-sample pivot loop of
+python/salmon_fetch_tpms.py, including the cells of the features that
+are missing from some of the samples, and that an update only fetches
+the columns of the samples that were added or changed (in batches that
+stay within the sqlite limit on query parameters).
+
+'''
+import os
+import sys
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from txseq.tasks.matrix import sql_to_wide, update_wide
+
+SQL = "select sample_id, Name transcript_id, TPM tpm from quant"
+
+# s2 does not have t3, t4 is only found in s3
+ROWS = {"s1": [("t1", 1.5), ("t2", 0.0), ("t3", 2.0)],
+        "s2": [("t2", 4.0), ("t1", 2.5)],
+        "s3": [("t4", 7.0), ("t1", 3.5), ("t3", 1.0)]}
+
+
+def make_database(samples, rows=ROWS):
+    '''return an in memory database with the long table of *samples*'''
+
+    con = sqlite3.connect(":memory:")
+    con.execute("CREATE TABLE quant (sample_id TEXT, Name TEXT, TPM REAL)")
+    add_samples(con, samples, rows)
+
+    return(con)
+
+
+def add_samples(con, samples, rows=ROWS):
+
+    con.executemany("INSERT INTO quant VALUES (?, ?, ?)",
+                    [(s, name, tpm) for s in samples for name, tpm in rows[s]])
+
+
+def per_sample_loop(con):
+    '''the previous pivot of python/salmon_fetch_tpms.py'''
+
+    df = pd.read_sql(SQL, con)
+
+    out_df = pd.DataFrame(index=[x for x in df["transcript_id"].unique()])
+
+    for sample in [x for x in df["sample_id"].unique()]:
+
+        sample_df = df[df["sample_id"] == sample].copy()
+        sample_df.index = sample_df["transcript_id"]
+
+        out_df[sample] = np.nan
+        out_df.loc[sample_df.index, sample] = sample_df["tpm"]
+
+    return(out_df)
+
+
+def check(df, expected):
+
+    pd.testing.assert_frame_equal(df, expected, check_index_type=False,
+                                  check_column_type=False, check_names=False)
+
+
+def test_sql_to_wide():
+    '''the scatter pivot matches the per-sample loop'''
+
+    con = make_database(["s1", "s2", "s3"])
+
+    expected = per_sample_loop(con)
+
+    assert np.isnan(expected.loc["t3", "s2"])
+    assert np.isnan(expected.loc["t4", "s1"])
+
+    df = sql_to_wide(SQL, con, index="transcript_id", columns="sample_id",
+                     values="tpm")
+    check(df, expected)
+
+    # chunks that split the samples
+    for chunksize in (1, 2, 4, 100):
+        df = sql_to_wide(SQL, con, index="transcript_id",
+                         columns="sample_id", values="tpm",
+                         chunksize=chunksize)
+        check(df, expected)
+
+
+def test_update_wide():
+    '''the updated table matches the per-sample loop'''
+
+    con = make_database(["s1", "s2"])
+
+    df = sql_to_wide(SQL, con, index="transcript_id", columns="sample_id",
+                     values="tpm")
+
+    # a sample is added (with a new feature)
+    add_samples(con, ["s3"])
+
+    for chunksize in (None, 2):
+        updated = update_wide(df, SQL, con, index="transcript_id",
+                              columns="sample_id", values="tpm",
+                              updated=["s3"], tracks=["s1", "s2", "s3"],
+                              chunksize=chunksize)
+
+        check(updated, per_sample_loop(con))
+
+    # nothing has changed
+    check(update_wide(df, SQL, con, index="transcript_id",
+                      columns="sample_id", values="tpm",
+                      updated=[], tracks=["s1", "s2"]), df)
+
+
+def test_update_changed():
+    '''only the columns of the updated samples are replaced'''
+
+    con = make_database(["s1", "s2", "s3"])
+
+    df = sql_to_wide(SQL, con, index="transcript_id", columns="sample_id",
+                     values="tpm")
+
+    # s2 is reloaded with new values, s1 is removed and the s3 rows are
+    # changed in the database without s3 being marked as updated
+    con.execute("DELETE FROM quant WHERE sample_id IN ('s1', 's2')")
+    con.execute("UPDATE quant SET TPM=-1 WHERE sample_id='s3'")
+    add_samples(con, ["s2"], {"s2": [("t2", 5.0), ("t5", 6.0)]})
+
+    updated = update_wide(df, SQL, con, index="transcript_id",
+                          columns="sample_id", values="tpm",
+                          updated=["s2"], tracks=["s2", "s3"])
+
+    assert list(updated.columns) == ["s3", "s2"]
+    assert list(updated.index) == ["t1", "t2", "t3", "t4", "t5"]
+
+    # the s3 column was not fetched again
+    check(updated[["s3"]], df[["s3"]].reindex(updated.index))
+
+    assert updated["s2"].fillna(-2).tolist() == [-2, 5.0, -2, -2, 6.0]
+
+
+def test_update_batches():
+    '''the updated samples are fetched in batches of query parameters'''
+
+    samples = ["s%i" % i for i in range(1, 8)]
+    rows = {x: [("t1", float(i)), ("t%i" % (i + 2), 1.0)]
+            for i, x in enumerate(samples)}
+
+    con = make_database(samples[:2], rows)
+
+    df = sql_to_wide(SQL, con, index="transcript_id", columns="sample_id",
+                     values="tpm")
+
+    add_samples(con, samples[2:], rows)
+
+    statements = []
+    con.set_trace_callback(statements.append)
+
+    updated = update_wide(df, SQL, con, index="transcript_id",
+                          columns="sample_id", values="tpm",
+                          updated=samples[2:], tracks=samples,
+                          max_variables=2)
+
+    con.set_trace_callback(None)
+
+    assert len([x for x in statements if " IN (" in x]) == 3
+
+    check(updated, per_sample_loop(con))
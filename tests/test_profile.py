@@ -0,0 +1,158 @@
+'''test_profile - tests for parsing the pipeline log in tasks.profile
+===================================================================
+
+Purpose
+-------
+
+Check that :func:`txseq.tasks.profile.parse_logs` reads the job records
+from a synthetic pipeline.log together with its rotated (and gzipped)
+copies, oldest first, that partially written lines are left for the
+next run, and that with a state file only the lines added since the
+last run are parsed, without counting the records of a rotated log
+twice.
+
+'''
+import os
+import sys
+import gzip
+import json
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import txseq.tasks.profile as profile
+
+PREFIX = "2024-01-01 12:00:00,000 INFO main task - "
+
+
+def record(task, wall_t):
+    '''a cgat-core job record line'''
+
+    return(PREFIX + json.dumps({"task": task, "statement": "run " + task,
+                                "wall_t": wall_t}) + "\n")
+
+
+def job(task, sample):
+    '''a txseq.tasks.setup job line'''
+
+    return(PREFIX + profile.JOB_TAG +
+           json.dumps({"task": task, "sample": sample}) + "\n")
+
+
+def write(path, text, mode="w"):
+
+    if path.endswith(".gz"):
+        with gzip.open(path, mode + "t") as outfile:
+            outfile.write(text)
+    else:
+        with open(path, mode) as outfile:
+            outfile.write(text)
+
+
+def test_read_log():
+    '''the records are parsed and partial lines are not read'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        log = os.path.join(tmp, "pipeline.log")
+
+        # an older (python dict) record and a partially written line
+        complete = (record("a", 1) + "a line without a job\n" +
+                    job("a", "s1") +
+                    PREFIX + '{"task": "b", "statement": "run b", '
+                    '"done": True, "wall_t": 2}\n')
+        write(log, complete + record("c", 3)[:-10])
+
+        records, jobs = profile.recordColumns(), profile.recordColumns()
+
+        offset = profile.read_log(log, records, jobs=jobs)
+
+        assert offset == len(complete.encode())
+
+        df = records.to_frame()
+        assert df["task"].tolist() == ["a", "b"]
+        assert df["wall_t"].tolist() == [1, 2]
+        assert df["done"].tolist() == [None, True]
+
+        assert jobs.to_frame()["sample"].tolist() == ["s1"]
+
+        # the rest of the line is read from the offset
+        write(log, record("c", 3)[-10:] + record("d", 4), mode="a")
+
+        profile.read_log(log, records, offset=offset)
+
+        assert records.to_frame()["task"].tolist() == ["a", "b", "c", "d"]
+
+
+def test_rotated_logs():
+    '''the rotated and gzipped logs are read oldest first'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        log = os.path.join(tmp, "pipeline.log")
+
+        write(log + ".2.gz", record("a", 1))
+        write(log + ".1", record("b", 2))
+        write(log, record("c", 3) + job("c", "s1"))
+        write(log + ".x", record("x", 0))
+
+        assert profile.log_files(log) == [log + ".2.gz", log + ".1", log]
+
+        df, jobs = profile.parse_logs(log, jobs=True)
+
+        assert df["task"].tolist() == ["a", "b", "c"]
+        assert df["wall_t"].dtype == "float64"
+        assert jobs["task"].tolist() == ["c"]
+
+
+def test_incremental(monkeypatch):
+    '''only the lines added since the last run are parsed'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        log = os.path.join(tmp, "pipeline.log")
+        state_file = log + ".profile.state"
+
+        write(log, record("a", 1) + record("b", 2)[:-5])
+
+        df = profile.parse_logs(log, state_file=state_file)
+        assert df["task"].tolist() == ["a"]
+
+        # the partial line is completed and a line is added
+        write(log, record("b", 2)[-5:] + record("c", 3), mode="a")
+
+        offsets = []
+        read_log = profile.read_log
+
+        def tracked(path, records, offset=0, jobs=None):
+            offsets.append((os.path.basename(path), offset))
+            return(read_log(path, records, offset, jobs=jobs))
+
+        monkeypatch.setattr(profile, "read_log", tracked)
+
+        df = profile.parse_logs(log, state_file=state_file)
+        assert df["task"].tolist() == ["a", "b", "c"]
+        assert offsets == [("pipeline.log", len(record("a", 1)))]
+
+        # an unchanged log is not read
+        offsets.clear()
+        df = profile.parse_logs(log, state_file=state_file)
+        assert df["task"].tolist() == ["a", "b", "c"]
+        assert offsets == []
+
+        # the log is rotated, compressed and a new log started
+        with open(log, "rb") as infile:
+            write(log + ".1.gz", infile.read().decode())
+        os.unlink(log)
+        write(log, record("d", 4))
+
+        offsets.clear()
+        df = profile.parse_logs(log, state_file=state_file)
+
+        assert df["task"].tolist() == ["a", "b", "c", "d"]
+        assert offsets == [("pipeline.log.1.gz", 0), ("pipeline.log", 0)]
+
+        # the same records are parsed without the state file
+        assert profile.parse_logs(log)["task"].tolist() == \
+            ["a", "b", "c", "d"]
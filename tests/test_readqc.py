@@ -0,0 +1,181 @@
+'''test_readqc - tests for reading FastQC results in tasks.readqc
+===============================================================
+
+Purpose
+-------
+
+Check that the FastQC results read from the zip archives (without
+extracting them) match those read from the extracted fastqc_data.txt
+files, that the results of a track are found in "<datadir>/<track>/"
+(and not in the folders of tracks that share its prefix), that the
+sections are parsed as before and that the sections saved by
+:func:`parse_fastqc` are shared rather than parsed again.
+
+'''
+import os
+import sys
+import zipfile
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import txseq.tasks.readqc as readqc
+
+FASTQC_DATA = """##FastQC\t0.11.9
+>>Basic Statistics\tpass
+#Measure\tValue
+Filename\tx_1.fastq.gz
+Total Sequences\t100
+>>END_MODULE
+>>Per sequence quality scores\twarn
+#Quality\tCount
+30\t40.0
+31\t60.0
+>>END_MODULE
+"""
+
+
+def write_results(seq_dir, name):
+    '''write a FastQC zip archive and the extracted fastqc_data.txt'''
+
+    extracted = os.path.join(seq_dir, name + "_fastqc")
+    os.makedirs(extracted)
+
+    with open(os.path.join(extracted, "fastqc_data.txt"), "w") as outf:
+        outf.write(FASTQC_DATA)
+
+    archive = os.path.join(seq_dir, name + "_fastqc.zip")
+
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr(name + "_fastqc/fastqc_report.html", "<html></html>")
+        zf.writestr(name + "_fastqc/fastqc_data.txt", FASTQC_DATA)
+
+    return(archive, os.path.join(extracted, "fastqc_data.txt"))
+
+
+def test_read_fastqc_data():
+    '''the fastqc_data.txt lines are read from the zip archive'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        archive, extracted = write_results(tmp, "x_1")
+
+        lines = FASTQC_DATA.splitlines(keepends=True)
+
+        assert readqc.read_fastqc_data(archive) == lines
+        assert readqc.read_fastqc_data(extracted) == lines
+
+        # an archive without the data file
+        empty = os.path.join(tmp, "y_1_fastqc.zip")
+        with zipfile.ZipFile(empty, "w") as zf:
+            zf.writestr("y_1_fastqc/fastqc_report.html", "<html></html>")
+
+        try:
+            readqc.read_fastqc_data(empty)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("ValueError not raised")
+
+
+def test_section_iterator():
+    '''the sections, headers and data rows are parsed'''
+
+    sections = list(readqc.FastqcSectionIterator(
+        FASTQC_DATA.splitlines(keepends=True)))
+
+    assert sections == [
+        ("Basic Statistics", "pass", "Measure\tValue",
+         ["Filename\tx_1.fastq.gz", "Total Sequences\t100"]),
+        ("Per sequence quality scores", "warn", "Quality\tCount",
+         ["30\t40.0", "31\t60.0"])]
+
+
+def test_find_fastqc_files():
+    '''the archives (or else the extracted files) of a track are found'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        s1 = os.path.join(tmp, "s1")
+        s10 = os.path.join(tmp, "s10")
+
+        archive_1, extracted_1 = write_results(s1, "x_1")
+        archive_2, extracted_2 = write_results(s1, "x_2")
+        write_results(s10, "y_1")
+
+        assert readqc.find_fastqc_files(os.path.join(s1, "")) == \
+            [archive_1, archive_2]
+
+        os.unlink(archive_1)
+        os.unlink(archive_2)
+
+        assert readqc.find_fastqc_files(os.path.join(s1, "")) == \
+            [extracted_1, extracted_2]
+
+        assert readqc.find_fastqc_files(os.path.join(tmp, "s2", "")) == []
+
+
+def test_collect_sections():
+    '''the results of "<track>.sentinel" are read from <datadir>/<track>/'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        datadir = os.path.join(tmp, "fastqc.dir")
+
+        write_results(os.path.join(datadir, "s1"), "x_1")
+        write_results(os.path.join(datadir, "s10"), "y_1")
+
+        results = readqc.collectFastQCSections(
+            [os.path.join(datadir, "s1.sentinel")],
+            "Per sequence quality scores", datadir)
+
+        assert results == [("s1", "warn", "Quality\tCount",
+                            ["30\t40.0", "31\t60.0"])]
+
+
+def test_zip_sections():
+    '''the sections read from the zip match the extracted file'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        archive, extracted = write_results(os.path.join(tmp, "s1_FC1_1_END1"),
+                                           "x_1")
+
+        sections = readqc.read_fastqc_sections(archive)
+
+        assert sections == readqc.read_fastqc_sections(extracted)
+        assert [x[:2] for x in sections] == [
+            ("Basic Statistics", "pass"),
+            ("Per sequence quality scores", "warn")]
+
+        assert readqc.find_fastqc_files(
+            os.path.join(tmp, "s1_FC1_1_END1", "")) == [archive]
+
+        assert readqc.fastqc_filename2track(archive) == \
+            readqc.fastqc_filename2track(extracted)
+
+        dfs = readqc.read_fastqc([archive])
+        assert list(dfs["basic_statistics"]["sample_id"]) == \
+            ["s1_FC1_1_END1"] * 2
+
+
+def test_parse_fastqc():
+    '''the saved sections are used rather than parsing the archives'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        archive, extracted = write_results(os.path.join(tmp, "s1"), "x_1")
+        outfile = os.path.join(tmp, "fastqc_sections.pickle")
+
+        readqc.parse_fastqc([archive], outfile)
+
+        readqc._SECTIONS.clear()
+        readqc.load_fastqc_sections(outfile)
+
+        key = readqc._stat_key(archive)
+        readqc._SECTIONS[key] = [("saved", "pass", "", [])]
+
+        assert readqc.read_fastqc_sections(archive)[0][0] == "saved"
+
+        readqc._SECTIONS.clear()
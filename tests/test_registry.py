@@ -0,0 +1,138 @@
+'''test_registry - tests for the pipeline registry of the txseq command
+=====================================================================
+
+Purpose
+-------
+
+Check that :class:`txseq.tasks.registry.pipelineRegistry` reads the
+descriptions and targets of the pipelines without importing them, that
+the saved registry is reused while the pipelines are unchanged and that
+it is refreshed when pipelines are added or edited.
+
+'''
+import os
+import sys
+import time
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import txseq.tasks.registry as registry
+from txseq.tasks.registry import pipelineRegistry
+
+PIPELINE = '''"""=============
+Pipeline x.py
+=============
+
+:Author: Someone
+
+Overview
+--------
+
+This pipeline does x using `X <https://x.org>`_
+and then y.
+
+Configuration
+-------------
+
+"""
+import this_module_does_not_exist
+
+@files(None, "a.sentinel")
+def a(infile, outfile):
+    pass
+
+def helper():
+    pass
+
+@follows(a)
+def full():
+    pass
+'''
+
+
+def write_pipeline(path, text=PIPELINE):
+
+    with open(path, "w") as outfile:
+        outfile.write(text)
+
+
+def test_registry():
+    '''the descriptions and targets are read without importing'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        write_pipeline(os.path.join(tmp, "pipeline_x.py"))
+
+        pipelines = pipelineRegistry([tmp], save=False)
+
+        assert pipelines.commands() == ["x"]
+
+        info = pipelines.get("x")
+
+        assert info["description"] == "This pipeline does x using X and then y."
+        assert info["targets"] == ["a", "full"]
+        assert pipelines.get("y") is None
+
+
+def test_registry_file():
+    '''the saved registry does not depend on missing paths'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        missing = os.path.join(tmp, "src")
+
+        assert registry.default_registry_file([tmp]) == \
+            registry.default_registry_file([tmp, missing])
+
+        assert registry.default_registry_file([tmp]) != \
+            registry.default_registry_file([missing])
+
+        os.mkdir(missing)
+
+        assert registry.default_registry_file([tmp]) != \
+            registry.default_registry_file([tmp, missing])
+
+        pipelines = pipelineRegistry([tmp, os.path.join(tmp, "other")],
+                                     save=False)
+        assert pipelines.paths == [tmp]
+
+
+def test_saved_registry():
+    '''the saved registry is reused until the pipelines change'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        pipeline_dir = os.path.join(tmp, "pipelines")
+        registry_file = os.path.join(tmp, "registry.json")
+
+        os.mkdir(pipeline_dir)
+        write_pipeline(os.path.join(pipeline_dir, "pipeline_x.py"))
+
+        pipelineRegistry([pipeline_dir], registry_file=registry_file)
+        assert os.path.exists(registry_file)
+
+        # the saved registry is used (rather than the modules)
+        pipelines = pipelineRegistry([pipeline_dir],
+                                     registry_file=registry_file)
+        pipelines.pipelines["x"]["description"] = "saved"
+        pipelines.write(pipelines.stamp())
+
+        pipelines = pipelineRegistry([pipeline_dir],
+                                     registry_file=registry_file)
+        assert pipelines.get("x")["description"] == "saved"
+
+        # an edited pipeline is refreshed
+        time.sleep(0.01)
+        write_pipeline(os.path.join(pipeline_dir, "pipeline_x.py"),
+                       PIPELINE.replace("def full", "def all"))
+
+        assert pipelines.get("x")["targets"] == ["a", "all"]
+
+        # an added pipeline is found
+        write_pipeline(os.path.join(pipeline_dir, "pipeline_y.py"))
+
+        pipelines = pipelineRegistry([pipeline_dir],
+                                     registry_file=registry_file)
+        assert pipelines.commands() == ["x", "y"]
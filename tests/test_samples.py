@@ -0,0 +1,327 @@
+'''test_samples - tests for the FASTQ table construction in tasks.samples
+=======================================================================
+
+Purpose
+-------
+
+Check that :func:`txseq.tasks.samples.build_fastq_table` gives the same
+FASTQ table and per-sample FASTQ paths as the original (row by row,
+deepcopy based) implementation, which is reproduced below as a
+reference, that the FASTQ manifest detects added and removed files and
+that cached sample models are reused only while the tables are unchanged.
+
+The construction can be benchmarked on a synthetic 50k row library
+table by running::
+
+   python tests/test_samples.py
+
+'''
+import os
+import re
+import sys
+import copy
+import time
+import tempfile
+
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from txseq.tasks.samples import build_fastq_table, fastqManifest, \
+    load_samples, cache_path, samples_key
+
+# (txseq.tasks.samples is also the name of the samples class)
+samples_module = sys.modules["txseq.tasks.samples"]
+
+
+def reference(library_table, sample_types):
+    '''the original implementation (without the FASTQ path checks)'''
+
+    samples = {sid: {"type": x} for sid, x in sample_types.items()}
+
+    library_table["end"] = 'END1'
+    library_table["seq_id"] = library_table[["sample_id", "flow_cell", "lane",
+                                             "end"]].astype(str).T.apply(
+        lambda c: c.str.cat(sep='_'))
+
+    fastqs = library_table.copy(deep=True)
+    fastqs.index = fastqs["seq_id"]
+    fastqs = fastqs.to_dict(orient='index')
+
+    for seq_id in list(fastqs):
+
+        entry = fastqs[seq_id]
+
+        fqp = fastqs[seq_id]["fastq_path"]
+        sid = fastqs[seq_id]["sample_id"]
+
+        paired = True if samples[sid]["type"] == "PE" else False
+
+        if "fastq" not in samples[sid].keys():
+            samples[sid]["fastq"] = {'read1': [], 'read2': []}
+
+        if paired:
+
+            if fqp.endswith("1.fastq.gz"):
+                r2p = fqp.replace("1.fastq.gz", "2.fastq.gz")
+            elif fqp.endswith("1.fq.gz"):
+                r2p = fqp.replace("1.fq.gz", "2.fq.gz")
+            elif fqp.endswith("fastq.1.gz") or fqp.endswith("fq.1.gz"):
+                r2p = fqp.replace("1.gz", "2.gz")
+            else:
+                raise ValueError("Read 1 FASTQ file end suffix not recognised")
+
+            samples[sid]["fastq"]["read1"].append(fqp)
+            samples[sid]["fastq"]["read2"].append(r2p)
+
+            r2_seq_id = re.sub("_END1$", "_END2", seq_id)
+            r2_entry = copy.deepcopy(entry)
+            r2_entry["seq_id"] = r2_seq_id
+            r2_entry["fastq_path"] = r2p
+            r2_entry["end"] = "END2"
+            fastqs[r2_seq_id] = r2_entry
+
+        else:
+
+            samples[sid]["fastq"]["read1"].append(fqp)
+
+    fastqs = copy.deepcopy(fastqs)
+    fastq_table = pd.DataFrame.from_dict(fastqs, orient='index')
+
+    return(fastq_table, {sid: x["fastq"] for sid, x in samples.items()
+                         if "fastq" in x})
+
+
+def libraries(n_samples, n_lanes, n_flow_cells=1):
+    '''a synthetic library table and sample types'''
+
+    suffixes = ["_R1.fastq.gz", "_1.fq.gz", ".fastq.1.gz", ".fq.1.gz"]
+
+    rows = []
+    sample_types = {}
+
+    for i in range(n_samples):
+        sid = "sample%i" % i
+        sample_types[sid] = "SE" if i % 3 == 0 else "PE"
+        for fc in range(n_flow_cells):
+            for lane in range(1, n_lanes + 1):
+                rows.append((sid, lane, "FC%i" % fc,
+                             "/data/run1/%s_FC%i_L%03i%s" %
+                             (sid, fc, lane, suffixes[i % len(suffixes)])))
+
+    return(pd.DataFrame(rows, columns=["sample_id", "lane", "flow_cell",
+                                       "fastq_path"]),
+           sample_types)
+
+
+def check(library_table, sample_types):
+
+    ref_table, ref_fastqs = reference(library_table.copy(), sample_types)
+    table, fastqs = build_fastq_table(library_table.copy(), sample_types)
+
+    pd.testing.assert_frame_equal(table, ref_table)
+    assert fastqs == ref_fastqs
+    assert table.to_dict(orient="index") == ref_table.to_dict(orient="index")
+
+
+def test_build_fastq_table():
+    '''the FASTQ table matches the reference implementation'''
+
+    check(*libraries(n_samples=12, n_lanes=2, n_flow_cells=2))
+
+
+def test_build_fastq_table_large():
+    '''the FASTQ table matches the reference for 5k library rows'''
+
+    check(*libraries(n_samples=625, n_lanes=4, n_flow_cells=2))
+
+
+def test_unrecognised_suffix():
+    '''an unrecognised read 1 suffix raises a ValueError'''
+
+    library_table = pd.DataFrame([("a", 1, "FC1", "a.fastq.gz")],
+                                 columns=["sample_id", "lane", "flow_cell",
+                                          "fastq_path"])
+
+    try:
+        build_fastq_table(library_table, {"a": "PE"})
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("ValueError not raised")
+
+
+def test_fastq_manifest():
+    '''the manifest detects added and removed FASTQ files'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        paths = [os.path.join(tmp, "x_%i.fastq.gz" % i) for i in range(3)]
+
+        for path in paths[:2]:
+            open(path, "w").close()
+
+        manifest = fastqManifest(os.path.join(tmp, "manifest.tsv"))
+
+        stats = manifest.stat(paths)
+        assert [stats[x] is None for x in paths] == [False, False, True]
+
+        # the directory mtime changes when files are added or removed
+        time.sleep(0.01)
+        open(paths[2], "w").close()
+        os.unlink(paths[0])
+
+        stats = manifest.stat(paths)
+        assert [stats[x] is None for x in paths] == [True, False, False]
+
+
+def test_fastq_manifest_write(monkeypatch):
+    '''the manifest is replaced from a temporary file of the process'''
+
+    replaced = []
+    replace = os.replace
+
+    def record(src, dst):
+        replaced.append((src, dst))
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", record)
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        paths = [os.path.join(tmp, "x_%i.fastq.gz" % i) for i in range(2)]
+
+        for path in paths:
+            open(path, "w").close()
+
+        manifest_file = os.path.join(tmp, "manifest.tsv")
+
+        # e.g. left by another pipeline writing the manifest
+        with open(manifest_file + ".tmp", "w") as outfile:
+            outfile.write("partial")
+
+        manifest = fastqManifest(manifest_file)
+        stats = manifest.stat(paths)
+
+        assert replaced == [(manifest_file + ".tmp." + str(os.getpid()),
+                             manifest_file)]
+
+        dirs, files = manifest.read()
+
+        assert files == stats
+        assert list(dirs) == [tmp]
+
+        with open(manifest_file + ".tmp") as infile:
+            assert infile.read() == "partial"
+
+        assert sorted(os.listdir(tmp)) == ["manifest.tsv", "manifest.tsv.tmp",
+                                           "x_0.fastq.gz", "x_1.fastq.gz"]
+
+
+def test_load_samples():
+    '''cached models are reused until the tables or FASTQs change'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        fq = os.path.join(tmp, "fq")
+        os.mkdir(fq)
+
+        for sid in ["a", "b"]:
+            for end in [1, 2]:
+                open(os.path.join(fq, "%s_%i.fastq.gz" % (sid, end)),
+                     "w").close()
+
+        sample_tsv = os.path.join(tmp, "samples.tsv")
+        library_tsv = os.path.join(tmp, "libraries.tsv")
+        cache_file = os.path.join(tmp, "samples.cache.pickle")
+
+        with open(sample_tsv, "w") as outfile:
+            outfile.write("sample_id\ttype\tstrand\n"
+                          "a\tPE\tnone\nb\tPE\treverse\n")
+
+        with open(library_tsv, "w") as outfile:
+            outfile.write("sample_id\tlane\tflow_cell\tfastq_path\n")
+            for sid in ["a", "b"]:
+                outfile.write("%s\t1\tFC1\t%s\n" %
+                              (sid, os.path.join(fq, sid + "_1.fastq.gz")))
+
+        first = load_samples(sample_tsv, library_tsv, cache_file=cache_file)
+        second = load_samples(sample_tsv, library_tsv, cache_file=cache_file)
+
+        assert os.path.exists(cache_file)
+        assert second.npaired == 2
+        assert second.fastqs == first.fastqs
+
+        # a changed sample table invalidates the cached model
+        with open(sample_tsv, "w") as outfile:
+            outfile.write("sample_id\ttype\tstrand\n"
+                          "a\tPE\tnone\nb\tSE\treverse\n")
+
+        third = load_samples(sample_tsv, library_tsv, cache_file=cache_file)
+        assert third.npaired == 1
+
+        # the FASTQ files of a cached model are still checked
+        os.unlink(os.path.join(fq, "a_1.fastq.gz"))
+
+        try:
+            load_samples(sample_tsv, library_tsv, cache_file=cache_file)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("ValueError not raised")
+
+
+def test_cache_files(monkeypatch):
+    '''pipelines loading the samples differently use different caches'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        sample_tsv = os.path.join(tmp, "samples.tsv")
+
+        with open(sample_tsv, "w") as outfile:
+            outfile.write("sample_id\ttype\tstrand\n"
+                          "a\tPE\tnone\nb\tSE\treverse\n")
+
+        monkeypatch.chdir(tmp)
+
+        # e.g. pipeline_bamqc (no library table) and pipeline_salmon
+        assert cache_path(sample_tsv) != \
+            cache_path(sample_tsv, "libraries.tsv", "fastq.manifest.tsv")
+
+        first = load_samples(sample_tsv)
+        assert os.path.exists(cache_path(sample_tsv))
+        assert first.npaired == 1
+
+        # the cached model is not used once the module has changed
+        key = samples_key(sample_tsv)
+
+        source = os.path.join(tmp, "samples.py")
+        with open(samples_module.__file__) as infile:
+            text = infile.read()
+
+        with open(source, "w") as outfile:
+            outfile.write(text + "\n# changed\n")
+
+        monkeypatch.setattr(samples_module, "__file__", source)
+
+        assert samples_key(sample_tsv) != key
+
+
+def benchmark(n_samples=6250, n_lanes=4, n_flow_cells=2):
+    '''time the FASTQ table construction on a synthetic library table'''
+
+    library_table, sample_types = libraries(n_samples, n_lanes,
+                                            n_flow_cells)
+
+    print("library table rows: %i" % len(library_table))
+
+    for name, function in [("reference", reference),
+                           ("build_fastq_table", build_fastq_table)]:
+        start = time.time()
+        function(library_table.copy(), sample_types)
+        print("%s: %.2f seconds" % (name, time.time() - start))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,138 @@
+'''test_startup - tests for the start up time of the txseq command
+=================================================================
+
+Purpose
+-------
+
+Check that importing :mod:`txseq.tasks` and :mod:`txseq.entry` does
+not import the heavy dependencies (pandas, numpy, cgat-core, ruffus,
+sqlalchemy), that their import time (measured with "python -X
+importtime") stays within a budget and that "txseq --help", "txseq
+<pipeline> --help" and "txseq <pipeline> config" work without importing
+the pipelines.
+
+The slowest imports can be listed by running::
+
+   python tests/test_startup.py
+
+'''
+import os
+import sys
+import subprocess
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that must not be imported by the txseq command or txseq.tasks
+HEAVY = ["pandas", "numpy", "cgatcore", "ruffus", "sqlalchemy"]
+
+# the budget for the (cumulative) import time, in seconds
+IMPORT_BUDGET = 0.5
+
+
+# the pipeline registry is saved here rather than in ~/.cache
+CACHE_DIR = tempfile.TemporaryDirectory()
+
+
+def run(args, cwd=None):
+
+    env = dict(os.environ, PYTHONPATH=ROOT, XDG_CACHE_HOME=CACHE_DIR.name)
+
+    return(subprocess.run([sys.executable] + args, cwd=cwd, env=env,
+                          capture_output=True, text=True, check=True))
+
+
+def import_times(args, cwd=None):
+    '''
+    Return a dictionary of the cumulative import times (in seconds) of
+    the modules imported by running python with *args*.
+    '''
+
+    result = run(["-X", "importtime"] + args, cwd=cwd)
+
+    times = {}
+
+    for line in result.stderr.splitlines():
+
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+
+        fields = line[len("import time:"):].split("|")
+
+        if not fields[1].strip().isdigit():
+            # the header line
+            continue
+
+        times[fields[2].strip()] = int(fields[1]) / 1e6
+
+    return(times)
+
+
+def check_heavy(times):
+
+    heavy = sorted(x for x in times if x.split(".")[0] in HEAVY)
+    assert heavy == [], "heavy modules imported: " + ", ".join(heavy)
+
+
+def check_imports(module):
+
+    times = import_times(["-c", "import " + module])
+
+    check_heavy(times)
+
+    assert times[module] < IMPORT_BUDGET, \
+        "import %s took %.2f seconds" % (module, times[module])
+
+
+def test_import_tasks():
+    '''importing txseq.tasks is fast and does not import pandas'''
+
+    check_imports("txseq.tasks")
+
+
+def test_import_entry():
+    '''importing the txseq command is fast'''
+
+    check_imports("txseq.entry")
+
+
+def test_help():
+    '''"txseq --help" lists the pipelines'''
+
+    result = run(["-m", "txseq.entry", "--help"])
+
+    assert "salmon_index" in result.stdout
+
+
+def test_config():
+    '''"txseq <pipeline> config" writes the default configuration file'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        times = import_times(["-m", "txseq.entry", "salmon", "config"],
+                             cwd=tmp)
+
+        check_heavy(times)
+
+        assert os.path.exists(os.path.join(tmp, "pipeline_salmon.yml"))
+
+
+def test_pipeline_help():
+    '''"txseq <pipeline> --help" lists the targets without importing'''
+
+    times = import_times(["-m", "txseq.entry", "salmon", "--help"])
+
+    check_heavy(times)
+
+
+def benchmark(module="txseq.entry", n=15):
+    '''print the slowest imports of *module*'''
+
+    times = import_times(["-c", "import " + module])
+
+    for name, seconds in sorted(times.items(), key=lambda x: -x[1])[:n]:
+        print("%-40s %.3f" % (name, seconds))
+
+
+if __name__ == "__main__":
+    benchmark(*sys.argv[1:])
@@ -15,13 +15,27 @@ For this message and a list of available keywords type::
 To get help for a specify workflow, type::
 
     txseq <workflow> --help
+
+To check out a local copy of the default configuration file of a
+workflow, type::
+
+    txseq <workflow> config
+
+For the cgat-core options of a workflow, type::
+
+    txseq <workflow> make --help
+
+The pipeline modules (and so cgat-core, ruffus, pandas etc) are only
+imported when a workflow is run: the workflows, their descriptions and
+their targets are listed from a registry (see txseq.tasks.registry) and
+writing the configuration files and profiling do not import them, so
+that these commands start quickly.
 '''
 
 import os
 import sys
 import re
-import glob
-import imp
+import importlib.util
 
 
 def printListInColumns(l, ncolumns):
@@ -54,39 +68,103 @@ def printListInColumns(l, ncolumns):
     return '\n'.join([pattern % row for row in rows])
 
 
-def main(argv=None):
-
-    argv = sys.argv
+def pipeline_paths():
+    '''return the paths to look for pipelines in.'''
 
-    # paths to look for pipelines:
     # print(pipelines.__file__)
     path = os.path.abspath(os.path.dirname(__file__))
     #path = os.path.abspath(os.path.dirname(pipelines.__file__))
     relpath = os.path.abspath("../src")
 
-    paths = [path, relpath]
+    # the relative path only exists when run from a source checkout
+    return [x for x in [path, relpath] if os.path.isdir(x)]
+
+
+def printPipelines(pipelines, width=78):
+    '''output the pipeline commands with their descriptions.'''
+
+    commands = pipelines.commands()
+    max_width = max([len(x) for x in commands]) + 3
+
+    for command in commands:
+        description = pipelines.pipelines[command]["description"]
+        if len(description) > width - max_width:
+            description = description[:width - max_width - 3] + "..."
+        print(("%-" + str(max_width) + "s%s") % (command, description))
+
+
+def load_pipeline(pipeline, pipeline_path):
+    '''import the *pipeline* module from *pipeline_path*.'''
+
+    spec = importlib.util.spec_from_file_location(pipeline, pipeline_path)
+    module = importlib.util.module_from_spec(spec)
+
+    # registered (as by imp.load_module) before it is executed
+    sys.modules[pipeline] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def main(argv=None):
+
+    argv = sys.argv
+
+    # the pipelines are listed and found with the registry
+    from txseq.tasks.registry import pipelineRegistry
+
+    pipelines = pipelineRegistry(pipeline_paths())
 
     if len(argv) == 1 or argv[1] == "--help" or argv[1] == "-h":
-        pipelines = []
-        for path in paths:
-            pipelines.extend(glob.glob(os.path.join(path, "pipeline_*.py")))
         print((globals()["__doc__"]))
         print("The list of available pipelines are:\n")
-        print("{}\n".format(
-            printListInColumns(
-                sorted([os.path.basename(x)[len("pipeline_"):-len(".py")] for x in pipelines]),
-                3)))
+        printPipelines(pipelines)
+        print("")
         return
     
     command = argv[1]
     command = re.sub("-", "_", command)
     pipeline = "pipeline_{}".format(command)
 
-    if argv[2] == "profile":
+    info = pipelines.get(command)
+
+    if info is None:
+        raise ValueError("pipeline not found: " + argv[1] + ' (see "txseq '
+                         '--help" for the list of available pipelines)')
+
+    pipeline_path = info["path"]
+
+    action = argv[2] if len(argv) > 2 else None
+
+    if action in ["--help", "-h"] and len(argv) == 3:
+
+        print("txseq " + command + ": " + info["description"] + "\n")
+        print("Usage: txseq " + command + " [config|make <target>|"
+              "show <target>|profile] [options]\n")
+        print("The list of targets are:\n")
+        print("{}\n".format(printListInColumns(info["targets"], 3)))
+        print('For the cgat-core pipeline options, type "txseq ' + command +
+              ' make --help"')
+        return
+
+    if action == "config":
+
+        # the default configuration file is copied without importing the
+        # pipeline. As for cgatcore, the path is given without the ".py"
+        # (see txseq.tasks.parameters.write_config_files).
+        from txseq.tasks.parameters import write_config_files
+
+        write_config_files(os.path.splitext(pipeline_path)[0], None)
+
+        return
+
+    if action == "profile":
     
         import txseq.tasks.profile as p
         
-        p.profile(pipeline + ".log", show_fields=False)
+        p.profile(pipeline + ".log", show_fields=False,
+                  incremental="--incremental" in argv,
+                  save_history="--no-history" not in argv)
         
         return
 
@@ -96,9 +174,7 @@ def main(argv=None):
     # specify a named logfile
     sys.argv.append("--pipeline-logfile=" + pipeline + ".log")
 
-    (file, pathname, description) = imp.find_module(pipeline, paths)
-
-    module = imp.load_module(pipeline, file, pathname, description)
+    module = load_pipeline(pipeline, pipeline_path)
 
     module.main(sys.argv)
 
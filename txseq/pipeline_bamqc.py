@@ -7,6 +7,32 @@ Overview
 
 This pipeline computes QC statistic from BAM files. It uses the `Picard toolkit <https://broadinstitute.github.io/picard/>`_ and some custom scripts.
 
+If the "picard_batch" option is set, the Picard RNA-seq, alignment summary and
+insert size metrics are collected for each BAM file in a single JVM with
+Picard CollectMultipleMetrics.
+
+Alternatively, if the "metrics_engine" option is set to "native", all of the
+metrics are computed by a single pass of each BAM file with pysam (see
+:mod:`txseq.tasks.bam`). The native metrics tables have the same layout as
+the Picard tables and are loaded in the same way.
+
+For a quick triage, the "subsample_fraction" option can be used to run all
+of the QC on a deterministic random subsample of the reads of each BAM file.
+Reads are selected by a (seeded) hash of the read name so that mates are
+kept together and repeated runs select the same reads. When subsampled,
+95% confidence intervals are added for the proportions reported in the
+"qc_summary" table. Each interval is computed from the number of reads,
+bases or read pairs of its own metric.
+
+.. note::
+
+    The subsample is not index-aware: "samtools view -s" reads (and
+    decompresses) every record of the BAM file to select the reads. The
+    time saved is that of the QC steps that run on the (smaller)
+    subsample, not that of reading the BAM files. The BAM index is not
+    used to select regions as the reads of a few regions are not a
+    random sample of the library (and mates would be separated).
+
 
 Configuration
 -------------
@@ -34,6 +60,8 @@ Requirements
 The following software is required:
 
 #. Picard
+#. pysam (for the native metrics engine)
+#. samtools (for subsampling)
 
 Output files
 ------------
@@ -42,7 +70,7 @@ The pipeline produces the following outputs:
 
 #. Picard rnaseq metrics: in the bam.qc.dir/rnaseq.metrics.dir
 #. Picard alignment summary metrics: in the bam.qc.dir/alignment.summary.metrics.dir
-#. Fraction of spliced reads: in the bam.qc.dir/fraction.spliced.dir
+#. Fraction of spliced reads (genome-wide and per contig): in the bam.qc.dir/fraction.spliced.dir
 #. An sqlite database: in a file named "csvdb" which contains tables of the QC metrics, with key metrics summarised in the "qc_summary" table.
 
 
@@ -55,6 +83,7 @@ from ruffus import *
 import sys
 import shutil
 import os
+import re
 from pathlib import Path
 import glob
 import sqlite3
@@ -70,6 +99,9 @@ import cgatcore.iotools as IOTools
 
 # import local pipeline utility functions
 import txseq.tasks as T
+import txseq.tasks.picard as picard
+import txseq.tasks.db as db
+from txseq.tasks.bam import binomial_ci
 
 # ----------------------- < pipeline configuration > ------------------------ #
 
@@ -83,12 +115,29 @@ PARAMS = P.get_parameters(T.get_parameter_file(__file__))
 # set the location of the code directory
 PARAMS["txseq_code_dir"] = Path(__file__).parents[1]
 
+# only (re)load the new or changed per-sample outputs
+INCREMENTAL = bool(PARAMS.get("sqlite_incremental"))
+
 PAIRED = False
 
+# compute all of the BAM metrics in a single pass
+NATIVE = PARAMS.get("metrics_engine", "picard") == "native"
+
+# run the QC on a subsample of the reads
+SAMPLE_FRACTION = float(PARAMS.get("subsample_fraction") or 1)
+
+if SAMPLE_FRACTION <= 0 or SAMPLE_FRACTION > 1:
+    raise ValueError("subsample_fraction must be > 0 and <= 1")
+
+SUBSAMPLE = SAMPLE_FRACTION < 1
+
+# run the Picard collectors for each BAM file in a single JVM
+PICARD_BATCH = bool(PARAMS.get("picard_batch")) and not NATIVE
+
 if len(sys.argv) > 1:
     if(sys.argv[1] == "make"):
         
-        S = T.samples(sample_tsv = PARAMS["samples"],
+        S = T.load_samples(sample_tsv = PARAMS["samples"],
                             library_tsv = None)
         
         if S.npaired > 0: PAIRED = True
@@ -99,6 +148,18 @@ if len(sys.argv) > 1:
 
 # ---------------------- < specific pipeline tasks > ------------------------ #
 
+def bam_input(sample_id):
+    '''
+    Return the path of the BAM file to QC for a sample: either the
+    original BAM file or its subsample.
+    '''
+
+    if SUBSAMPLE:
+        return(os.path.join("bam.qc.dir/subsample.dir", sample_id + ".bam"))
+
+    return(os.path.join(PARAMS["bam_path"], sample_id + ".bam"))
+
+
 # ------------------------- Geneset Definition ------------------------------ #
 
 @follows(mkdir("annotations.dir"))
@@ -138,6 +199,247 @@ def flatGeneset(infile, sentinel):
     IOTools.touch_file(sentinel)
 
 
+# ------------------------ Subsampling of the reads ------------------------- #
+
+
+def subsample_jobs():
+
+    for sample_id in S.samples.keys():
+
+        yield([os.path.join(PARAMS["bam_path"], sample_id + ".bam"),
+                os.path.join("bam.qc.dir/subsample.dir/",
+                            sample_id + ".bam.sentinel")])
+
+@active_if(SUBSAMPLE)
+@files(subsample_jobs)
+def subsampleBams(infile, sentinel):
+    '''
+    Take a deterministic random subsample of the reads in each BAM file.
+
+    samtools selects the reads using a hash of the read name (and the
+    seed) so that mates are kept together. Note that every record of the
+    BAM file is read (the index is not used).
+    '''
+
+    t = T.setup(infile, sentinel, PARAMS,
+            memory=PARAMS["subsample_memory"],
+            cpu=PARAMS["subsample_threads"])
+
+    # the samtools -s argument is the seed followed by the fraction,
+    # e.g. 11.05 to take 5% of the reads with seed 11.
+    subsample = "%i%s" % (int(PARAMS["subsample_seed"]),
+                          ("%.10f" % SAMPLE_FRACTION).rstrip("0")[1:])
+
+    statement = '''samtools view
+                    -b
+                    -@ %(job_threads)s
+                    -s %(subsample)s
+                    -o %(out_file)s
+                    %(infile)s
+                   &> %(log_file)s;
+                   samtools index %(out_file)s
+                ''' % dict(PARAMS, **t.var, **locals())
+
+    P.run(statement, **t.resources)
+    IOTools.touch_file(sentinel)
+
+
+# ---------------------- Native: single pass metrics ------------------------ #
+
+
+def bam_metrics_jobs():
+
+    for sample_id in S.samples.keys():
+
+        yield([bam_input(sample_id),
+                os.path.join("bam.qc.dir/bam.metrics.dir/",
+                            sample_id + ".bam.metrics.sentinel")])
+
+@active_if(NATIVE)
+@follows(flatGeneset, subsampleBams)
+@files(bam_metrics_jobs)
+def bamMetrics(infile, sentinel):
+    '''
+    Compute the RNA-seq, alignment summary, insert size, library
+    complexity and fraction spliced metrics in a single pass of each
+    BAM file.
+
+    The outputs are written to the folders used by the Picard tasks
+    (which are skipped when the native engine is used).
+    '''
+
+    bam_file = infile
+    geneset_flat = "annotations.dir/geneset.flat.gz"
+
+    sample_id = os.path.basename(bam_file)[:-len(".bam")]
+    sample = S.samples[sample_id]
+
+    t = T.setup(infile, sentinel, PARAMS,
+            memory=PARAMS["metrics_memory"],
+            cpu=PARAMS["metrics_threads"],
+            sample=sample_id)
+
+    picard_strand = sample.picard_strand
+
+    outputs = {"rnaseqmetrics": "rnaseq.metrics.dir/%s.rnaseq.metrics",
+               "coveragehist": "rnaseq.metrics.dir/%s.rnaseq.cov.hist",
+               "alignmentsummary": ("alignment.summary.metrics.dir/"
+                                    "%s.alignment.summary.metrics"),
+               "fractionspliced": "fraction.spliced.dir/%s.fraction.spliced",
+               "fractionsplicedcontigs": ("fraction.spliced.dir/"
+                                          "%s.fraction.spliced.contigs")}
+
+    if sample.paired:
+        outputs["insertsize"] = ("insert.size.metrics.dir/"
+                                 "%s.insert.size.metrics.summary")
+        outputs["insertsizehist"] = ("insert.size.metrics.dir/"
+                                     "%s.insert.size.metrics.histogram")
+
+        if PARAMS["run_estimateLibraryComplexity"]:
+            outputs["librarycomplexity"] = ("estimate.library.complexity.dir/"
+                                            "%s.library.complexity")
+
+    output_options = " ".join(["--%s=bam.qc.dir/%s" % (k, v % sample_id)
+                               for k, v in outputs.items()])
+
+    statement = '''python %(txseq_code_dir)s/python/bam_metrics.py
+                   --bam=%(bam_file)s
+                   --refflat=%(geneset_flat)s
+                   --strand=%(picard_strand)s
+                   --threads=%(job_threads)s
+                   %(output_options)s
+                   &> %(log_file)s
+                ''' % dict(PARAMS, **t.var, **locals())
+
+    P.run(statement, **t.resources)
+    IOTools.touch_file(sentinel)
+
+
+# ------------------ Picard: CollectMultipleMetrics (batch) ----------------- #
+
+
+def collect_multiple_metrics_jobs():
+
+    for sample_id in S.samples.keys():
+
+        yield([bam_input(sample_id),
+                os.path.join("bam.qc.dir/multiple.metrics.dir/",
+                            sample_id + ".multiple.metrics.sentinel")])
+
+@active_if(PICARD_BATCH)
+@follows(flatGeneset, subsampleBams)
+@files(collect_multiple_metrics_jobs)
+def collectMultipleMetrics(infile, sentinel):
+    '''
+    Run the Picard RnaSeqMetrics, CollectAlignmentSummaryMetrics and
+    (for paired end data) CollectInsertSizeMetrics collectors in a
+    single JVM with Picard CollectMultipleMetrics.
+
+    The outputs are written to the files made by the individual Picard
+    tasks (which are skipped when the batch mode is used).
+    '''
+
+    bam_file = infile
+    geneset_flat = "annotations.dir/geneset.flat.gz"
+
+    sample_id = os.path.basename(bam_file)[:-len(".bam")]
+    sample = S.samples[sample_id]
+
+    t = T.setup(infile, sentinel, PARAMS,
+            memory=PARAMS["picard_memory"],
+            cpu=PARAMS["picard_threads"],
+            sample=sample_id)
+
+    picard_strand = sample.picard_strand
+    validation_stringency = PARAMS["picard_validation_stringency"]
+
+    reference_sequence = os.path.join(PARAMS["txseq_annotations"],
+                                      "api.dir/txseq.genome.fa.gz")
+
+    if not os.path.exists(reference_sequence):
+        raise ValueError("Reference sequence not found")
+
+    # the prefix of the CollectMultipleMetrics outputs
+    prefix = t.out_file
+
+    rnaseq_out = os.path.join("bam.qc.dir/rnaseq.metrics.dir",
+                              sample_id + ".rnaseq.metrics")
+    coverage_out = rnaseq_out[:-len(".metrics")] + ".cov.hist"
+    chart_out = rnaseq_out[:-len(".metrics")] + ".cov.pdf"
+
+    alignment_out = os.path.join("bam.qc.dir/alignment.summary.metrics.dir",
+                                 sample_id + ".alignment.summary.metrics")
+
+    programs = ["RnaSeqMetrics", "CollectAlignmentSummaryMetrics"]
+
+    # the options for the individual collectors are passed as
+    # CollectMultipleMetrics "extra arguments"
+    extra_args = ["RnaSeqMetrics::--STRAND_SPECIFICITY " + picard_strand,
+                  "RnaSeqMetrics::--CHART_OUTPUT " + chart_out]
+
+    for program, option in [
+            ("RnaSeqMetrics", "collectrnaseqmetrics_options"),
+            ("CollectAlignmentSummaryMetrics",
+             "alignmentsummarymetrics_options"),
+            ("CollectInsertSizeMetrics", "insertsizemetric_options")]:
+
+        if PARAMS.get("picard_" + option):
+            extra_args.append(program + "::" + PARAMS["picard_" + option])
+
+    dirs = [os.path.dirname(rnaseq_out), os.path.dirname(alignment_out)]
+
+    if sample.paired:
+        programs.append("CollectInsertSizeMetrics")
+
+        insert_size_dir = "bam.qc.dir/insert.size.metrics.dir"
+        dirs.append(insert_size_dir)
+
+        picard_summary = os.path.join(insert_size_dir,
+                                      sample_id + ".insert.size.metrics.summary")
+        picard_histogram = os.path.join(insert_size_dir,
+                                        sample_id + ".insert.size.metrics.histogram")
+
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+
+    program_options = " ".join(["--PROGRAM " + x for x in programs])
+    extra_options = " ".join(['--EXTRA_ARGUMENT "%s"' % x for x in extra_args])
+
+    statement = '''%(picard_cmd)s CollectMultipleMetrics
+                   -I %(bam_file)s
+                   -O %(prefix)s
+                   --REFERENCE_SEQUENCE %(reference_sequence)s
+                   --REF_FLAT %(geneset_flat)s
+                   --PROGRAM null
+                   %(program_options)s
+                   %(extra_options)s
+                   --VALIDATION_STRINGENCY %(validation_stringency)s
+                   &> %(log_file)s
+                ''' % dict(PARAMS, **t.var, **locals())
+
+    # jobs killed for exceeding their memory limit are resubmitted
+    # (if enabled, see txseq.tasks.setup)
+    t.run(statement, PARAMS)
+
+    # The histogram is not generated if no data is present, in which
+    # case an empty coverage histogram file is written.
+    # https://github.com/broadinstitute/picard/issues/1177
+    picard.write_metrics(prefix + ".rna_metrics",
+                         metrics_out=rnaseq_out,
+                         histogram_out=coverage_out)
+
+    picard.write_metrics(prefix + ".alignment_summary_metrics",
+                         metrics_out=alignment_out)
+
+    if sample.paired:
+        picard.write_metrics(prefix + ".insert_size_metrics",
+                             metrics_out=picard_summary,
+                             histogram_out=picard_histogram,
+                             first_row=True)
+
+    IOTools.touch_file(sentinel)
+
+
 # ------------------- Picard: CollectRnaSeqMetrics -------------------------- #
 
 
@@ -145,26 +447,32 @@ def collect_rna_seq_metrics_jobs():
 
     for sample_id in S.samples.keys():
     
-        yield([os.path.join(PARAMS["bam_path"], sample_id + ".bam"),
+        yield([bam_input(sample_id),
                 os.path.join("bam.qc.dir/rnaseq.metrics.dir/",
                             sample_id + ".rnaseq.metrics.sentinel")])
 
-@follows(flatGeneset)
+@follows(flatGeneset, subsampleBams, bamMetrics, collectMultipleMetrics)
 @files(collect_rna_seq_metrics_jobs)
 def collectRnaSeqMetrics(infile, sentinel):
     '''
     Run Picard CollectRnaSeqMetrics on the bam files.
     '''
 
-    t = T.setup(infile, sentinel, PARAMS,
-            memory=PARAMS["picard_memory"],
-            cpu=PARAMS["picard_threads"])
+    if NATIVE or PICARD_BATCH:
+        # the metrics were computed by bamMetrics or collectMultipleMetrics
+        IOTools.touch_file(sentinel)
+        return
 
     bam_file = infile
     geneset_flat = "annotations.dir/geneset.flat.gz"
     
     sample_id = os.path.basename(bam_file)[:-len(".bam")]
     sample = S.samples[sample_id]
+
+    t = T.setup(infile, sentinel, PARAMS,
+            memory=PARAMS["picard_memory"],
+            cpu=PARAMS["picard_threads"],
+            sample=sample_id)
     picard_strand = sample.picard_strand
 
     if PARAMS["picard_collectrnaseqmetrics_options"]:
@@ -177,45 +485,32 @@ def collectRnaSeqMetrics(infile, sentinel):
     coverage_out = t.out_file[:-len(".metrics")] + ".cov.hist"
     chart_out = t.out_file[:-len(".metrics")] + ".cov.pdf"
 
-    mktemp_template = "ctmp.CollectRnaSeqMetrics.XXXXXXXXXX"
+    # the full Picard output (removed once the tables are written)
+    picard_out = t.out_file + ".picard"
 
-    # The histogram is not generated if no data is present
-    # https://github.com/broadinstitute/picard/issues/1177
-    statement = '''picard_out=`mktemp -p . %(mktemp_template)s`;
-                   %(picard_cmd)s CollectRnaSeqMetrics
+    statement = '''%(picard_cmd)s CollectRnaSeqMetrics
                    -I %(bam_file)s
                    --REF_FLAT %(geneset_flat)s
-                   -O $picard_out
+                   -O %(picard_out)s
                    --CHART %(chart_out)s
                    --STRAND_SPECIFICITY %(picard_strand)s
                    --VALIDATION_STRINGENCY %(validation_stringency)s
-                   %(picard_options)s;
-                   grep . $picard_out | grep -v "#" | head -n2
-                   > %(out_file)s;
-                   grep . $picard_out
-                   | grep -A 102 "## HISTOGRAM"
-                   | grep -v "##"
-                   > %(coverage_out)s || touch %(coverage_out)s;
-                   rm $picard_out;
+                   %(picard_options)s
                 ''' % dict(PARAMS, **t.var, **locals())
 
-    P.run(statement, **t.resources)
-    IOTools.touch_file(sentinel)
-
+    # jobs killed for exceeding their memory limit are resubmitted
+    # (if enabled, see txseq.tasks.setup)
+    t.run(statement, PARAMS)
 
-@merge(collectRnaSeqMetrics,
-       "bam.qc.dir/qc_rnaseq_metrics.load")
-def loadCollectRnaSeqMetrics(infiles, outfile):
-    '''
-    Load the metrics to the db.
-    '''
-    
-    infiles = [x.replace(".sentinel", "") for x in infiles]
+    # The histogram is not generated if no data is present, in which
+    # case an empty coverage histogram file is written.
+    # https://github.com/broadinstitute/picard/issues/1177
+    picard.write_metrics(picard_out,
+                         metrics_out=t.out_file,
+                         histogram_out=coverage_out)
+    os.remove(picard_out)
 
-    P.concatenate_and_load(infiles, outfile,
-                           regex_filename=".*/.*/(.*).rnaseq.metrics",
-                           cat="sample_id",
-                           options='-i "sample_id"')
+    IOTools.touch_file(sentinel)
 
 
 # --------------------- Three prime bias analysis --------------------------- #
@@ -254,19 +549,6 @@ def threePrimeBias(infile, outfile):
 
 
 
-@merge(threePrimeBias,
-       "bam.qc.dir/qc_three_prime_bias.load")
-def loadThreePrimeBias(infiles, outfile):
-    '''
-    Load the metrics in the project database.
-    '''
-
-    P.concatenate_and_load(infiles, outfile,
-                           regex_filename=".*/.*/(.*).three.prime.bias",
-                           cat="sample_id",
-                           options='-i "sample_id"')
-
-
 # ----------------- Picard: EstimateLibraryComplexity ----------------------- #
 
 
@@ -276,16 +558,23 @@ def estimate_library_complexity_jobs():
     
         if  S.samples[sample_id].paired == True:
     
-            yield([os.path.join(PARAMS["bam_path"], sample_id + ".bam"),
+            yield([bam_input(sample_id),
                    os.path.join("bam.qc.dir/estimate.library.complexity.dir/",
                                 sample_id + ".library.complexity.sentinel")])
 
 @active_if(PAIRED and PARAMS["run_estimateLibraryComplexity"])
+@follows(subsampleBams, bamMetrics)
 @files(estimate_library_complexity_jobs)
 def estimateLibraryComplexity(infile, sentinel):
     '''
     Run Picard EstimateLibraryComplexity on the BAM files.
     '''
+
+    if NATIVE:
+        # the metrics were computed by bamMetrics
+        IOTools.touch_file(sentinel)
+        return
+
     t = T.setup(infile, sentinel, PARAMS,
         memory=PARAMS["picard_memory"],
         cpu=PARAMS["picard_threads"])
@@ -297,39 +586,25 @@ def estimateLibraryComplexity(infile, sentinel):
 
     validation_stringency = PARAMS["picard_validation_stringency"]
 
-    mktemp_template = "ctmp.EstimateLibraryComplexity.XXXXXXXXXX"
+    # the full Picard output (removed once the tables are written)
+    picard_out = t.out_file + ".picard"
 
-    statement = '''picard_out=`mktemp -p . %(mktemp_template)s`;
-                   %(picard_cmd)s EstimateLibraryComplexity
+    statement = '''%(picard_cmd)s EstimateLibraryComplexity
                    -I %(infile)s
-                   -O $picard_out
+                   -O %(picard_out)s
                    --VALIDATION_STRINGENCY %(validation_stringency)s
-                   %(picard_options)s;
-                   grep . $picard_out | grep -v "#" | head -n2
-                   > %(out_file)s;
-                   rm $picard_out;
+                   %(picard_options)s
                 ''' % dict(PARAMS, **t.var, **locals())
 
     P.run(statement, **t.resources)
-    IOTools.touch_file(sentinel)
-    
-
-@active_if(PAIRED and PARAMS["run_estimateLibraryComplexity"])
-@merge(estimateLibraryComplexity,
-       "bam.qc.dir/qc_library_complexity.load")
-def loadEstimateLibraryComplexity(infiles, outfile):
-    '''
-    Load the complexity metrics to a single table in the project database.
-    '''
-    
-    infiles = [x.replace(".sentinel", "") for x in infiles]
-
-    P.concatenate_and_load(infiles, outfile,
-                           regex_filename=".*/.*/(.*).library.complexity",
-                           cat="sample_id",
-                           options='-i "sample_id"')
 
+    # the metrics are reported per library: these are combined so that
+    # the table (and qcSummary) has one row per sample
+    picard.write_metrics(picard_out, metrics_out=t.out_file, level="sample")
+    os.remove(picard_out)
 
+    IOTools.touch_file(sentinel)
+    
 
 # ------------------- Picard: AlignmentSummaryMetrics ----------------------- #
 
@@ -338,21 +613,30 @@ def alignment_summary_metrics_jobs():
 
     for sample_id in S.samples.keys():
     
-        yield([os.path.join(PARAMS["bam_path"], sample_id + ".bam"),
+        yield([bam_input(sample_id),
                 os.path.join("bam.qc.dir/alignment.summary.metrics.dir/",
                             sample_id + ".alignment.summary.metrics.sentinel")])
 
+@follows(subsampleBams, bamMetrics, collectMultipleMetrics)
 @files(alignment_summary_metrics_jobs)
 def alignmentSummaryMetrics(infile, sentinel):
     '''
     Run Picard AlignmentSummaryMetrics on the bam files.
     '''
 
+    if NATIVE or PICARD_BATCH:
+        # the metrics were computed by bamMetrics or collectMultipleMetrics
+        IOTools.touch_file(sentinel)
+        return
+
     t = T.setup(infile, sentinel, PARAMS,
             memory=PARAMS["picard_memory"],
             cpu=PARAMS["picard_threads"])
 
-    picard_options = PARAMS["picard_alignmentsummarymetric_options"]
+    if PARAMS.get("picard_alignmentsummarymetrics_options"):
+        picard_options = PARAMS["picard_alignmentsummarymetrics_options"]
+    else:
+        picard_options = ""
     validation_stringency = PARAMS["picard_validation_stringency"]
 
     reference_sequence = os.path.join(PARAMS["txseq_annotations"],
@@ -361,39 +645,23 @@ def alignmentSummaryMetrics(infile, sentinel):
     if not os.path.exists(reference_sequence):
         raise ValueError("Reference sequence not found")
 
-    mktemp_template = "ctmp.CollectAlignmentSummaryMetrics.XXXXXXXXXX"
+    # the full Picard output (removed once the tables are written)
+    picard_out = t.out_file + ".picard"
 
-    statement = '''picard_out=`mktemp -p . %(mktemp_template)s`;
-                   %(picard_cmd)s CollectAlignmentSummaryMetrics
+    statement = '''%(picard_cmd)s CollectAlignmentSummaryMetrics
                    -I %(infile)s
-                   -O $picard_out
+                   -O %(picard_out)s
                    --REFERENCE_SEQUENCE %(reference_sequence)s
                    --VALIDATION_STRINGENCY %(validation_stringency)s
-                   %(picard_options)s;
-                   sed -e '1,/## HISTOGRAM/!d' $picard_out
-                   | grep . | grep -v "#"
-                   > %(out_file)s;
-                   rm $picard_out;
+                   %(picard_options)s
                 ''' % dict(PARAMS, **t.var, **locals())
 
     P.run(statement, **t.resources)
-    IOTools.touch_file(sentinel)
-
-
-@merge(alignmentSummaryMetrics,
-       "bam.qc.dir/qc_alignment_summary_metrics.load")
-def loadAlignmentSummaryMetrics(infiles, outfile):
-    '''
-    Load the complexity metrics to a single table in the project database.
-    '''
 
-    infiles = [x.replace(".sentinel", "") for x in infiles]
+    picard.write_metrics(picard_out, metrics_out=t.out_file)
+    os.remove(picard_out)
 
-    P.concatenate_and_load(
-        infiles, outfile,
-        regex_filename=".*/.*/(.*).alignment.summary.metrics",
-        cat="sample_id",
-        options='-i "sample_id"')
+    IOTools.touch_file(sentinel)
 
 
 # ------------------- Picard: InsertSizeMetrics ----------------------- #
@@ -404,7 +672,7 @@ def insert_size_jobs():
     
         if  S.samples[sample_id].paired == True:
     
-            yield([os.path.join(PARAMS["bam_path"], sample_id + ".bam"),
+            yield([bam_input(sample_id),
                    [os.path.join("bam.qc.dir/insert.size.metrics.dir/",
                                 sample_id + ".insert.size.metrics.summary.sentinel"),
                     os.path.join("bam.qc.dir/insert.size.metrics.dir/",
@@ -412,12 +680,19 @@ def insert_size_jobs():
                    ]])
 
 @active_if(PAIRED)
+@follows(subsampleBams, bamMetrics, collectMultipleMetrics)
 @files(insert_size_jobs)
 def insertSizeMetricsAndHistograms(infile, sentinels):
     '''
     Run Picard InsertSizeMetrics on the BAM files to
     collect summary metrics and histograms.'''
 
+    if NATIVE or PICARD_BATCH:
+        # the metrics were computed by bamMetrics or collectMultipleMetrics
+        for sentinel in sentinels:
+            IOTools.touch_file(sentinel)
+        return
+
     t = T.setup(infile, sentinels[0], PARAMS,
             memory=PARAMS["picard_memory"],
             cpu=PARAMS["picard_threads"])
@@ -438,64 +713,29 @@ def insertSizeMetricsAndHistograms(infile, sentinels):
     if not os.path.exists(reference_sequence):
         raise ValueError("Reference sequence not found")
 
-    mktemp_template = "ctmp.CollectInsertSizeMetrics.XXXXXXXXXX"
+    # the full Picard output (removed once the tables are written)
+    picard_out = picard_summary[:-len(".summary")] + ".picard"
 
-    statement = '''picard_out=`mktemp -p . %(mktemp_template)s`;
-                   %(picard_cmd)s CollectInsertSizeMetrics
+    statement = '''%(picard_cmd)s CollectInsertSizeMetrics
                    -I %(infile)s
-                   -O $picard_out
+                   -O %(picard_out)s
                    --Histogram_FILE %(picard_histogram_pdf)s
                    --VALIDATION_STRINGENCY %(validation_stringency)s
                    --REFERENCE_SEQUENCE %(reference_sequence)s
-                   %(picard_options)s;
-                   grep "MEDIAN_INSERT_SIZE" -A 1 $picard_out
-                   > %(picard_summary)s;
-                   sed -e '1,/## HISTOGRAM/d' $picard_out
-                   > %(picard_histogram)s;
-                   rm $picard_out;
+                   %(picard_options)s
                 ''' % dict(PARAMS, **t.var, **locals())
 
     P.run(statement, **t.resources)
-    
-    for sentinel in sentinels: 
-        IOTools.touch_file(sentinel)
-
-@active_if(PAIRED)
-@merge(insertSizeMetricsAndHistograms,
-       "bam.qc.dir/qc_insert_size_metrics.load")
-def loadInsertSizeMetrics(infiles, outfile):
-    '''
-    Load the insert size metrics to a single table of the project database.
-    '''
-
-    picard_summaries = [x[0].replace(".sentinel", "") for x in infiles]
-
-    P.concatenate_and_load(picard_summaries, outfile,
-                            regex_filename=(".*/.*/(.*)"
-                                            ".insert.size.metrics.summary"),
-                            cat="sample_id",
-                            options='')
-
-
-@active_if(PAIRED)
-@merge(insertSizeMetricsAndHistograms,
-       "bam.qc.dir/qc_insert_size_histogram.load")
-def loadInsertSizeHistograms(infiles, outfile):
-    '''
-    Load the histograms to a single table of the project database.
-    '''
-
-    picard_histograms = [x[1].replace(".sentinel", "") for x in infiles]
-
-    P.concatenate_and_load(
-        picard_histograms, outfile,
-        regex_filename=(".*/.*/(.*)"
-                        ".insert.size.metrics.histogram"),
-        cat="sample_id",
-        options='-i "insert_size" -e')
-
 
+    # the summary is reported for the first pair orientation (FR, RF, TANDEM)
+    picard.write_metrics(picard_out,
+                         metrics_out=picard_summary,
+                         histogram_out=picard_histogram,
+                         first_row=True)
+    os.remove(picard_out)
 
+    for sentinel in sentinels: 
+        IOTools.touch_file(sentinel)
 
 # --------------------- Fraction of spliced reads --------------------------- #
 
@@ -504,47 +744,107 @@ def fraction_spliced_jobs():
 
     for sample_id in S.samples.keys():
     
-        yield([os.path.join(PARAMS["bam_path"], sample_id + ".bam"),
+        yield([bam_input(sample_id),
                 os.path.join("bam.qc.dir/fraction.spliced.dir/",
                             sample_id + ".fraction.spliced.sentinel")])
 
+@follows(subsampleBams, bamMetrics)
 @files(fraction_spliced_jobs)
 def fractionSpliced(infile, sentinel):
     '''
     Compute fraction of reads containing a splice junction.
     * paired-endedness is ignored
     * only uniquely mapping reads are considered.
+
+    The BAM index is used to split the BAM file into regions that are
+    read in parallel. The fraction is also reported per contig.
     '''
-    
-    t = T.setup(infile, sentinel, PARAMS)
-
-    statement = '''echo "fraction_spliced" > %(out_file)s;
-                   samtools view %(infile)s
-                   | grep NH:i:1
-                   | cut -f 6
-                   | awk '{if(index($1,"N")==0){us+=1}
-                           else{s+=1}}
-                          END{print s/(us+s)}'
-                   >> %(out_file)s
+
+    if NATIVE:
+        # the fraction was computed by bamMetrics
+        IOTools.touch_file(sentinel)
+        return
+
+    t = T.setup(infile, sentinel, PARAMS,
+            memory=PARAMS["fraction_spliced_memory"],
+            cpu=PARAMS["fraction_spliced_threads"])
+
+    contigs_out = t.out_file + ".contigs"
+
+    statement = '''python %(txseq_code_dir)s/python/bam_fraction_spliced.py
+                   --bam=%(infile)s
+                   --processes=%(job_threads)s
+                   --outfile=%(out_file)s
+                   --contigsoutfile=%(contigs_out)s
+                   &> %(log_file)s
                  ''' % dict(PARAMS, **t.var, **locals())
 
     P.run(statement, **t.resources)
     IOTools.touch_file(sentinel)
 
 
-@merge(fractionSpliced,
-       "bam.qc.dir/qc_fraction_spliced.load")
-def loadFractionSpliced(infiles, outfile):
+# ------------------------ Load the QC metrics ------------------------------ #
+
+# The per-sample metrics files (by suffix) and the tables that they are
+# loaded to, with any indexes in addition to "sample_id".
+QC_TABLES = [(".rnaseq.metrics", "qc_rnaseq_metrics", []),
+             (".three.prime.bias", "qc_three_prime_bias", []),
+             (".library.complexity", "qc_library_complexity", []),
+             (".alignment.summary.metrics", "qc_alignment_summary_metrics", []),
+             (".insert.size.metrics.summary", "qc_insert_size_metrics", []),
+             (".insert.size.metrics.histogram", "qc_insert_size_histogram",
+              ["insert_size"]),
+             (".fraction.spliced", "qc_fraction_spliced", []),
+             (".fraction.spliced.contigs", "qc_fraction_spliced_contigs", [])]
+
+
+@merge([collectRnaSeqMetrics,
+        threePrimeBias,
+        estimateLibraryComplexity,
+        alignmentSummaryMetrics,
+        insertSizeMetricsAndHistograms,
+        fractionSpliced],
+       "bam.qc.dir/qc_metrics.load")
+def loadMetrics(infiles, outfile):
     '''
-    Load fractions of spliced reads to a single table of the project database.
+    Load all of the QC metrics tables to the project database in a
+    single transaction. The indexes are built after the rows are
+    inserted.
     '''
-    
-    infiles = [x.replace(".sentinel","") for x in infiles]
 
-    P.concatenate_and_load(infiles, outfile,
-                           regex_filename=".*/.*/(.*).fraction.spliced",
-                           cat="sample_id",
-                           options='-i "sample_id"')
+    metric_files = []
+
+    for infile in infiles:
+        # the insert size jobs have a list of outputs
+        if isinstance(infile, str):
+            infile = [infile]
+        metric_files += [x.replace(".sentinel", "") for x in infile]
+
+    # the outputs of inactive tasks (e.g. EstimateLibraryComplexity)
+    # are not present
+    metric_files = [x for x in metric_files if os.path.exists(x)]
+
+    # the per contig fractions are written alongside the fraction
+    # spliced tables
+    metric_files += [x + ".contigs" for x in metric_files
+                     if x.endswith(".fraction.spliced")]
+
+    loader = db.tableLoader(PARAMS["sqlite_file"],
+                            incremental=INCREMENTAL)
+
+    for file_suffix, table, indexes in QC_TABLES:
+
+        table_files = [x for x in metric_files if x.endswith(file_suffix)]
+
+        if len(table_files) == 0:
+            continue
+
+        loader.add(table, table_files,
+                   regex_filename=".*/(.*)" + re.escape(file_suffix) + "$",
+                   cat="sample_id",
+                   indexes=indexes)
+
+    db.write_load_log(outfile, loader.load())
 
 
 # ---------------- Prepare a post-mapping QC summary ------------------------ #
@@ -557,16 +857,12 @@ def loadSampleInformation(infile, outfile):
     Load the sample information table to the project database.
     '''
 
-    P.load(infile, outfile, options='-i "sample_id"')
+    db.concatenate_and_load([infile], outfile, PARAMS["sqlite_file"],
+                            cat=None, indexes=["sample_id"])
 
 
 @merge([loadSampleInformation,
-        loadCollectRnaSeqMetrics,
-        loadThreePrimeBias,
-        loadEstimateLibraryComplexity,
-        loadFractionSpliced,
-        loadAlignmentSummaryMetrics,
-        loadInsertSizeMetrics],
+        loadMetrics],
        "bam.qc.dir/qc_summary.txt")
 def qcSummary(infiles, outfile):
     '''
@@ -575,7 +871,6 @@ def qcSummary(infiles, outfile):
 
     # Some QC metrics are specific to paired end data
     if PAIRED:
-        exclude = []
         paired_columns = '''PCT_READS_ALIGNED_IN_PAIRS
                                        as pct_reads_aligned_in_pairs,
                               MEDIAN_INSERT_SIZE
@@ -584,7 +879,6 @@ def qcSummary(infiles, outfile):
         pcat = "PAIR"
    
     else:
-        exclude = ["qc_library_complexity", "qc_insert_size_metrics"]
         paired_columns = ''
         pcat = "UNPAIRED"
 
@@ -600,17 +894,63 @@ def qcSummary(infiles, outfile):
 
     # ESTIMATED_LIBRARY_SIZE as library_size,
 
-    tables = [P.to_table(x) for x in infiles
-              if P.to_table(x) not in exclude]
+    tables = ["samples", "qc_rnaseq_metrics", "qc_three_prime_bias"]
+
+    if PARAMS["run_estimateLibraryComplexity"] and PAIRED:
+        tables.append("qc_library_complexity")
+
+    tables += ["qc_fraction_spliced", "qc_alignment_summary_metrics"]
+
+    if PAIRED:
+        tables.append("qc_insert_size_metrics")
 
     t1 = tables[0]
 
+    # The number of trials (reads, bases or read pairs) from which each
+    # proportion was computed, for the confidence intervals (see below).
+    trials = {"fraction_spliced":
+                  ("qc_fraction_spliced",
+                   "qc_fraction_spliced.spliced + "
+                   "qc_fraction_spliced.unspliced"),
+              "pct_mrna":
+                  ("qc_rnaseq_metrics",
+                   "qc_rnaseq_metrics.PF_ALIGNED_BASES"),
+              "pct_coding":
+                  ("qc_rnaseq_metrics",
+                   "qc_rnaseq_metrics.PF_ALIGNED_BASES"),
+              "pct_reads_aligned":
+                  ("qc_alignment_summary_metrics",
+                   "qc_alignment_summary_metrics.PF_READS"),
+              "pct_adapter":
+                  ("qc_alignment_summary_metrics",
+                   "qc_alignment_summary_metrics.PF_READS"),
+              "pct_pf_reads_aligned_hq":
+                  ("qc_alignment_summary_metrics",
+                   "qc_alignment_summary_metrics.PF_READS"),
+              "pct_reads_aligned_in_pairs":
+                  ("qc_alignment_summary_metrics",
+                   "qc_alignment_summary_metrics.PF_READS_ALIGNED"),
+              "pct_duplication":
+                  ("qc_library_complexity",
+                   "qc_library_complexity.UNPAIRED_READS_EXAMINED + "
+                   "2 * qc_library_complexity.READ_PAIRS_EXAMINED")}
+
+    if SUBSAMPLE:
+        trials = {k: v for k, v in trials.items() if v[0] in tables}
+    else:
+        trials = {}
+
+    trial_columns = "".join(["%s as n_%s,\n" % (expression, column)
+                             for column, (table, expression)
+                             in trials.items()])
+
     stat_start = '''select distinct samples.*,
                                     fraction_spliced,
                                     three_prime_bias
                                        as three_prime_bias,
                                     %(paired_columns)s
                                     %(elc_columns)s
+                                    %(trial_columns)s
                                     PCT_MRNA_BASES
                                        as pct_mrna,
                                     PCT_CODING_BASES
@@ -637,6 +977,23 @@ def qcSummary(infiles, outfile):
     statement = "\n".join([stat_start, join_stat, where_stat])
 
     df = DB.fetch_DataFrame(statement, PARAMS["sqlite_file"])
+
+    # record the fraction of the reads that the metrics were computed on
+    df["sample_fraction"] = SAMPLE_FRACTION
+
+    # Add 95% confidence intervals for the proportions computed from
+    # the subsampled reads. Each interval uses the number of trials of
+    # its own metric, e.g. the aligned bases for the base-level
+    # proportions. As the bases of a read are not independent, the
+    # base-level intervals are narrower than the read-level ones.
+    for column in [x for x in trials.keys() if x in df.columns]:
+        low, high = binomial_ci(df[column].astype(float),
+                                df["n_" + column].astype(float))
+        df[column + "_ci_low"] = low
+        df[column + "_ci_high"] = high
+
+    df = df.drop(columns=["n_" + x for x in trials.keys()])
+
     df.to_csv(outfile, sep="\t", index=False)
 
 
@@ -648,10 +1005,11 @@ def loadQCSummary(infile, outfile):
     Load summary to project database.
     '''
 
-    P.load(infile, outfile)
+    db.concatenate_and_load([infile], outfile, PARAMS["sqlite_file"],
+                            cat=None)
 
 
-@follows(loadQCSummary, loadInsertSizeHistograms)
+@follows(loadQCSummary)
 def qc():
     '''
     Target for executing quality control.
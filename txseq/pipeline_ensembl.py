@@ -17,6 +17,8 @@ It performs the following tasks:
 #. Makes a transcript -> gene map for use with sample
 #. Makes a transcript information table that contains information on transcript and gene names and biotypes.
 
+The filtered GTF, transcript -> gene map and transcript information table are made in a single pass over the Ensembl GTF file.
+
 
 Configuration
 -------------
@@ -46,6 +48,8 @@ Output files
 The pipeline creates an "api" folder with the following files for use by downstream pipelines:
 
 #. api.dir/txseq.genome.fa.gz: a copy of the Ensembl primary assembly in which Y PAR regions are hard masked
+#. api.dir/txseq.genome.fa and api.dir/txseq.genome.fa.fai: (if the "uncompressed_genome" option is set) an uncompressed copy of txseq.genome.fa.gz and its samtools FASTA index
+#. api.dir/txseq.genome.contigs.txt: the names of the sequences in the txseq.genome.fa.gz file, one per line (e.g. for use as the Salmon decoys)
 #. api.dir/txseq.transcript.fa.gz: all records from the Ensembl cDNA and ncRNA transcript fasta files that are on primary contigs and not in the Y PAR region
 #. api.dir/txseq.geneset.gtf.gz: all records from the Ensembl gtf file that are on primary contigs and not in the Y PAR region
 #. api.dir/txseq.transcript.to.gene.map: a tab-seperated list of transcript_id -> gene_id mappings for use with Salmon
@@ -114,12 +118,21 @@ def hardMaskYPAR(infile, sentinel):
     t = T.setup(y_par_bed, sentinel, PARAMS)
 
     
+    if PARAMS.get("uncompressed_genome"):
+        # keep an uncompressed, indexed, copy of the genome
+        # (e.g. for hisat2-build)
+        compress = '''gzip -c %(out_file)s > %(out_file)s.gz;
+                      samtools faidx %(out_file)s;
+                   ''' % t.var
+    else:
+        compress = "gzip %(out_file)s;" % t.var
+
     statement = '''bedtools maskfasta
                    -fi <(zcat %(primary_assembly)s)
                    -fo %(out_file)s
                    -bed %(y_par_bed)s
                     &> %(log_file)s;
-                    gzip %(out_file)s;
+                    %(compress)s
                 ''' % dict(PARAMS, **t.var, **locals())
                 
     P.run(statement, **t.resources)
@@ -177,78 +190,51 @@ def filteredTranscriptFasta(infiles, sentinel):
 @transform(contigs,
            regex(r".*.sentinel"),
            add_inputs(extractYPAR),
-           "filtered.geneset.gtf.gz.sentinel")
-def filteredGTF(infiles, sentinel):
+           ["filtered.geneset.gtf.gz.sentinel",
+            "transcript.to.gene.map.sentinel",
+            "transcript.info.tsv.gz.sentinel"])
+def filteredGTF(infiles, sentinels):
     '''
     Filter the ensembl geneset to exclude genes on non primary contigs
     and genes in the Y PAR region.
+
+    The transcript -> gene map (for use by salmon) and the transcript
+    information table are made in the same pass over the GTF file. The
+    map is made from the filtered geneset and the transcript information
+    from the full geneset.
     '''
     
     contig_file_sentinel, ypar = infiles
     contig_file = contig_file_sentinel.replace(".sentinel","")
 
-    t = T.setup(contig_file, sentinel, PARAMS)
-        
-    statement='''python %(txseq_code_dir)s/python/ensembl_filter_gtf.py
-                 --ensemblgtf=%(geneset)s
-                 --contigs=%(contig_file)s
-                 --mask=%(ypar)s
-                 --outfile=%(out_file)s
-                 &> %(log_file)s
-              ''' % dict(PARAMS, **t.var, **locals())
-    
-    P.run(statement, **t.resources)
-    IOTools.touch_file(sentinel)
-
+    gtf_sentinel, tx2gene_sentinel, txinfo_sentinel = sentinels
 
-@transform(filteredGTF,
-           regex(r".*.sentinel"),
-           "transcript.to.gene.map.sentinel")
-def transcriptToGeneMap(infile, sentinel):
-    '''
-    Make a map of transcripts to genes for use by salmon
-    '''
-    
-    gtf = infile.replace(".sentinel","")
+    t = T.setup(contig_file, gtf_sentinel, PARAMS)
 
-    t = T.setup(gtf, sentinel, PARAMS)
+    tx2gene = tx2gene_sentinel.replace(".sentinel", "")
+    txinfo = txinfo_sentinel.replace(".sentinel", "")
         
-    statement='''zgrep transcript %(gtf)s
-                 | sed 's/.*gene_id "\\([^"]*\\)".*transcript_id "\\([^"]*\\)".*$/\\2\\\t\\1/g' 
-                 | sort -u > %(out_file)s
-              ''' % dict(PARAMS, **t.var, **locals())
-    
-    P.run(statement, **t.resources)
-    IOTools.touch_file(sentinel) 
-    
-@transform(filteredGTF,
-           regex(r".*.sentinel"),
-           "transcript.info.tsv.gz.sentinel")
-def transcriptInfo(infile, sentinel):
-    '''
-    Extract transcript information from the GTF
-    '''
-    
-    gtf = infile.replace(".sentinel","")
-
-    t = T.setup(gtf, sentinel, PARAMS)
-        
-    statement='''python %(txseq_code_dir)s/python/ensembl_extract_gtf_attributes.py
+    statement='''python %(txseq_code_dir)s/python/ensembl_build_geneset.py
                  --ensemblgtf=%(geneset)s
+                 --contigs=%(contig_file)s
+                 --mask=%(ypar)s
                  --attributes=transcript_id,transcript_name,transcript_biotype,gene_id,gene_name,gene_biotype
-                 --outfile=%(out_file)s
+                 --outgtf=%(out_file)s
+                 --outtx2gene=%(tx2gene)s
+                 --outtxinfo=%(txinfo)s
                  &> %(log_file)s
               ''' % dict(PARAMS, **t.var, **locals())
     
     P.run(statement, **t.resources)
-    IOTools.touch_file(sentinel) 
+
+    for sentinel in sentinels:
+        IOTools.touch_file(sentinel)
 
 
 @follows(hardMaskYPAR,
+         contigs,
          filteredTranscriptFasta,
-         filteredGTF,
-         transcriptToGeneMap,
-         transcriptInfo)
+         filteredGTF)
 @files(None,"api.sentinel")
 def api(infile, sentinel):
 
@@ -262,6 +248,19 @@ def api(infile, sentinel):
     
     os.symlink(os.path.join("..",pa), 
                os.path.join("api.dir","txseq.genome.fa.gz"))
+
+    if os.path.exists(pa[:-len(".gz")] + ".fai"):
+        for suffix in ["", ".fai"]:
+            os.symlink(os.path.join("..", pa[:-len(".gz")] + suffix),
+                       os.path.join("api.dir", "txseq.genome.fa" + suffix))
+
+    contig_file = "contigs"
+
+    if not os.path.exists(contig_file):
+        raise ValueError("primary assembly contigs file not found")
+
+    os.symlink(os.path.join("..", contig_file),
+               os.path.join("api.dir", "txseq.genome.contigs.txt"))
     
     txfa = "filtered.transcripts.fa.gz"
     
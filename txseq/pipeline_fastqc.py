@@ -44,7 +44,7 @@ Output files
 
 The pipeline produces the following outputs:
 
-#. fastqc results: for each FASTQ file in the "fastqc.dir" sub-folder
+#. fastqc results: for each FASTQ file in the "fastqc.dir" sub-folder. The FastQC zip archives are not extracted: the summary tables are made from the "fastqc_data.txt" file read directly from each archive, which is parsed once (see "fastqc.summary.dir/fastqc_sections.pickle").
 #. An sqlite database: in a file named "csvdb" which contain summary tables of the fastqc results e.g. for plotting in R.
 
 .. note::
@@ -95,8 +95,9 @@ PARAMS["txseq_code_dir"] = Path(__file__).parents[1]
 
 if len(sys.argv) > 1:
     if(sys.argv[1] == "make"):
-        S = T.samples(sample_tsv = PARAMS["samples"],
-                      library_tsv = PARAMS["libraries"])
+        S = T.load_samples(sample_tsv = PARAMS["samples"],
+                      library_tsv = PARAMS["libraries"],
+                      manifest = "fastq.manifest.tsv")
 
 # ########################################################################### #
 # ############################ Run FASTQC  ################################## #
@@ -138,7 +139,6 @@ def fastqc(infile, outfile):
 
     statement = '''fastqc 
                    -o %(out_path)s
-                   --extract
                    %(contaminants)s
                    %(adaptors)s
                    %(limits)s
@@ -150,23 +150,42 @@ def fastqc(infile, outfile):
     IOTools.touch_file(outfile)
 
 
-@split(fastqc, ["fastqc.summary.dir/fastqc_basic_statistics.tsv.gz", 
-                "fastqc.summary.dir/fastqc_*.tsv.gz"])
-def summarizeFastQC(infiles, outfiles):
-
-    t = T.setup(infiles[0], outfiles[0], PARAMS)
+def fastqc_files(infiles):
+    '''return the FastQC zip archives for the fastqc task sentinels'''
 
     all_files = []
 
     for infile in infiles:
 
         track = P.snip(infile, ".sentinel")
-        all_files.extend(glob.glob(
-            os.path.join(track, "*_fastqc",
-                         "fastqc_data.txt")))
+        all_files.extend(readqc.find_fastqc_files(os.path.join(track, "")))
+
+    return all_files
+
+
+@merge(fastqc, "fastqc.summary.dir/fastqc_sections.pickle")
+def parseFastQC(infiles, outfile):
+    '''
+    Parse the FastQC results (read from the zip archives) once for
+    the summary tasks.
+    '''
+
+    t = T.setup(infiles[0], outfile, PARAMS)
+
+    readqc.parse_fastqc(fastqc_files(infiles), outfile)
+
+
+@follows(parseFastQC)
+@split(fastqc, ["fastqc.summary.dir/fastqc_basic_statistics.tsv.gz", 
+                "fastqc.summary.dir/fastqc_*.tsv.gz"])
+def summarizeFastQC(infiles, outfiles):
+
+    t = T.setup(infiles[0], outfiles[0], PARAMS)
+
+    readqc.load_fastqc_sections("fastqc.summary.dir/fastqc_sections.pickle")
 
     dfs = readqc.read_fastqc(
-        all_files)
+        fastqc_files(infiles))
 
     for key, df in dfs.items():
         fn = re.sub("basic_statistics", key, outfiles[0])
@@ -175,10 +194,12 @@ def summarizeFastQC(infiles, outfiles):
             df.to_csv(outf, sep="\t", index=True)
 
 
+@follows(parseFastQC)
 @merge(fastqc, 
        "fastqc.summary.dir/fastqc_status_summary.tsv.gz")
 def buildFastQCSummaryStatus(infiles, outfile):
     '''load FastQC status summaries into a single table.'''
+    readqc.load_fastqc_sections("fastqc.summary.dir/fastqc_sections.pickle")
     readqc.buildFastQCSummaryStatus(
         infiles,
         outfile,
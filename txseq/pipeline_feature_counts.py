@@ -82,9 +82,12 @@ PARAMS = P.get_parameters(T.get_parameter_file(__file__))
 # set the location of the code directory
 PARAMS["txseq_code_dir"] = Path(__file__).parents[1]
 
+# only (re)load the new or changed per-sample outputs
+INCREMENTAL = bool(PARAMS.get("sqlite_incremental"))
+
 if len(sys.argv) > 1:
     if(sys.argv[1] == "make"):
-        S = T.samples(sample_tsv = PARAMS["samples"],
+        S = T.load_samples(sample_tsv = PARAMS["samples"],
                       library_tsv = None)
         
         # Set the database location
@@ -109,12 +112,13 @@ def count(infile, sentinel):
     Run featureCounts.
     '''
 
-    t = T.setup(infile, sentinel, PARAMS,
-            cpu=PARAMS["featurecounts_threads"])
-
     sample_id = os.path.basename(infile)[:-len(".bam")]
     sample = S.samples[sample_id]
 
+    t = T.setup(infile, sentinel, PARAMS,
+            cpu=PARAMS["featurecounts_threads"],
+            sample=sample_id)
+
     # set featureCounts options
     featurecounts_strand = sample.featurecounts_strand
 
@@ -162,15 +166,32 @@ def loadCounts(infiles, outfile):
     Combine and load count data in the project database.
     '''
     
-    infiles = [x.replace(".sentinel", ".gz") for x in infiles]
+    t = T.setup(infiles[0], outfile, PARAMS,
+                memory=PARAMS["sqlite_himem"],
+                cpu=1)
+
+    tables = " ".join([x.replace(".sentinel", ".gz") for x in infiles])
+
+    database = DATABASE
+    load_log = outfile + ".log"
+
+    # only load the new or changed samples to the existing table
+    incremental = "--incremental" if INCREMENTAL else ""
+
+    statement = '''python %(txseq_code_dir)s/python/db_concatenate_and_load.py
+                   --database=%(database)s
+                   --outfile=%(outfile)s
+                   --regex-filename=".*/(.*).counts.gz"
+                   --no-titles
+                   --cat=track
+                   --header=track,gene_id,counts
+                   --index=gene_id
+                   %(incremental)s
+                   %(tables)s
+                   &> %(load_log)s
+                ''' % dict(PARAMS, **t.var, **locals())
 
-    P.concatenate_and_load(infiles, outfile,
-                           regex_filename=".*/(.*).counts.gz",
-                           has_titles=False,
-                           cat="track",
-                           header="track,gene_id,counts",
-                           options='-i "gene_id"',
-                           job_memory=PARAMS["sqlite_himem"])
+    P.run(statement, **t.resources)
 
 
 @files(loadCounts,
@@ -187,10 +208,19 @@ def geneCounts(infile, outfile):
 
     database = DATABASE
 
+    chunksize = ""
+    if PARAMS["matrix_chunksize"]:
+        chunksize = "--chunksize=%s" % PARAMS["matrix_chunksize"]
+
+    # update the existing table with the samples that were (re)loaded
+    incremental = "--incremental" if INCREMENTAL else ""
+
     statement = '''python %(txseq_code_dir)s/python/feature_counts_table.py
                    --database=%(database)s
                    --table=%(table)s
                    --outfile=%(out_file)s.tsv.gz
+                   %(chunksize)s
+                   %(incremental)s
                    &> %(log_file)s
                 ''' % dict(PARAMS, **t.var, **locals())
               
@@ -85,8 +85,9 @@ PARAMS["txseq_code_dir"] = Path(__file__).parents[1]
 
 if len(sys.argv) > 1:
     if(sys.argv[1] == "make"):
-        S = T.samples(sample_tsv = PARAMS["samples"],
-                      library_tsv = PARAMS["libraries"])
+        S = T.load_samples(sample_tsv = PARAMS["samples"],
+                      library_tsv = PARAMS["libraries"],
+                      manifest = "fastq.manifest.tsv")
 
 
 # ---------------------- < specific pipeline tasks > ------------------------ #
@@ -108,14 +109,16 @@ def firstPass(infile, sentinel):
     Run a first hisat pass to identify novel splice sites.
     '''
 
-    t = T.setup(infile, sentinel, PARAMS,
-                memory=PARAMS["hisat_memory"],
-                cpu=PARAMS["hisat_threads"])
-    
     sample_id = os.path.basename(sentinel)[:-len(".sentinel")]
 
     sample = S.samples[sample_id]
 
+    t = T.setup(infile, sentinel, PARAMS,
+                memory=PARAMS["hisat_memory"],
+                cpu=PARAMS["hisat_threads"],
+                sample=sample_id,
+                inputs=sample.fastq["read1"] + sample.fastq.get("read2", []))
+
     if sample.paired:
         fastq_input = "-1 " + ",".join(sample.fastq["read1"]) +\
                       " -2 " + ",".join(sample.fastq["read2"])
@@ -152,7 +155,10 @@ def firstPass(infile, sentinel):
                     gzip %(novel_ss_outfile)s
                 ''' % dict(PARAMS, **t.var, **locals())
 
-    P.run(statement, **t.resources)
+    # jobs killed for exceeding their memory limit are resubmitted
+    # (if enabled, see txseq.tasks.setup)
+    t.run(statement, PARAMS)
+
     IOTools.touch_file(sentinel) 
 
 
@@ -198,14 +204,16 @@ def secondPass(infile, sentinel):
     Align reads using HISAT with known and novel junctions.
     '''
 
-    t = T.setup(infile, sentinel, PARAMS,
-                memory=PARAMS["hisat_memory"],
-                cpu=PARAMS["hisat_threads"])
-    
     sample_id = os.path.basename(sentinel)[:-len(".sentinel")]
 
     sample = S.samples[sample_id]
 
+    t = T.setup(infile, sentinel, PARAMS,
+                memory=PARAMS["hisat_memory"],
+                cpu=PARAMS["hisat_threads"],
+                sample=sample_id,
+                inputs=sample.fastq["read1"] + sample.fastq.get("read2", []))
+
     if sample.paired:
         fastq_input = "-1 " + ",".join(sample.fastq["read1"]) +\
                       " -2 " + ",".join(sample.fastq["read2"])
@@ -238,7 +246,10 @@ def secondPass(infile, sentinel):
                    rm -rf $sort_dir;
                  ''' % dict(PARAMS, **t.var, **locals())
 
-    P.run(statement, **t.resources)
+    # jobs killed for exceeding their memory limit are resubmitted
+    # (if enabled, see txseq.tasks.setup)
+    t.run(statement, PARAMS)
+
     IOTools.touch_file(sentinel) 
 
 # --------------------- < generic pipeline tasks > -------------------------- #
@@ -28,6 +28,15 @@ For building the  index the pipeline requires:
 #. A gzip compressed FASTA file containing the genome primary assembly sequences.
 #. A gzip compressed GTF file containing the transcript information.
 
+hisat2-build requires an uncompressed genome. If an uncompressed copy of
+the primary assembly with a FASTA index is present alongside it (e.g.
+"api.dir/txseq.genome.fa" and "api.dir/txseq.genome.fa.fai" as prepared
+by :doc:`pipeline_ensembl.py </pipelines/pipeline_ensembl>`), it is
+used directly. Otherwise, if the "cache_dir" option is set, the genome is
+decompressed (and indexed with samtools faidx) once into the shared
+cache. Failing both, it is decompressed to a temporary file for the
+build.
+
 The location of these files must be specified in the 'pipeline_index.yml' file.
 
 Requirements
@@ -36,6 +45,7 @@ Requirements
 The following software is required:
 
 #. Hisat2
+#. samtools (if the genome is decompressed into the cache)
 
 
 Output files
@@ -43,12 +53,19 @@ Output files
 
 The pipeline generates a hisat2 HGFM index in the current folder.
 
+If the "cache_dir" option is set, the index files are symlinked from a
+shared cache directory (see :mod:`txseq.tasks.cache`). The cache is
+keyed by the contents of the input files, the hisat2-build version and
+the options, so the index is only built once for the same inputs.
+
 Code
 ====
 
 """
 from ruffus import *
 import sys
+import os
+from pathlib import Path
 
 # import CGAT-core pipeline functions
 from cgatcore import pipeline as P
@@ -56,6 +73,7 @@ import cgatcore.iotools as IOTools
 
 # Import txseq utility functions
 import txseq.tasks as T
+import txseq.tasks.cache as cache
 
 # ----------------------- < pipeline configuration > ------------------------ #
 
@@ -66,58 +84,109 @@ P.control.write_config_files = T.write_config_files
 P.parameters.HAVE_INITIALIZED = False
 PARAMS = P.get_parameters(T.get_parameter_file(__file__))
 
+# set the location of the code directory
+PARAMS["txseq_code_dir"] = Path(__file__).parents[1]
+
 
 # ---------------------- < specific pipeline tasks > ------------------------ #
 
 @files(PARAMS["geneset"],
-       "genome.ss.sentinel")
-def spliceSites(infile, sentinel):
+       ["genome.ss.sentinel",
+        "genome.exon.sentinel"])
+def spliceSitesAndExons(infile, sentinels):
     '''
-    Extract the splice sites
+    Extract the splice sites and the exons in a single pass of the GTF.
     '''
 
-    t = T.setup(infile, sentinel, PARAMS,
+    t = T.setup(infile, sentinels[0], PARAMS,
                 memory="32G",
                 cpu=1,
                 make_outdir=False)
 
-    statement = '''hisat2_extract_splice_sites.py 
-                   <(zcat %(infile)s) 
-                   > %(out_file)s
+    ss, exons = [x.replace(".sentinel", "") for x in sentinels]
+
+    statement = '''python %(txseq_code_dir)s/python/hisat_extract_splice_sites_exons.py
+                   --gtf=%(infile)s
+                   --exons=%(exons)s
+                   --splicesites=%(ss)s
+                   &> %(log_file)s
                 ''' % dict(PARAMS, **t.var, **locals())
 
     P.run(statement, **t.resources)
-    IOTools.touch_file(sentinel)
 
+    for sentinel in sentinels:
+        IOTools.touch_file(sentinel)
 
-@files(PARAMS["geneset"],
-       "genome.exon.sentinel")
-def exons(infile, sentinel):
+
+def uncompressed_genome():
     '''
-    Extract the exons.
+    Return the path of an uncompressed, faidx indexed, copy of the
+    primary assembly (e.g. "api.dir/txseq.genome.fa" as prepared by
+    pipeline_ensembl) if there is one, otherwise None.
     '''
 
-    t = T.setup(infile, sentinel, PARAMS,
-                memory="32G",
-                cpu=1,
-                make_outdir=False)
+    fasta = PARAMS["primary_assembly"]
 
-    statement = '''hisat2_extract_exons.py 
-                   <(zcat %(infile)s) 
-                   > %(out_file)s
-                ''' % dict(PARAMS, **t.var, **locals())
+    if fasta.endswith(".gz"):
+        fasta = fasta[:-len(".gz")]
 
-    P.run(statement, **t.resources)
-    IOTools.touch_file(sentinel)
+    if os.path.exists(fasta) and os.path.exists(fasta + ".fai"):
+        return(os.path.abspath(fasta))
+
+    return(None)
+
+
+def cached_genome(index_cache):
+    '''
+    Return the path of an uncompressed, faidx indexed, copy of the
+    primary assembly in the index cache. The genome is only decompressed
+    once for all of the projects that use the cache.
+    '''
+
+    key = index_cache.key({"primary_assembly": PARAMS["primary_assembly"]},
+                          options={"content": "uncompressed genome",
+                                   "faidx": True})
+
+    with index_cache.lock(key):
+
+        if not index_cache.exists(key):
+
+            build_dir = index_cache.build_dir(key)
+            genome = os.path.join(build_dir, "genome.fa")
+
+            t = T.setup(PARAMS["primary_assembly"], genome, PARAMS,
+                        memory="4G",
+                        cpu=1,
+                        make_outdir=False)
 
+            primary_assembly = os.path.abspath(PARAMS["primary_assembly"])
 
-@transform(spliceSites,
-           regex(r"genome.ss.sentinel"),
-           add_inputs(exons),
-           "genome_tran.sentinel")
+            statement = '''zcat %(primary_assembly)s
+                           > %(genome)s;
+                           samtools faidx %(genome)s
+                        ''' % dict(PARAMS, **t.var, **locals())
+
+            P.run(statement, **t.resources)
+
+            index_cache.store(key, build_dir,
+                              info={"primary_assembly":
+                                    PARAMS["primary_assembly"]})
+
+    return(os.path.join(index_cache.path(key), "genome.fa"))
+
+
+@follows(spliceSitesAndExons)
+@files(["genome.ss.sentinel",
+        "genome.exon.sentinel"],
+       "genome_tran.sentinel")
 def transcriptomeIndex(infiles, sentinel):
     '''
     Generate a HGFM index with transcripts. 
+
+    If a cache directory is configured, the index is taken from (or
+    built into) the shared cache, keyed by the contents of the primary
+    assembly and of the splice site and exon files passed to
+    hisat2-build, the hisat2-build version and the options.
     '''
     
     t = T.setup(infiles[0], sentinel, PARAMS,
@@ -128,23 +197,82 @@ def transcriptomeIndex(infiles, sentinel):
     ss, exons  = [ x.replace(".sentinel", "") for x in infiles]
     
     options = ''
-    if not PARAMS['options'] is None:
+    if not PARAMS.get('options') is None:
         options = PARAMS['options']
+
+    genome = uncompressed_genome()
+
+    if not PARAMS.get("cache_dir"):
+        build_index(".", t, ss, exons, options, genome)
+        IOTools.touch_file(sentinel)
+        return
+
+    index_cache = cache.indexCache(PARAMS["cache_dir"])
+
+    # the splice sites and exons are hashed (rather than the geneset)
+    # as they are the inputs of hisat2-build: a change to how they are
+    # extracted from the geneset gives a new index.
+    key = index_cache.key({"primary_assembly": PARAMS["primary_assembly"],
+                           "splice_sites": ss,
+                           "exons": exons},
+                          version=cache.tool_version("hisat2-build"),
+                          options={"options": options})
+
+    # concurrent projects wait for a single build of the same index
+    with index_cache.lock(key):
+
+        if not index_cache.fetch(key, "."):
+
+            if genome is None:
+                genome = cached_genome(index_cache)
+
+            build_dir = index_cache.build_dir(key)
+            build_index(build_dir, t, ss, exons, options, genome)
+
+            index_cache.store(key, build_dir,
+                              info={"primary_assembly":
+                                    PARAMS["primary_assembly"],
+                                    "geneset": PARAMS["geneset"],
+                                    "splice_sites": os.path.abspath(ss),
+                                    "exons": os.path.abspath(exons)})
+            index_cache.fetch(key, ".")
+
+    IOTools.touch_file(sentinel)
+
+
+def build_index(outdir, t, ss, exons, options, genome=None):
+    '''
+    Build the HGFM index "genome_tran" in *outdir* from the uncompressed
+    *genome* FASTA file. If no *genome* is given, the primary assembly
+    is decompressed to a temporary file in *outdir*.
+    '''
+
+    # the statement is run in the output directory
+    ss = os.path.abspath(ss)
+    exons = os.path.abspath(exons)
+
+    if genome is None:
+        # It is necessary to unzip the genome fasta file.
+        primary_assembly = os.path.abspath(PARAMS["primary_assembly"])
+        genome_statement = "zcat %(primary_assembly)s > genome.fa;" % locals()
+        cleanup_statement = "rm genome.fa;"
+        genome = "genome.fa"
+    else:
+        genome_statement = ""
+        cleanup_statement = ""
     
-    # It is necessary to unzip the genome fasta file.
-    
-    statement = '''zcat %(primary_assembly)s > genome.fa;
+    statement = '''cd %(outdir)s;
+                   %(genome_statement)s
                    hisat2-build 
                    -p %(resources_threads)s 
                    --exon %(exons)s
                    --ss %(ss)s
-                   genome.fa
+                   %(genome)s
                    genome_tran;
-                   rm genome.fa;
+                   %(cleanup_statement)s
                 ''' % dict(PARAMS, **t.var, **locals())
                 
     P.run(statement, **t.resources)
-    IOTools.touch_file(sentinel)    
 
 
 # --------------------- < generic pipeline tasks > -------------------------- #
@@ -42,6 +42,7 @@ Output files
 The pipeline produces the following outputs:
 
 #. per-sample salmon quantification results in the "salmon.dir" folder
+#. TPM, NumReads and EffectiveLength matrices (features x samples) for genes and transcripts in the "salmon.dir" folder, in a columnar format (parquet by default). These are built when "run_long_tables" is False or "run_matrices" is True
 #. a csvdb sqlite database that contains tables of gene and transcript counts and TPMs
 
 .. note::
@@ -73,6 +74,7 @@ import cgatcore.iotools as IOTools
 
 # import local pipeline utility functions
 import txseq.tasks as T
+import txseq.tasks.matrix as matrix
 
 # ----------------------- < pipeline configuration > ------------------------ #
 
@@ -84,13 +86,24 @@ P.parameters.HAVE_INITIALIZED = False
 PARAMS = P.get_parameters(T.get_parameter_file(__file__))
 PARAMS["txseq_code_dir"] = Path(__file__).parents[1]
 
+# only (re)load the new or changed per-sample outputs
+INCREMENTAL = bool(PARAMS.get("sqlite_incremental"))
+
+# Load the long per-sample tables into the database?
+LONG_TABLES = PARAMS["run_long_tables"]
+
+# Build the TPM, NumReads and EffectiveLength matrices? These are needed
+# for the wide TPM tables when the long tables are not loaded.
+MATRICES = PARAMS.get("run_matrices") or not LONG_TABLES
+
 
 if len(sys.argv) > 1:
     if(sys.argv[1] == "make"):
         
         # set the location of the code directory 
-        S = T.samples(sample_tsv = PARAMS["samples"],
-                            library_tsv = PARAMS["libraries"])
+        S = T.load_samples(sample_tsv = PARAMS["samples"],
+                            library_tsv = PARAMS["libraries"],
+                            manifest = "fastq.manifest.tsv")
         
         # Set the database location
         DATABASE = PARAMS["sqlite"]["file"]
@@ -115,11 +128,14 @@ def quant(infile, outfile):
     Per sample quantitation using salmon.
     '''
     
+    sample_id = os.path.basename(outfile)[:-len(".sentinel")]
+    sample = S.samples[sample_id]
+
     t = T.setup(infile, outfile, PARAMS,
                 memory=PARAMS["salmon_memory"],
-                cpu=PARAMS["salmon_threads"])
-
-    sample = S.samples[os.path.basename(outfile)[:-len(".sentinel")]]
+                cpu=PARAMS["salmon_threads"],
+                sample=sample_id,
+                inputs=sample.fastq["read1"] + sample.fastq.get("read2", []))
 
     if sample.paired:
         fastq_input = "-1 " + " ".join(sample.fastq["read1"]) +\
@@ -148,10 +164,69 @@ def quant(infile, outfile):
                     &> %(log_file)s;
               ''' % dict(PARAMS, **t.var, **locals())
               
-    P.run(statement, **t.resources)
+    # jobs killed for exceeding their memory limit are resubmitted
+    # (if enabled, see txseq.tasks.setup)
+    t.run(statement, PARAMS)
     
     IOTools.touch_file(outfile)
 
+# ---------------------- Salmon quantification matrices --------------------- #
+
+def salmon_matrix_jobs():
+
+    infiles = [os.path.join("salmon.dir", sample_id + ".sentinel")
+               for sample_id in S.samples.keys()]
+
+    for level in ["transcripts", "genes"]:
+
+        yield([infiles,
+               os.path.join("salmon.dir",
+                            "salmon." + level + ".matrices.sentinel")])
+
+@active_if(MATRICES)
+@follows(quant)
+@files(salmon_matrix_jobs)
+def salmonMatrices(infiles, sentinel):
+    '''
+    Build TPM, NumReads and EffectiveLength matrices (features x samples)
+    directly from the per-sample salmon quant.sf or quant.genes.sf files.
+    '''
+
+    t = T.setup(infiles[0], sentinel, PARAMS,
+                memory=PARAMS["matrix_memory"],
+                cpu=PARAMS["matrix_threads"])
+
+    if "transcripts" in sentinel:
+        quant_file = "quant.sf"
+        id_name = "transcript_id"
+    else:
+        quant_file = "quant.genes.sf"
+        id_name = "gene_id"
+
+    sample_ids = ",".join([os.path.basename(x)[:-len(".sentinel")]
+                           for x in infiles])
+
+    out_prefix = sentinel[:-len(".matrices.sentinel")]
+
+    statement = '''python %(txseq_code_dir)s/python/salmon_quant_matrices.py
+                   --salmondir=salmon.dir
+                   --samples=%(sample_ids)s
+                   --quantfile=%(quant_file)s
+                   --idname=%(id_name)s
+                   --format=%(matrix_format)s
+                   --threads=%(job_threads)s
+                   --outprefix=%(out_prefix)s
+                   &> %(log_file)s
+                ''' % dict(PARAMS, **t.var, **locals())
+
+    P.run(statement, **t.resources)
+
+    IOTools.touch_file(sentinel)
+
+
+# -------------------------- Salmon long tables ----------------------------- #
+
+@active_if(LONG_TABLES)
 @merge(quant, 
        "salmon.dir/salmon.transcripts.sentinel")
 def loadSalmonTranscriptQuant(infiles, sentinel):
@@ -159,18 +234,34 @@ def loadSalmonTranscriptQuant(infiles, sentinel):
     Load the salmon transcript-level results.
     '''
 
-    tables = [x.replace(".sentinel", "/quant.sf") for x in infiles]
+    t = T.setup(infiles[0], sentinel, PARAMS,
+                memory=PARAMS["sqlite_himem"],
+                cpu=1)
 
-    outfile = sentinel.replace(".sentinel",".load")
+    tables = " ".join([x.replace(".sentinel", "/quant.sf") for x in infiles])
+
+    load_file = sentinel.replace(".sentinel",".load")
+    database = DATABASE
+
+    # only load the new or changed samples to the existing table
+    incremental = "--incremental" if INCREMENTAL else ""
+
+    statement = '''python %(txseq_code_dir)s/python/db_concatenate_and_load.py
+                   --database=%(database)s
+                   --outfile=%(load_file)s
+                   --regex-filename=".*/(.*)/quant.sf"
+                   --cat=sample_id
+                   --index=Name
+                   %(incremental)s
+                   %(tables)s
+                   &> %(log_file)s
+                ''' % dict(PARAMS, **t.var, **locals())
+
+    P.run(statement, **t.resources)
 
-    P.concatenate_and_load(tables, outfile,
-                           regex_filename=".*/(.*)/quant.sf",
-                           cat="sample_id",
-                           options="-i Name -i sample_id",
-                           job_memory=PARAMS["sqlite_himem"])
-    
     IOTools.touch_file(sentinel)
 
+@active_if(LONG_TABLES)
 @follows(loadSalmonTranscriptQuant)
 @merge(quant, "salmon.dir/salmon.genes.sentinel")
 def loadSalmonGeneQuant(infiles, sentinel):
@@ -178,18 +269,36 @@ def loadSalmonGeneQuant(infiles, sentinel):
     Load the salmon gene-level results.
     '''
 
-    tables = [x.replace(".sentinel", "/quant.genes.sf") for x in infiles]
-    outfile = sentinel.replace(".sentinel",".load")
+    t = T.setup(infiles[0], sentinel, PARAMS,
+                memory=PARAMS["sqlite_himem"],
+                cpu=1)
+
+    tables = " ".join([x.replace(".sentinel", "/quant.genes.sf")
+                       for x in infiles])
+
+    load_file = sentinel.replace(".sentinel",".load")
+    database = DATABASE
+
+    # only load the new or changed samples to the existing table
+    incremental = "--incremental" if INCREMENTAL else ""
+
+    statement = '''python %(txseq_code_dir)s/python/db_concatenate_and_load.py
+                   --database=%(database)s
+                   --outfile=%(load_file)s
+                   --regex-filename=".*/(.*)/quant.genes.sf"
+                   --cat=sample_id
+                   --index=Name
+                   %(incremental)s
+                   %(tables)s
+                   &> %(log_file)s
+                ''' % dict(PARAMS, **t.var, **locals())
+
+    P.run(statement, **t.resources)
 
-    P.concatenate_and_load(tables, outfile,
-                           regex_filename=".*/(.*)/quant.genes.sf",
-                           cat="sample_id",
-                           options="-i Name -i sample_id",
-                           job_memory=PARAMS["sqlite_himem"])
-    
     IOTools.touch_file(sentinel)
 
 
+@active_if(LONG_TABLES)
 @jobs_limit(1)
 @transform([loadSalmonTranscriptQuant,
             loadSalmonGeneQuant],
@@ -214,11 +323,20 @@ def salmonTPMs(infile, outfile):
     else:
         raise ValueError("Unexpected Salmon table name")
 
+    chunksize = ""
+    if PARAMS["matrix_chunksize"]:
+        chunksize = "--chunksize=%s" % PARAMS["matrix_chunksize"]
+
+    # update the existing table with the samples that were (re)loaded
+    incremental = "--incremental" if INCREMENTAL else ""
+
     statement = '''python %(txseq_code_dir)s/python/salmon_fetch_tpms.py
                    --database=%(database)s
                    --table=%(table)s
                    --idname=%(id_name)s
                    --outfile=%(out_file)s.txt.gz
+                   %(chunksize)s
+                   %(incremental)s
                    &> %(log_file)s
                 ''' % dict(PARAMS, **t.var, **locals())
               
@@ -227,9 +345,46 @@ def salmonTPMs(infile, outfile):
     IOTools.touch_file(outfile)
 
 
+@active_if(not LONG_TABLES)
+@transform(salmonMatrices,
+           regex(r"(.*)/(.*).matrices.sentinel"),
+           r"\1/\2.tpms.sentinel")
+def salmonMatrixTPMs(infile, outfile):
+    '''
+    Prepare the wide table of salmon TPMs from the TPM matrix when the
+    long tables are not loaded into the database.
+    '''
+
+    t = T.setup(infile, outfile, PARAMS,
+                memory=PARAMS["matrix_memory"],
+                cpu=1)
+
+    tpm_matrix = matrix.matrix_path(
+        infile.replace(".matrices.sentinel", ".tpm"),
+        PARAMS["matrix_format"])
+
+    if "transcript" in infile:
+        id_name = "transcript_id"
+    elif "gene" in infile:
+        id_name = "gene_id"
+    else:
+        raise ValueError("Unexpected Salmon matrix name")
+
+    statement = '''python %(txseq_code_dir)s/python/salmon_matrix_tpms.py
+                   --matrix=%(tpm_matrix)s
+                   --idname=%(id_name)s
+                   --outfile=%(out_file)s.txt.gz
+                   &> %(log_file)s
+                ''' % dict(PARAMS, **t.var, **locals())
+
+    P.run(statement, **t.resources)
+
+    IOTools.touch_file(outfile)
+
+
 @follows(loadSalmonGeneQuant)
 @jobs_limit(1)
-@transform(salmonTPMs,
+@transform([salmonTPMs, salmonMatrixTPMs],
            suffix(".sentinel"),
            ".load")
 def loadSalmonTPMs(infile, outfile):
@@ -288,7 +443,7 @@ def tximeta(infile, outfile):
 
 # ----------------------- Quantitation target ------------------------------ #
 
-@follows(loadSalmonTPMs) #, loadCopyNumber)
+@follows(salmonMatrices, loadSalmonTPMs) #, loadCopyNumber)
 def quantitation():
     '''
     Quantitation target.
@@ -26,6 +26,12 @@ For building the SAF genome index the pipeline requires:
 #. A gzip compressed FASTA file containing the transcript sequences.
 #. A gzip compressed FASTA file containing the genome primary assembly sequences.
 
+The decoy sequence names are read from the FASTA index of the genome
+(e.g. "txseq.genome.fa.gz.fai") if present, or from the
+"txseq.genome.contigs.txt" file written alongside the genome by
+:doc:`pipeline_ensembl.py </pipelines/pipeline_ensembl>`. Otherwise they
+are extracted from the genome FASTA file.
+
 The location of these three files must be specified in the 'pipeline_salmon.yml' file.
 
 
@@ -42,6 +48,11 @@ Output files
 
 The pipeline generates a salmon index called "salmon_index" in the current folder.
 
+If the "cache_dir" option is set, the index is symlinked from a shared
+cache directory (see :mod:`txseq.tasks.cache`). The cache is keyed by
+the contents of the input files, the salmon version and the index
+options, so the index is only built once for the same inputs.
+
 
 Code
 ====
@@ -49,6 +60,7 @@ Code
 """
 from ruffus import *
 import sys
+import os
 
 # import CGAT-core pipeline functions
 from cgatcore import pipeline as P
@@ -57,6 +69,7 @@ import cgatcore.iotools as IOTools
 
 # Import txseq utility functions
 import txseq.tasks as T
+import txseq.tasks.cache as cache
 
 # ----------------------- < pipeline configuration > ------------------------ #
 
@@ -75,6 +88,10 @@ PARAMS = P.get_parameters(T.get_parameter_file(__file__))
 def index(infile, sentinel):
     '''
     Generate a SAF genome index. 
+
+    If a cache directory is configured, the index is taken from (or
+    built into) the shared cache, keyed by the contents of the FASTA
+    files, the salmon version and the index options.
     '''
     
     t = T.setup(infile, sentinel, PARAMS,
@@ -87,25 +104,117 @@ def index(infile, sentinel):
         options = PARAMS['options']
     
     source = "--gencode" if PARAMS["fasta_source"] == "gencode" else ""
-    
-    statement = '''grep "^>" <(gunzip -c %(genome_fasta)s) 
-                   | cut -d " " -f 1 
-                   > decoys.txt;
-                   sed -i.bak -e 's/>//g' decoys.txt;
-                   cat %(transcript_fasta)s %(genome_fasta)s 
-                   > gentrome.fa.gz;
-                   salmon index -t gentrome.fa.gz 
+
+    if not PARAMS.get("cache_dir"):
+        build_index(".", t, options, source)
+        IOTools.touch_file(sentinel)
+        return
+
+    index_cache = cache.indexCache(PARAMS["cache_dir"])
+
+    key = index_cache.key({"transcript_fasta": PARAMS["transcript_fasta"],
+                           "genome_fasta": PARAMS["genome_fasta"]},
+                          version=cache.tool_version("salmon"),
+                          options={"kmerLen": PARAMS["kmerLen"],
+                                   "options": options,
+                                   "source": source})
+
+    # concurrent projects wait for a single build of the same index
+    with index_cache.lock(key):
+
+        if not index_cache.fetch(key, "."):
+
+            build_dir = index_cache.build_dir(key)
+            build_index(build_dir, t, options, source)
+
+            index_cache.store(key, build_dir,
+                              info={"transcript_fasta":
+                                    PARAMS["transcript_fasta"],
+                                    "genome_fasta": PARAMS["genome_fasta"]})
+            index_cache.fetch(key, ".")
+
+    IOTools.touch_file(sentinel)
+
+
+def write_decoys(genome_fasta, decoys):
+    '''
+    Write the names of the genome sequences (the decoys) to the file
+    *decoys* from the FASTA index (".fai") of the genome or from the list
+    of contigs written by pipeline_ensembl to the "api.dir". Returns False
+    if neither is available.
+    '''
+
+    fai = genome_fasta + ".fai"
+    contigs = os.path.join(os.path.dirname(genome_fasta),
+                           "txseq.genome.contigs.txt")
+
+    if os.path.exists(fai):
+        source = fai
+    elif os.path.exists(contigs):
+        source = contigs
+    else:
+        return(False)
+
+    with open(source, "r") as infile, open(decoys, "w") as outfile:
+        for line in infile:
+            if line.strip() != "":
+                outfile.write(line.split()[0] + "\n")
+
+    return(True)
+
+
+def build_index(outdir, t, options, source):
+    '''
+    Build the SAF genome index in *outdir*.
+
+    The decoy names are taken from the genome FASTA index or the txseq
+    api contig list if available (otherwise the genome is scanned), and
+    the concatenated transcript and genome sequences are streamed to
+    salmon rather than written to a "gentrome" file (unless the
+    "stream_gentrome" option is False).
+    '''
+
+    # the statement is run in the output directory
+    genome = os.path.abspath(PARAMS["genome_fasta"])
+    transcripts = os.path.abspath(PARAMS["transcript_fasta"])
+    log_path = os.path.abspath(t.log_file)
+
+    if write_decoys(genome, os.path.join(outdir, "decoys.txt")):
+        decoy_statement = ""
+    else:
+        decoy_statement = '''grep "^>" <(gunzip -c %(genome)s)
+                             | cut -d " " -f 1
+                             | sed -e 's/>//g'
+                             > decoys.txt;
+                          ''' % locals()
+
+    if PARAMS.get("stream_gentrome", True):
+        gentrome_statement = ""
+        gentrome = "<(cat %(transcripts)s %(genome)s)" % locals()
+    else:
+        gentrome_statement = '''cat %(transcripts)s %(genome)s
+                                > gentrome.fa.gz;
+                             ''' % locals()
+        gentrome = "gentrome.fa.gz"
+
+    statement = '''cd %(outdir)s;
+                   %(decoy_statement)s
+                   %(gentrome_statement)s
+                   salmon index -t %(gentrome)s 
                                 -d decoys.txt 
                                 -k %(kmerLen)s
                                 -p %(resources_threads)s 
                                 -i salmon_index
                                 %(options)s
                                 %(source)s
-                    &> %(log_file)s 
+                    &> %(log_path)s 
                 ''' % dict(PARAMS, **t.var, **locals())
                 
     P.run(statement, **t.resources)
-    IOTools.touch_file(sentinel)    
+
+    if os.path.exists(os.path.join(outdir, "gentrome.fa.gz")):
+        # the concatenated fasta is not needed to use the index
+        os.unlink(os.path.join(outdir, "gentrome.fa.gz"))
 
 
 # --------------------- < generic pipeline tasks > -------------------------- #
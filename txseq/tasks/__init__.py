@@ -13,6 +13,16 @@ Core components:
 Pipeline specific components:
 
 * `readqc`_
+* `matrix`_
+* `gtf`_
+* `intervals`_
+* `history`_
+* `cluster`_
+* `bam`_
+* `picard`_
+* `db`_
+* `cache`_
+* `registry`_
 
 
 '''
@@ -0,0 +1,1468 @@
+'''
+bam.py
+======
+
+Overview
+--------
+
+A single pass BAM metrics collector.
+
+Each BAM record is read once (with pysam) and passed to a set of metric
+"collectors" that are filled at the same time. The collectors write
+tables with the same layout as the Picard tools (and the samtools based
+fraction spliced task) used by :doc:`pipeline_bamqc.py
+</pipelines/pipeline_bamqc>` so that the same loading tasks can be used:
+
+* :class:`rnaSeqMetrics`: Picard CollectRnaSeqMetrics (metrics and the
+  normalised coverage histogram)
+* :class:`alignmentSummaryMetrics`: Picard CollectAlignmentSummaryMetrics
+* :class:`insertSizeMetrics`: Picard CollectInsertSizeMetrics (metrics
+  and histogram)
+* :class:`libraryComplexity`: Picard EstimateLibraryComplexity
+* :class:`fractionSpliced`: the fraction of uniquely mapped reads that
+  are spliced (genome-wide and per contig)
+
+The following differ from Picard:
+
+* mismatches are counted from the NM tag (less the inserted and deleted
+  bases) rather than against the reference sequence. BAD_CYCLES is not
+  computed.
+* duplicates are identified from the (unclipped) alignment positions of
+  the read and its mate (as by MarkDuplicates) rather than from the read
+  sequences. Optical duplicates are not identified.
+* the coverage histogram is computed from the longest transcript of each
+  gene, in 101 bins along the transcript. The 5' and 3' biases are the
+  coverage of the first and last bins relative to the mean.
+
+The fraction of spliced reads can also be computed on its own from an
+indexed BAM file with :func:`fraction_spliced`, which splits the BAM
+into regions that are read by a pool of worker processes.
+
+Usage
+-----
+
+.. code-block:: python
+
+    from txseq.tasks.bam import refFlat, collect, rnaSeqMetrics
+
+    rnaseq = rnaSeqMetrics(refFlat("geneset.flat.gz"), "NONE")
+    collect("sample.bam", [rnaseq])
+    rnaseq.write("sample.rnaseq.metrics", "sample.rnaseq.cov.hist")
+
+Classes and functions
+---------------------
+
+'''
+
+import math
+import gzip
+from array import array
+from bisect import bisect_right
+from collections import Counter
+
+import numpy as np
+
+
+# Picard locus functions: when features overlap, the highest value wins.
+INTERGENIC, INTRONIC, UTR, CODING = 0, 1, 2, 3
+
+# CIGAR operations
+M, I, D, N, S, H, EQ, X = 0, 1, 2, 3, 4, 5, 7, 8
+ALIGNED_OPS = (M, EQ, X)
+
+# Number of bins along the transcripts for the coverage histogram.
+NBINS = 101
+
+
+# ------------------------------ output tables ------------------------------ #
+
+def format_value(value):
+    '''
+    Format a metric value as Picard does: missing values are empty,
+    integers are written as integers and other values with up to six
+    decimal places.
+    '''
+
+    if value is None:
+        return("")
+
+    if isinstance(value, (bool, np.bool_)):
+        return(str(value).lower())
+
+    if isinstance(value, (int, np.integer)):
+        return(str(int(value)))
+
+    if isinstance(value, (float, np.floating)):
+        if math.isnan(value):
+            return("")
+        if float(value).is_integer():
+            return(str(int(value)))
+        return(("%.6f" % value).rstrip("0"))
+
+    return(str(value))
+
+
+def write_table(path, columns, rows):
+    '''
+    Write a tab-separated table with the given *columns* from a list of
+    *rows* (dictionaries).
+    '''
+
+    with open(path, "w") as out_file:
+        out_file.write("\t".join(columns) + "\n")
+        for row in rows:
+            out_file.write("\t".join([format_value(row.get(c))
+                                      for c in columns]) + "\n")
+
+
+def _divide(a, b):
+    return(a / b if b else 0.0)
+
+
+# ------------------------------ histograms --------------------------------- #
+
+def histogram_median(hist):
+    '''
+    Return the median of a histogram (a dictionary of value: count).
+    '''
+
+    total = sum(hist.values())
+
+    if total == 0:
+        return(0.0)
+
+    keys = sorted(hist.keys())
+    cumulative = 0
+    lower = upper = None
+
+    for key in keys:
+        cumulative += hist[key]
+        if lower is None and cumulative >= (total + 1) // 2:
+            lower = key
+        if upper is None and cumulative >= total / 2.0 + 1:
+            upper = key
+        if lower is not None and upper is not None:
+            break
+
+    if total % 2 == 1:
+        return(float(lower))
+
+    return((lower + upper) / 2.0)
+
+
+def histogram_mad(hist):
+    '''
+    Return the median absolute deviation of a histogram.
+    '''
+
+    median = histogram_median(hist)
+
+    deviations = Counter()
+    for key, count in hist.items():
+        deviations[abs(key - median)] += count
+
+    return(histogram_median(deviations))
+
+
+def histogram_mean_sd(hist):
+    '''
+    Return the mean and (sample) standard deviation of a histogram.
+    '''
+
+    total = sum(hist.values())
+
+    if total == 0:
+        return(0.0, 0.0)
+
+    mean = sum([k * v for k, v in hist.items()]) / total
+
+    if total == 1:
+        return(mean, 0.0)
+
+    var = sum([v * (k - mean) ** 2 for k, v in hist.items()]) / (total - 1)
+
+    return(mean, math.sqrt(var))
+
+
+def binomial_ci(p, n, z=1.96):
+    '''
+    Return the lower and upper bounds of the Wilson score interval for
+    proportion(s) *p* observed in *n* trials (e.g. the metrics computed
+    from a subsample of the reads). By default the 95% interval is
+    returned.
+    '''
+
+    p = np.asarray(p, dtype=float)
+    n = np.asarray(n, dtype=float)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        denominator = 1 + z ** 2 / n
+        centre = (p + z ** 2 / (2 * n)) / denominator
+        half_width = (z * np.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) /
+                      denominator)
+
+    return(np.clip(centre - half_width, 0, 1),
+           np.clip(centre + half_width, 0, 1))
+
+
+# ------------------------------ annotation --------------------------------- #
+
+class refFlat():
+    '''
+    A genome annotation built from a (gzipped) Picard refFlat file.
+
+    The genome is split into segments labelled with the Picard locus
+    function (coding, UTR, intronic or intergenic) and into segments
+    labelled with the genes that span them, so that the bases of an
+    aligned block and the genes overlapped by a read can be found with
+    a binary search.
+    '''
+
+    def __init__(self, path):
+
+        transcripts = {}
+        gene_index = {}
+
+        self.gene_names = []
+        self.gene_negative = []
+        self.gene_contig = []
+
+        opener = gzip.open if path.endswith(".gz") else open
+
+        with opener(path, "rt") as ref_flat:
+            for line in ref_flat:
+
+                if line.startswith("#") or line.strip() == "":
+                    continue
+
+                fields = line.rstrip("\n").split("\t")
+
+                gene, contig, strand = fields[0], fields[2], fields[3]
+                tx_start, tx_end = int(fields[4]), int(fields[5])
+                cds_start, cds_end = int(fields[6]), int(fields[7])
+                starts = [int(x) for x in fields[9].split(",") if x != ""]
+                ends = [int(x) for x in fields[10].split(",") if x != ""]
+
+                key = (contig, gene, strand)
+
+                if key not in gene_index:
+                    gene_index[key] = len(self.gene_names)
+                    self.gene_names.append(gene)
+                    self.gene_negative.append(strand == "-")
+                    self.gene_contig.append(contig)
+
+                transcripts.setdefault(contig, []).append(
+                    (gene_index[key], tx_start, tx_end, cds_start, cds_end,
+                     starts, ends))
+
+        self.functions = {}
+        self.genes = {}
+
+        # The longest transcript of each gene is used for the
+        # coverage histogram.
+        self.transcripts = {}
+
+        for contig, txs in transcripts.items():
+
+            function_events = []
+            gene_spans = {}
+
+            for gene, tx_start, tx_end, cds_start, cds_end, starts, ends in txs:
+
+                function_events += [(tx_start, INTRONIC, 1),
+                                    (tx_end, INTRONIC, -1)]
+
+                for start, end in zip(starts, ends):
+                    function_events += [(start, UTR, 1), (end, UTR, -1)]
+
+                    cs, ce = max(start, cds_start), min(end, cds_end)
+                    if cs < ce:
+                        function_events += [(cs, CODING, 1), (ce, CODING, -1)]
+
+                span = gene_spans.get(gene, (tx_start, tx_end))
+                gene_spans[gene] = (min(span[0], tx_start),
+                                    max(span[1], tx_end))
+
+                length = sum([e - s for s, e in zip(starts, ends)])
+
+                if gene not in self.transcripts or \
+                   length > self.transcripts[gene][2][-1]:
+
+                    cumulative = [0]
+                    for s, e in zip(starts, ends):
+                        cumulative.append(cumulative[-1] + e - s)
+
+                    self.transcripts[gene] = (starts, ends, cumulative)
+
+            self.functions[contig] = self._segment_functions(function_events)
+
+            gene_events = []
+            for gene, (start, end) in gene_spans.items():
+                gene_events += [(start, gene, 1), (end, gene, -1)]
+
+            self.genes[contig] = self._segment_genes(gene_events)
+
+    @staticmethod
+    def _segment_functions(events):
+        '''
+        Return the segment starts and the highest locus function of
+        each segment.
+        '''
+
+        events.sort()
+        counts = [0, 0, 0, 0]
+        starts, labels = [], []
+
+        i = 0
+        while i < len(events):
+
+            pos = events[i][0]
+            while i < len(events) and events[i][0] == pos:
+                counts[events[i][1]] += events[i][2]
+                i += 1
+
+            label = INTERGENIC
+            for function in (CODING, UTR, INTRONIC):
+                if counts[function] > 0:
+                    label = function
+                    break
+
+            if len(labels) > 0 and labels[-1] == label:
+                continue
+
+            starts.append(pos)
+            labels.append(label)
+
+        return(starts, labels)
+
+    @staticmethod
+    def _segment_genes(events):
+        '''
+        Return the segment starts and the genes that span each segment.
+        '''
+
+        events.sort()
+        active = set()
+        starts, genes = [], []
+
+        i = 0
+        while i < len(events):
+
+            pos = events[i][0]
+            while i < len(events) and events[i][0] == pos:
+                if events[i][2] > 0:
+                    active.add(events[i][1])
+                else:
+                    active.discard(events[i][1])
+                i += 1
+
+            current = tuple(sorted(active))
+
+            if len(genes) > 0 and genes[-1] == current:
+                continue
+
+            starts.append(pos)
+            genes.append(current)
+
+        return(starts, genes)
+
+    def count_functions(self, contig, start, end, counts):
+        '''
+        Add the number of bases in start-end (0-based, half open) with
+        each locus function to *counts*.
+        '''
+
+        if contig not in self.functions:
+            counts[INTERGENIC] += end - start
+            return
+
+        starts, labels = self.functions[contig]
+
+        i = bisect_right(starts, start) - 1
+        pos = start
+
+        while pos < end:
+
+            label = labels[i] if i >= 0 else INTERGENIC
+
+            if i + 1 < len(starts):
+                segment_end = min(starts[i + 1], end)
+            else:
+                segment_end = end
+
+            counts[label] += segment_end - pos
+            pos = segment_end
+            i += 1
+
+    def overlapping_genes(self, contig, start, end):
+        '''
+        Return the set of genes that overlap start-end.
+        '''
+
+        found = set()
+
+        if contig not in self.genes:
+            return(found)
+
+        starts, genes = self.genes[contig]
+
+        i = max(bisect_right(starts, start) - 1, 0)
+
+        while i < len(starts) and starts[i] < end:
+            found.update(genes[i])
+            i += 1
+
+        return(found)
+
+
+# ------------------------------- collectors -------------------------------- #
+
+def unclipped_five_prime(read):
+    '''
+    Return the unclipped 5' position of an aligned read.
+    '''
+
+    cigar = read.cigartuples
+
+    if read.is_reverse:
+        clip = cigar[-1][1] if cigar[-1][0] in (S, H) else 0
+        return(read.reference_end + clip)
+
+    clip = cigar[0][1] if cigar[0][0] in (S, H) else 0
+    return(read.reference_start - clip)
+
+
+class rnaSeqMetrics():
+    '''
+    Collect the Picard CollectRnaSeqMetrics metrics and normalised
+    coverage histogram.
+
+    The *strand* is given as for Picard, i.e. NONE,
+    FIRST_READ_TRANSCRIPTION_STRAND or SECOND_READ_TRANSCRIPTION_STRAND.
+    '''
+
+    COLUMNS = ["PF_BASES", "PF_ALIGNED_BASES", "RIBOSOMAL_BASES",
+               "CODING_BASES", "UTR_BASES", "INTRONIC_BASES",
+               "INTERGENIC_BASES", "IGNORED_READS", "CORRECT_STRAND_READS",
+               "INCORRECT_STRAND_READS", "NUM_R1_TRANSCRIPT_STRAND_READS",
+               "NUM_R2_TRANSCRIPT_STRAND_READS", "NUM_UNEXPLAINED_READS",
+               "PCT_R1_TRANSCRIPT_STRAND_READS",
+               "PCT_R2_TRANSCRIPT_STRAND_READS", "PCT_RIBOSOMAL_BASES",
+               "PCT_CODING_BASES", "PCT_UTR_BASES", "PCT_INTRONIC_BASES",
+               "PCT_INTERGENIC_BASES", "PCT_MRNA_BASES", "PCT_USABLE_BASES",
+               "PCT_CORRECT_STRAND_READS", "MEDIAN_CV_COVERAGE",
+               "MEDIAN_5PRIME_BIAS", "MEDIAN_3PRIME_BIAS",
+               "MEDIAN_5PRIME_TO_3PRIME_BIAS", "SAMPLE", "LIBRARY",
+               "READ_GROUP"]
+
+    def __init__(self, annotation, strand="NONE",
+                 minimum_length=500, n_transcripts=1000):
+
+        if strand not in ("NONE", "FIRST_READ_TRANSCRIPTION_STRAND",
+                          "SECOND_READ_TRANSCRIPTION_STRAND"):
+            raise ValueError("Strand specificity not recognised: " + strand)
+
+        self.annotation = annotation
+        self.strand = strand
+        self.minimum_length = minimum_length
+        self.n_transcripts = n_transcripts
+
+        self.pf_bases = 0
+        self.functions = [0, 0, 0, 0]
+        self.correct = 0
+        self.incorrect = 0
+        self.r1 = 0
+        self.r2 = 0
+        self.unexplained = 0
+
+        # per gene coverage of the longest transcript in NBINS bins
+        self.coverage = {}
+
+    def add(self, read):
+
+        if read.is_qcfail or read.is_secondary or read.is_supplementary:
+            return
+
+        self.pf_bases += read.query_length or read.infer_read_length() or 0
+
+        if read.is_unmapped:
+            return
+
+        annotation = self.annotation
+        contig = read.reference_name
+
+        genes = annotation.overlapping_genes(contig, read.reference_start,
+                                             read.reference_end)
+
+        counts = [0, 0, 0, 0]
+
+        for start, end in read.get_blocks():
+
+            annotation.count_functions(contig, start, end, counts)
+
+            for gene in genes:
+                self._add_coverage(gene, start, end)
+
+        for function in range(4):
+            self.functions[function] += counts[function]
+
+        if counts[UTR] + counts[CODING] == 0:
+            return
+
+        if len(genes) != 1:
+            self.unexplained += 1
+            return
+
+        gene = next(iter(genes))
+        agree = read.is_reverse == annotation.gene_negative[gene]
+        first_or_unpaired = (not read.is_paired) or read.is_read1
+
+        if first_or_unpaired == agree:
+            self.r1 += 1
+        else:
+            self.r2 += 1
+
+        if self.strand != "NONE":
+            expected = (first_or_unpaired ==
+                        (self.strand == "FIRST_READ_TRANSCRIPTION_STRAND"))
+
+            if agree == expected:
+                self.correct += 1
+            else:
+                self.incorrect += 1
+
+    def _add_coverage(self, gene, start, end):
+        '''
+        Add the bases of start-end that fall in the exons of the longest
+        transcript of the gene to the coverage bins.
+        '''
+
+        starts, ends, cumulative = self.annotation.transcripts[gene]
+        length = cumulative[-1]
+
+        if length < self.minimum_length:
+            return
+
+        j = max(bisect_right(starts, start) - 1, 0)
+
+        while j < len(starts) and starts[j] < end:
+
+            s, e = max(start, starts[j]), min(end, ends[j])
+
+            if s < e:
+
+                if gene not in self.coverage:
+                    self.coverage[gene] = [0] * NBINS
+
+                bins = self.coverage[gene]
+
+                a = cumulative[j] + s - starts[j]
+                b = a + e - s
+
+                while a < b:
+                    k = a * NBINS // length
+                    bin_end = min(-(-(k + 1) * length // NBINS), b)
+                    bins[k] += bin_end - a
+                    a = bin_end
+
+            j += 1
+
+    def coverage_profiles(self):
+        '''
+        Return the normalised coverage profiles (5' to 3') of the most
+        highly covered transcripts as an array (transcripts x bins).
+        '''
+
+        ranked = []
+
+        for gene, bins in self.coverage.items():
+            length = self.annotation.transcripts[gene][2][-1]
+            ranked.append((sum(bins) / length, gene))
+
+        ranked.sort(reverse=True)
+
+        profiles = []
+
+        for mean, gene in ranked[:self.n_transcripts]:
+
+            length = self.annotation.transcripts[gene][2][-1]
+
+            edges = np.array([-(-k * length // NBINS)
+                              for k in range(NBINS + 1)])
+            depth = np.array(self.coverage[gene], dtype=float) / np.diff(edges)
+
+            if self.annotation.gene_negative[gene]:
+                depth = depth[::-1]
+
+            profiles.append(depth)
+
+        return(np.array(profiles).reshape(-1, NBINS))
+
+    def metrics(self):
+
+        aligned = sum(self.functions)
+        mrna = self.functions[CODING] + self.functions[UTR]
+
+        metrics = {"PF_BASES": self.pf_bases,
+                   "PF_ALIGNED_BASES": aligned,
+                   "RIBOSOMAL_BASES": None,
+                   "CODING_BASES": self.functions[CODING],
+                   "UTR_BASES": self.functions[UTR],
+                   "INTRONIC_BASES": self.functions[INTRONIC],
+                   "INTERGENIC_BASES": self.functions[INTERGENIC],
+                   "IGNORED_READS": 0,
+                   "CORRECT_STRAND_READS": self.correct,
+                   "INCORRECT_STRAND_READS": self.incorrect,
+                   "NUM_R1_TRANSCRIPT_STRAND_READS": self.r1,
+                   "NUM_R2_TRANSCRIPT_STRAND_READS": self.r2,
+                   "NUM_UNEXPLAINED_READS": self.unexplained,
+                   "PCT_R1_TRANSCRIPT_STRAND_READS":
+                       _divide(self.r1, self.r1 + self.r2),
+                   "PCT_R2_TRANSCRIPT_STRAND_READS":
+                       _divide(self.r2, self.r1 + self.r2),
+                   "PCT_RIBOSOMAL_BASES": None,
+                   "PCT_CODING_BASES": _divide(self.functions[CODING], aligned),
+                   "PCT_UTR_BASES": _divide(self.functions[UTR], aligned),
+                   "PCT_INTRONIC_BASES":
+                       _divide(self.functions[INTRONIC], aligned),
+                   "PCT_INTERGENIC_BASES":
+                       _divide(self.functions[INTERGENIC], aligned),
+                   "PCT_MRNA_BASES": _divide(mrna, aligned),
+                   "PCT_USABLE_BASES": _divide(mrna, self.pf_bases),
+                   "PCT_CORRECT_STRAND_READS":
+                       _divide(self.correct, self.correct + self.incorrect)}
+
+        profiles = self.coverage_profiles()
+        means = profiles.mean(axis=1) if len(profiles) > 0 else profiles
+
+        if len(profiles) > 0 and (means > 0).any():
+            profiles = profiles[means > 0]
+            means = means[means > 0]
+
+            five = profiles[:, 0] / means
+            three = profiles[:, -1] / means
+
+            metrics["MEDIAN_CV_COVERAGE"] = float(
+                np.median(profiles.std(axis=1) / means))
+            metrics["MEDIAN_5PRIME_BIAS"] = float(np.median(five))
+            metrics["MEDIAN_3PRIME_BIAS"] = float(np.median(three))
+            metrics["MEDIAN_5PRIME_TO_3PRIME_BIAS"] = float(
+                np.median(five[three > 0] / three[three > 0])) \
+                if (three > 0).any() else 0.0
+
+        else:
+            for x in ["MEDIAN_CV_COVERAGE", "MEDIAN_5PRIME_BIAS",
+                      "MEDIAN_3PRIME_BIAS", "MEDIAN_5PRIME_TO_3PRIME_BIAS"]:
+                metrics[x] = 0.0
+
+        return(metrics)
+
+    def histogram(self):
+        '''
+        Return the mean normalised coverage at each position (0-100)
+        along the transcripts, or None if there was no coverage.
+        '''
+
+        profiles = self.coverage_profiles()
+        means = profiles.mean(axis=1) if len(profiles) > 0 else profiles
+
+        if len(profiles) == 0 or not (means > 0).any():
+            return(None)
+
+        normalised = profiles[means > 0] / means[means > 0][:, None]
+
+        return(normalised.mean(axis=0))
+
+    def write(self, metrics_file, histogram_file):
+        '''
+        Write the metrics and the coverage histogram.
+        '''
+
+        write_table(metrics_file, self.COLUMNS, [self.metrics()])
+
+        histogram = self.histogram()
+
+        with open(histogram_file, "w") as out_file:
+
+            # As for Picard, no histogram is written if there is no data.
+            if histogram is not None:
+                out_file.write("normalized_position\t"
+                               "All_Reads.normalized_coverage\n")
+                for position, value in enumerate(histogram):
+                    out_file.write("%i\t%s\n" % (position,
+                                                 format_value(float(value))))
+
+
+# The sequences at the start of the Illumina adapters (as read
+# through after a short insert) that are used to identify adapter reads.
+ADAPTERS = ["AGATCGGAAGAGC",         # TruSeq
+            "CTGTCTCTTATACACATCT",   # Nextera
+            "TGGAATTCTCGG"]          # small RNA
+
+
+def _adapter_kmers(adapters, k=12):
+    '''
+    Return the set of the first k bases of the adapters allowing for one
+    mismatch.
+    '''
+
+    kmers = set()
+
+    for adapter in adapters:
+        prefix = adapter[:k]
+        kmers.add(prefix)
+        for i in range(k):
+            for base in "ACGTN":
+                kmers.add(prefix[:i] + base + prefix[i + 1:])
+
+    return(kmers)
+
+
+class alignmentSummaryMetrics():
+    '''
+    Collect the Picard CollectAlignmentSummaryMetrics metrics, for the
+    FIRST_OF_PAIR, SECOND_OF_PAIR and PAIR categories for paired reads
+    or the UNPAIRED category for single end reads.
+    '''
+
+    COLUMNS = ["CATEGORY", "TOTAL_READS", "PF_READS", "PCT_PF_READS",
+               "PF_NOISE_READS", "PF_READS_ALIGNED", "PCT_PF_READS_ALIGNED",
+               "PF_ALIGNED_BASES", "PF_HQ_ALIGNED_READS",
+               "PF_HQ_ALIGNED_BASES", "PF_HQ_ALIGNED_Q20_BASES",
+               "PF_HQ_MEDIAN_MISMATCHES", "PF_MISMATCH_RATE",
+               "PF_HQ_ERROR_RATE", "PF_INDEL_RATE", "MEAN_READ_LENGTH",
+               "SD_READ_LENGTH", "MEDIAN_READ_LENGTH", "MAD_READ_LENGTH",
+               "MIN_READ_LENGTH", "MAX_READ_LENGTH", "READS_ALIGNED_IN_PAIRS",
+               "PCT_READS_ALIGNED_IN_PAIRS", "PF_READS_IMPROPER_PAIRS",
+               "PCT_PF_READS_IMPROPER_PAIRS", "BAD_CYCLES", "STRAND_BALANCE",
+               "PCT_CHIMERAS", "PCT_ADAPTER", "PCT_SOFTCLIP", "PCT_HARDCLIP",
+               "AVG_POS_3PRIME_SOFTCLIP_LENGTH", "SAMPLE", "LIBRARY",
+               "READ_GROUP"]
+
+    COUNTS = ["total", "pf", "aligned", "aligned_bases", "hq_aligned",
+              "hq_aligned_bases", "hq_q20_bases", "mismatches",
+              "hq_mismatches", "indels", "in_pairs", "improper",
+              "positive", "chimeras", "chimera_reads", "adapter",
+              "softclip", "hardclip", "softclip3_reads", "softclip3_bases"]
+
+    def __init__(self, min_mapq=20, max_insert_size=100000):
+
+        self.min_mapq = min_mapq
+        self.max_insert_size = max_insert_size
+        self.adapters = _adapter_kmers(ADAPTERS)
+
+        self.counts = {}
+        self.read_lengths = {}
+        self.hq_mismatch_hist = {}
+
+    def _category(self, read):
+
+        if not read.is_paired:
+            return("UNPAIRED")
+
+        return("FIRST_OF_PAIR" if read.is_read1 else "SECOND_OF_PAIR")
+
+    def add(self, read):
+
+        if read.is_secondary or read.is_supplementary:
+            return
+
+        category = self._category(read)
+
+        if category not in self.counts:
+            self.counts[category] = dict.fromkeys(self.COUNTS, 0)
+            self.read_lengths[category] = Counter()
+            self.hq_mismatch_hist[category] = Counter()
+
+        c = self.counts[category]
+        c["total"] += 1
+
+        if read.is_qcfail:
+            return
+
+        c["pf"] += 1
+
+        length = read.query_length or read.infer_read_length() or 0
+        self.read_lengths[category][length] += 1
+
+        if read.is_unmapped or read.mapping_quality == 0:
+            sequence = read.query_sequence
+            if sequence is not None and sequence[:12] in self.adapters:
+                c["adapter"] += 1
+
+        if read.is_unmapped:
+            return
+
+        c["aligned"] += 1
+
+        aligned_bases = 0
+        indel_bases = 0
+        cigar = read.cigartuples
+
+        # the intervals of the read that are aligned: blocks separated
+        # only by deletions or introns are contiguous in the read.
+        blocks = []
+        pos = 0
+
+        for op, n in cigar:
+            if op in ALIGNED_OPS:
+                aligned_bases += n
+                if blocks and blocks[-1][1] == pos:
+                    blocks[-1][1] = pos + n
+                else:
+                    blocks.append([pos, pos + n])
+                pos += n
+            elif op == I or op == D:
+                c["indels"] += 1
+                indel_bases += n
+                if op == I:
+                    pos += n
+            elif op == S:
+                c["softclip"] += n
+                pos += n
+            elif op == H:
+                c["hardclip"] += n
+
+        three_prime = cigar[0] if read.is_reverse else cigar[-1]
+        if three_prime[0] == S:
+            c["softclip3_reads"] += 1
+            c["softclip3_bases"] += three_prime[1]
+
+        c["aligned_bases"] += aligned_bases
+
+        mismatches = 0
+        if read.has_tag("NM"):
+            mismatches = max(read.get_tag("NM") - indel_bases, 0)
+        c["mismatches"] += mismatches
+
+        if not read.is_reverse:
+            c["positive"] += 1
+
+        hq = read.mapping_quality >= self.min_mapq
+
+        if hq:
+            c["hq_aligned"] += 1
+            c["hq_aligned_bases"] += aligned_bases
+            c["hq_mismatches"] += mismatches
+            self.hq_mismatch_hist[category][mismatches] += 1
+
+            qualities = read.query_qualities
+
+            if qualities is not None and blocks:
+                qualities = np.frombuffer(qualities, dtype=np.uint8)
+
+                if len(blocks) == 1:
+                    c["hq_q20_bases"] += int(np.count_nonzero(
+                        qualities[blocks[0][0]:blocks[0][1]] >= 20))
+                else:
+                    # one cumulative count over the read
+                    q20 = np.concatenate(([0], np.cumsum(qualities >= 20)))
+                    bounds = np.array(blocks)
+                    c["hq_q20_bases"] += int((q20[bounds[:, 1]] -
+                                              q20[bounds[:, 0]]).sum())
+
+        if read.is_paired and not read.mate_is_unmapped:
+
+            c["in_pairs"] += 1
+
+            if not read.is_proper_pair:
+                c["improper"] += 1
+
+            if hq:
+                c["chimera_reads"] += 1
+                if self._is_chimeric(read):
+                    c["chimeras"] += 1
+
+        elif hq and not read.is_paired:
+            c["chimera_reads"] += 1
+            if read.has_tag("SA"):
+                c["chimeras"] += 1
+
+    def _is_chimeric(self, read):
+
+        if read.reference_id != read.next_reference_id:
+            return(True)
+
+        if abs(read.template_length) > self.max_insert_size:
+            return(True)
+
+        if read.has_tag("SA"):
+            return(True)
+
+        return(pair_orientation(read) != "FR")
+
+    def _row(self, category, c, lengths, mismatch_hist):
+
+        mean_length, sd_length = histogram_mean_sd(lengths)
+
+        return({"CATEGORY": category,
+                "TOTAL_READS": c["total"],
+                "PF_READS": c["pf"],
+                "PCT_PF_READS": _divide(c["pf"], c["total"]),
+                "PF_NOISE_READS": 0,
+                "PF_READS_ALIGNED": c["aligned"],
+                "PCT_PF_READS_ALIGNED": _divide(c["aligned"], c["pf"]),
+                "PF_ALIGNED_BASES": c["aligned_bases"],
+                "PF_HQ_ALIGNED_READS": c["hq_aligned"],
+                "PF_HQ_ALIGNED_BASES": c["hq_aligned_bases"],
+                "PF_HQ_ALIGNED_Q20_BASES": c["hq_q20_bases"],
+                "PF_HQ_MEDIAN_MISMATCHES": histogram_median(mismatch_hist),
+                "PF_MISMATCH_RATE": _divide(c["mismatches"],
+                                            c["aligned_bases"]),
+                "PF_HQ_ERROR_RATE": _divide(c["hq_mismatches"],
+                                            c["hq_aligned_bases"]),
+                "PF_INDEL_RATE": _divide(c["indels"], c["aligned_bases"]),
+                "MEAN_READ_LENGTH": mean_length,
+                "SD_READ_LENGTH": sd_length,
+                "MEDIAN_READ_LENGTH": histogram_median(lengths),
+                "MAD_READ_LENGTH": histogram_mad(lengths),
+                "MIN_READ_LENGTH": min(lengths.keys()) if lengths else 0,
+                "MAX_READ_LENGTH": max(lengths.keys()) if lengths else 0,
+                "READS_ALIGNED_IN_PAIRS": c["in_pairs"],
+                "PCT_READS_ALIGNED_IN_PAIRS": _divide(c["in_pairs"],
+                                                      c["aligned"]),
+                "PF_READS_IMPROPER_PAIRS": c["improper"],
+                "PCT_PF_READS_IMPROPER_PAIRS": _divide(c["improper"],
+                                                       c["aligned"]),
+                "BAD_CYCLES": 0,
+                "STRAND_BALANCE": _divide(c["positive"], c["aligned"]),
+                "PCT_CHIMERAS": _divide(c["chimeras"], c["chimera_reads"]),
+                "PCT_ADAPTER": _divide(c["adapter"], c["pf"]),
+                "PCT_SOFTCLIP": _divide(c["softclip"], c["aligned_bases"]),
+                "PCT_HARDCLIP": _divide(c["hardclip"], c["aligned_bases"]),
+                "AVG_POS_3PRIME_SOFTCLIP_LENGTH":
+                    _divide(c["softclip3_bases"], c["softclip3_reads"])})
+
+    def metrics(self):
+        '''
+        Return a list with the metrics for each category.
+        '''
+
+        rows = []
+
+        categories = [x for x in ["FIRST_OF_PAIR", "SECOND_OF_PAIR",
+                                  "UNPAIRED"] if x in self.counts]
+
+        for category in categories:
+            rows.append(self._row(category, self.counts[category],
+                                  self.read_lengths[category],
+                                  self.hq_mismatch_hist[category]))
+
+        paired = [x for x in categories if x != "UNPAIRED"]
+
+        if len(paired) > 0:
+            c = dict.fromkeys(self.COUNTS, 0)
+            lengths, mismatch_hist = Counter(), Counter()
+
+            for category in paired:
+                for k, v in self.counts[category].items():
+                    c[k] += v
+                lengths.update(self.read_lengths[category])
+                mismatch_hist.update(self.hq_mismatch_hist[category])
+
+            rows.append(self._row("PAIR", c, lengths, mismatch_hist))
+
+        return(rows)
+
+    def write(self, metrics_file):
+
+        write_table(metrics_file, self.COLUMNS, self.metrics())
+
+
+def pair_orientation(read):
+    '''
+    Return the orientation (FR, RF or TANDEM) of a read pair, as Picard
+    SamPairUtil.getPairOrientation().
+    '''
+
+    if read.is_reverse == read.mate_is_reverse:
+        return("TANDEM")
+
+    if read.is_reverse:
+        positive_five_prime = read.next_reference_start
+        negative_five_prime = read.reference_end
+    else:
+        positive_five_prime = read.reference_start
+        negative_five_prime = read.reference_start + read.template_length
+
+    return("FR" if positive_five_prime < negative_five_prime else "RF")
+
+
+class insertSizeMetrics():
+    '''
+    Collect the Picard CollectInsertSizeMetrics metrics and histograms.
+    '''
+
+    COLUMNS = ["MEDIAN_INSERT_SIZE", "MODE_INSERT_SIZE",
+               "MEDIAN_ABSOLUTE_DEVIATION", "MIN_INSERT_SIZE",
+               "MAX_INSERT_SIZE", "MEAN_INSERT_SIZE", "STANDARD_DEVIATION",
+               "READ_PAIRS", "PAIR_ORIENTATION", "WIDTH_OF_10_PERCENT",
+               "WIDTH_OF_20_PERCENT", "WIDTH_OF_30_PERCENT",
+               "WIDTH_OF_40_PERCENT", "WIDTH_OF_50_PERCENT",
+               "WIDTH_OF_60_PERCENT", "WIDTH_OF_70_PERCENT",
+               "WIDTH_OF_80_PERCENT", "WIDTH_OF_90_PERCENT",
+               "WIDTH_OF_95_PERCENT", "WIDTH_OF_99_PERCENT", "SAMPLE",
+               "LIBRARY", "READ_GROUP"]
+
+    WIDTHS = [10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 99]
+
+    def __init__(self, minimum_pct=0.05, deviations=10):
+
+        self.minimum_pct = minimum_pct
+        self.deviations = deviations
+        self.histograms = {"FR": Counter(), "RF": Counter(),
+                           "TANDEM": Counter()}
+
+    def add(self, read):
+
+        # As for Picard, each pair is counted once (from the second read).
+        if (not read.is_paired or read.is_unmapped or
+                read.mate_is_unmapped or read.is_read1 or
+                read.is_secondary or read.is_supplementary or
+                read.is_duplicate or read.template_length == 0):
+            return
+
+        self.histograms[pair_orientation(read)][abs(read.template_length)] += 1
+
+    def _metrics(self, orientation, hist):
+
+        total = sum(hist.values())
+
+        median = histogram_median(hist)
+        mad = histogram_mad(hist)
+
+        metrics = {"MEDIAN_INSERT_SIZE": median,
+                   "MODE_INSERT_SIZE": max(hist.items(),
+                                           key=lambda x: (x[1], -x[0]))[0],
+                   "MEDIAN_ABSOLUTE_DEVIATION": mad,
+                   "MIN_INSERT_SIZE": min(hist.keys()),
+                   "MAX_INSERT_SIZE": max(hist.keys()),
+                   "READ_PAIRS": total,
+                   "PAIR_ORIENTATION": orientation}
+
+        low = high = median
+        covered = 0
+        widths = list(self.WIDTHS)
+        lowest, highest = min(hist.keys()), max(hist.keys())
+
+        while len(widths) > 0 and (low >= lowest - 1 or high <= highest + 1):
+
+            covered += hist.get(int(low), 0)
+            if low != high:
+                covered += hist.get(int(high), 0)
+
+            while len(widths) > 0 and covered / total >= widths[0] / 100.0:
+                metrics["WIDTH_OF_%i_PERCENT" % widths.pop(0)] = \
+                    int(high - low) + 1
+
+            low -= 1
+            high += 1
+
+        for width in widths:
+            metrics["WIDTH_OF_%i_PERCENT" % width] = 0
+
+        # trim the outliers (as for the histogram output)
+        trimmed = self._trim(hist, median, mad)
+        mean, sd = histogram_mean_sd(trimmed)
+        metrics["MEAN_INSERT_SIZE"] = mean
+        metrics["STANDARD_DEVIATION"] = sd
+
+        return(metrics)
+
+    def _trim(self, hist, median, mad):
+
+        limit = int(median + self.deviations * mad)
+
+        return(Counter({k: v for k, v in hist.items() if k <= limit}))
+
+    def included(self):
+        '''
+        Return the orientations that account for at least minimum_pct of
+        the pairs.
+        '''
+
+        total = sum([sum(h.values()) for h in self.histograms.values()])
+
+        return([o for o in ["FR", "RF", "TANDEM"]
+                if total > 0 and
+                sum(self.histograms[o].values()) >= self.minimum_pct * total])
+
+    def metrics(self):
+
+        return([self._metrics(o, self.histograms[o])
+                for o in self.included()])
+
+    def write(self, metrics_file, histogram_file):
+        '''
+        Write the metrics for the first included pair orientation (in
+        the Picard order FR, RF, TANDEM, as loaded by pipeline_bamqc) and
+        the histograms of all of the included orientations.
+        '''
+
+        write_table(metrics_file, self.COLUMNS, self.metrics()[:1])
+
+        orientations = self.included()
+
+        trimmed = {}
+        for o in orientations:
+            hist = self.histograms[o]
+            trimmed[o] = self._trim(hist, histogram_median(hist),
+                                    histogram_mad(hist))
+
+        sizes = sorted(set().union(*[h.keys() for h in trimmed.values()]))
+
+        with open(histogram_file, "w") as out_file:
+            out_file.write("\t".join(["insert_size"] +
+                                     ["All_Reads." + o.lower() + "_count"
+                                      for o in orientations]) + "\n")
+            for size in sizes:
+                out_file.write("\t".join([str(size)] +
+                                         [str(trimmed[o].get(size, 0))
+                                          for o in orientations]) + "\n")
+
+
+def estimate_library_size(read_pairs, unique_read_pairs):
+    '''
+    Estimate the library size from the number of read pairs and the
+    number of unique read pairs (as Picard DuplicationMetrics).
+    '''
+
+    duplicates = read_pairs - unique_read_pairs
+
+    if read_pairs == 0 or duplicates <= 0:
+        return(None)
+
+    n, c = float(read_pairs), float(unique_read_pairs)
+
+    def f(x):
+        return(c / x - 1 + math.exp(-n / x))
+
+    m, big_m = 1.0, 100.0
+
+    if c >= n or f(m * c) < 0:
+        return(None)
+
+    while f(big_m * c) >= 0:
+        big_m *= 10.0
+
+    for i in range(40):
+        r = (m + big_m) / 2.0
+        u = f(r * c)
+        if u == 0:
+            break
+        elif u > 0:
+            m = r
+        else:
+            big_m = r
+
+    return(int(c * (m + big_m) / 2.0))
+
+
+class libraryComplexity():
+    '''
+    Estimate the duplication rate and library size in the layout of
+    Picard EstimateLibraryComplexity.
+
+    Reads (or read pairs) are taken to be duplicates when they share
+    the same unclipped 5' positions and strands.
+    '''
+
+    COLUMNS = ["LIBRARY", "UNPAIRED_READS_EXAMINED", "READ_PAIRS_EXAMINED",
+               "SECONDARY_OR_SUPPLEMENTARY_RDS", "UNMAPPED_READS",
+               "UNPAIRED_READ_DUPLICATES", "READ_PAIR_DUPLICATES",
+               "READ_PAIR_OPTICAL_DUPLICATES", "PERCENT_DUPLICATION",
+               "ESTIMATED_LIBRARY_SIZE"]
+
+    def __init__(self):
+
+        self.pair_keys = array("q")
+        self.unpaired_keys = array("q")
+        self.secondary = 0
+        self.unmapped = 0
+
+    def add(self, read):
+
+        if read.is_secondary or read.is_supplementary:
+            self.secondary += 1
+            return
+
+        if read.is_unmapped:
+            self.unmapped += 1
+            return
+
+        five_prime = unclipped_five_prime(read)
+
+        if read.is_paired and not read.mate_is_unmapped:
+
+            if not read.is_read1:
+                return
+
+            mate_five_prime = read.next_reference_start
+
+            if read.has_tag("MC"):
+                mate_five_prime = _mate_five_prime(read)
+
+            # the ends are ordered (as by MarkDuplicates) so that the
+            # same fragment read in either orientation has the same key.
+            end = (read.reference_id, five_prime, read.is_reverse)
+            mate_end = (read.next_reference_id, mate_five_prime,
+                        read.mate_is_reverse)
+
+            self.pair_keys.append(hash((min(end, mate_end),
+                                        max(end, mate_end))))
+        else:
+            self.unpaired_keys.append(hash((read.reference_id, five_prime,
+                                            read.is_reverse)))
+
+    def metrics(self):
+
+        pairs = len(self.pair_keys)
+        unpaired = len(self.unpaired_keys)
+
+        unique_pairs = len(np.unique(np.frombuffer(self.pair_keys,
+                                                   dtype=np.int64)))
+        unique_unpaired = len(np.unique(np.frombuffer(self.unpaired_keys,
+                                                      dtype=np.int64)))
+
+        pair_duplicates = pairs - unique_pairs
+        unpaired_duplicates = unpaired - unique_unpaired
+
+        return({"LIBRARY": "",
+                "UNPAIRED_READS_EXAMINED": unpaired,
+                "READ_PAIRS_EXAMINED": pairs,
+                "SECONDARY_OR_SUPPLEMENTARY_RDS": self.secondary,
+                "UNMAPPED_READS": self.unmapped,
+                "UNPAIRED_READ_DUPLICATES": unpaired_duplicates,
+                "READ_PAIR_DUPLICATES": pair_duplicates,
+                "READ_PAIR_OPTICAL_DUPLICATES": 0,
+                "PERCENT_DUPLICATION": _divide(
+                    unpaired_duplicates + pair_duplicates * 2,
+                    unpaired + pairs * 2),
+                "ESTIMATED_LIBRARY_SIZE": estimate_library_size(pairs,
+                                                                unique_pairs)})
+
+    def write(self, metrics_file):
+
+        write_table(metrics_file, self.COLUMNS, [self.metrics()])
+
+
+def _mate_five_prime(read):
+    '''
+    Return the unclipped 5' position of the mate from the MC (mate
+    CIGAR) tag.
+    '''
+
+    mate_cigar = read.get_tag("MC")
+
+    ops = []
+    number = ""
+    for char in mate_cigar:
+        if char.isdigit():
+            number += char
+        else:
+            ops.append((char, int(number)))
+            number = ""
+
+    if read.mate_is_reverse:
+        end = read.next_reference_start + sum([n for op, n in ops
+                                               if op in "MDN=X"])
+        clip = ops[-1][1] if ops[-1][0] in "SH" else 0
+        return(end + clip)
+
+    clip = ops[0][1] if ops[0][0] in "SH" else 0
+    return(read.next_reference_start - clip)
+
+
+class fractionSpliced():
+    '''
+    Count the fraction of uniquely mapped reads (NH:i:1) that are
+    spliced (i.e. that contain an "N" CIGAR operation), per contig.
+    '''
+
+    def __init__(self):
+
+        # contig: [spliced, unspliced]
+        self.counts = {}
+
+    def add(self, read):
+
+        if read.is_unmapped or not read.has_tag("NH") or \
+           read.get_tag("NH") != 1:
+            return
+
+        counts = self.counts.get(read.reference_name)
+
+        if counts is None:
+            counts = self.counts[read.reference_name] = [0, 0]
+
+        if any(op == N for op, n in read.cigartuples):
+            counts[0] += 1
+        else:
+            counts[1] += 1
+
+    def merge(self, counts):
+        '''
+        Add per contig counts (e.g. from another region of the BAM file).
+        '''
+
+        for contig, (spliced, unspliced) in counts.items():
+            total = self.counts.setdefault(contig, [0, 0])
+            total[0] += spliced
+            total[1] += unspliced
+
+    def fraction(self):
+
+        spliced = sum([x[0] for x in self.counts.values()])
+        unspliced = sum([x[1] for x in self.counts.values()])
+
+        return(_divide(spliced, spliced + unspliced))
+
+    def write(self, outfile, contigs_outfile=None):
+        '''
+        Write the genome-wide fraction (with the numbers of spliced and
+        unspliced reads) and, optionally, a table of the per contig
+        counts.
+        '''
+
+        spliced = sum([x[0] for x in self.counts.values()])
+        unspliced = sum([x[1] for x in self.counts.values()])
+
+        write_table(outfile, ["fraction_spliced", "spliced", "unspliced"],
+                    [{"fraction_spliced": self.fraction(),
+                      "spliced": spliced,
+                      "unspliced": unspliced}])
+
+        if contigs_outfile is not None:
+            rows = [{"contig": contig,
+                     "spliced": spliced,
+                     "unspliced": unspliced,
+                     "fraction_spliced": _divide(spliced,
+                                                 spliced + unspliced)}
+                    for contig, (spliced, unspliced) in self.counts.items()]
+
+            write_table(contigs_outfile,
+                        ["contig", "spliced", "unspliced",
+                         "fraction_spliced"], rows)
+
+
+# the BAM file opened by each region worker process
+_region_bam = {}
+
+
+def _open_region_bam(bam_file):
+
+    import pysam
+
+    _region_bam["bam"] = pysam.AlignmentFile(bam_file, "rb")
+
+
+def _count_spliced_region(region):
+    '''
+    Return the per contig spliced and unspliced counts for the reads
+    that start in the region (contig, start, end).
+    '''
+
+    contig, start, end = region
+
+    counter = fractionSpliced()
+
+    for read in _region_bam["bam"].fetch(contig, start, end):
+
+        # reads that start before the region are counted with the
+        # region in which they start.
+        if read.reference_start >= start:
+            counter.add(read)
+
+    return(counter.counts)
+
+
+def bam_regions(bam_file, chunk_size=10000000):
+    '''
+    Return a list of (contig, start, end) regions of up to *chunk_size*
+    bases covering the contigs that have mapped reads (according to
+    the BAM index), largest contigs first.
+    '''
+
+    import pysam
+
+    regions = []
+
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+
+        contigs = [x.contig for x in bam.get_index_statistics()
+                   if x.mapped > 0]
+
+        lengths = {contig: bam.get_reference_length(contig)
+                   for contig in contigs}
+
+    for contig in sorted(contigs, key=lambda x: -lengths[x]):
+        for start in range(0, lengths[contig], chunk_size):
+            regions.append((contig, start,
+                            min(start + chunk_size, lengths[contig])))
+
+    return(regions)
+
+
+def fraction_spliced(bam_file, processes=1, chunk_size=10000000):
+    '''
+    Count the spliced and unspliced uniquely mapped reads in an indexed
+    BAM file by splitting it into regions that are read in parallel by
+    a pool of *processes*. Returns a :class:`fractionSpliced` instance.
+
+    If the BAM file is not indexed it is read in a single pass.
+    '''
+
+    import pysam
+    import multiprocessing
+
+    counter = fractionSpliced()
+
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+        indexed = bam.has_index()
+
+    if not indexed:
+        collect(bam_file, [counter], threads=processes)
+        return(counter)
+
+    regions = bam_regions(bam_file, chunk_size)
+
+    if processes <= 1:
+        _open_region_bam(bam_file)
+
+        for region in regions:
+            counter.merge(_count_spliced_region(region))
+
+        _region_bam.pop("bam").close()
+
+    else:
+        with multiprocessing.Pool(processes,
+                                  initializer=_open_region_bam,
+                                  initargs=(bam_file,)) as pool:
+
+            for counts in pool.imap_unordered(_count_spliced_region,
+                                              regions):
+                counter.merge(counts)
+
+    return(counter)
+
+
+# --------------------------------- engine ---------------------------------- #
+
+def collect(bam_file, collectors, threads=1):
+    '''
+    Read the BAM file once and pass each record to all of the
+    *collectors*. Returns the number of records read.
+    '''
+
+    import pysam
+
+    n = 0
+    add = [c.add for c in collectors]
+
+    with pysam.AlignmentFile(bam_file, "rb", threads=threads) as bam:
+        for read in bam.fetch(until_eof=True):
+            for f in add:
+                f(read)
+            n += 1
+
+    return(n)
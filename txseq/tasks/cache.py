@@ -0,0 +1,293 @@
+'''
+cache.py
+========
+
+Overview
+--------
+
+A shared, content-addressed cache for expensive build outputs such as
+the Salmon and HISAT2 indexes.
+
+Cache entries are keyed by a hash of the contents of the input files,
+the version of the tool and the build options. When a matching entry
+exists its files are symlinked into the working directory instead of
+being rebuilt. Builds run in a temporary directory inside the cache and
+are moved into place only once complete, under an exclusive (fcntl)
+lock on the key, so that concurrent projects wait for a single build of
+the same index rather than racing to build it.
+
+The content digests of the input files are remembered (by path, size
+and modification time) in the cache directory so that large FASTA files
+are only hashed once.
+
+The cache is meant to be shared (e.g. by the members of a group), so the
+entries, digests and lock files are given the permissions of the umask
+rather than those of the temporary files they are made from.
+
+Usage
+-----
+
+.. code-block:: python
+
+    import txseq.tasks.cache as cache
+
+    index_cache = cache.indexCache("/shared/txseq/index.cache")
+
+    key = index_cache.key({"genome": "genome.fa.gz"},
+                          version=cache.tool_version("salmon"),
+                          options={"k": 31})
+
+    with index_cache.lock(key):
+
+        if not index_cache.fetch(key, "."):
+
+            build_dir = index_cache.build_dir(key)
+            # ... build the index in build_dir ...
+            index_cache.store(key, build_dir)
+            index_cache.fetch(key, ".")
+
+Functions
+---------
+
+'''
+
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import datetime
+import subprocess
+import contextlib
+
+
+# The file that marks a complete cache entry and records how it was built.
+INFO_FILE = "cache.info.json"
+
+# The file in which the input file digests are remembered.
+DIGESTS_FILE = "digests.json"
+
+
+def file_digest(path, block_size=1 << 20):
+    '''
+    Return the sha256 hex digest of the contents of a file.
+    '''
+
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as infile:
+        for block in iter(lambda: infile.read(block_size), b""):
+            digest.update(block)
+
+    return(digest.hexdigest())
+
+
+def tool_version(cmd, flag="--version"):
+    '''
+    Return the first line of the output of "cmd --version", or None if
+    the tool cannot be run.
+    '''
+
+    try:
+        result = subprocess.run([cmd, flag], capture_output=True, text=True,
+                                timeout=120)
+    except (OSError, subprocess.TimeoutExpired):
+        return(None)
+
+    lines = (result.stdout + result.stderr).strip().splitlines()
+
+    if len(lines) == 0:
+        return(None)
+
+    return(lines[0].strip())
+
+
+def _chmod(path, mode):
+    '''
+    Set the permissions of *path* to *mode* less the process umask.
+    '''
+
+    # the umask can only be read by setting it
+    umask = os.umask(0)
+    os.umask(umask)
+
+    os.chmod(path, mode & ~umask)
+
+
+class indexCache():
+    '''
+    A content-addressed cache of build outputs in the directory
+    *cache_dir* (which is created if necessary).
+    '''
+
+    def __init__(self, cache_dir):
+
+        self.cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _digest(self, path):
+        '''
+        Return the digest of a file, using the remembered digest if the
+        file has not changed.
+        '''
+
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime]
+
+        digests_file = os.path.join(self.cache_dir, DIGESTS_FILE)
+
+        with self.lock(DIGESTS_FILE):
+
+            digests = {}
+            if os.path.exists(digests_file):
+                with open(digests_file, "r") as infile:
+                    digests = json.load(infile)
+
+            if path in digests and digests[path]["stamp"] == stamp:
+                return(digests[path]["sha256"])
+
+        # hash outside of the lock: this can take a while
+        sha256 = file_digest(path)
+
+        with self.lock(DIGESTS_FILE):
+
+            if os.path.exists(digests_file):
+                with open(digests_file, "r") as infile:
+                    digests = json.load(infile)
+
+            digests[path] = {"stamp": stamp, "sha256": sha256}
+
+            tmp = digests_file + ".tmp"
+            with open(tmp, "w") as outfile:
+                json.dump(digests, outfile, indent=1)
+            _chmod(tmp, 0o666)
+            os.replace(tmp, digests_file)
+
+        return(sha256)
+
+    def key(self, infiles, version=None, options=None):
+        '''
+        Return the cache key for a build from the dictionary of named
+        input files *infiles*, the tool *version* string and a
+        dictionary of build *options*.
+        '''
+
+        for name, path in infiles.items():
+            if path is None or not os.path.exists(path):
+                raise ValueError("Input file for the cache key not found: "
+                                 + str(name) + ": " + str(path))
+
+        spec = {"inputs": {name: self._digest(path)
+                           for name, path in sorted(infiles.items())},
+                "version": version,
+                "options": {name: str(value)
+                            for name, value in sorted((options or {}).items())}}
+
+        return(hashlib.sha256(json.dumps(spec, sort_keys=True)
+                              .encode()).hexdigest())
+
+    def path(self, key):
+        '''
+        Return the path of the cache entry for *key*.
+        '''
+
+        return(os.path.join(self.cache_dir, key))
+
+    def exists(self, key):
+        '''
+        Return True if there is a complete cache entry for *key*.
+        '''
+
+        return(os.path.exists(os.path.join(self.path(key), INFO_FILE)))
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        '''
+        A context manager that holds an exclusive lock on *key*. Blocks
+        until the lock is available.
+        '''
+
+        path = os.path.join(self.cache_dir, key + ".lock")
+        created = not os.path.exists(path)
+
+        lock_file = open(path, "a")
+
+        if created:
+            try:
+                _chmod(path, 0o666)
+            except OSError:
+                # created by another user in the meantime
+                pass
+
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def fetch(self, key, outdir):
+        '''
+        Symlink the files of the cache entry for *key* into *outdir*.
+        Returns False if there is no complete entry.
+        '''
+
+        if not self.exists(key):
+            return(False)
+
+        entry = self.path(key)
+
+        os.makedirs(outdir, exist_ok=True)
+
+        for name in sorted(os.listdir(entry)):
+
+            if name == INFO_FILE:
+                continue
+
+            link = os.path.join(outdir, name)
+
+            if os.path.islink(link):
+                os.unlink(link)
+            elif os.path.isdir(link):
+                shutil.rmtree(link)
+            elif os.path.exists(link):
+                os.unlink(link)
+
+            os.symlink(os.path.join(entry, name), link)
+
+        return(True)
+
+    def build_dir(self, key):
+        '''
+        Return a new temporary directory inside the cache in which to
+        build the entry for *key* (see :meth:`store`).
+        '''
+
+        return(tempfile.mkdtemp(prefix=key + ".build.", dir=self.cache_dir))
+
+    def store(self, key, build_dir, info=None):
+        '''
+        Move the complete build in *build_dir* into the cache as the
+        entry for *key*, recording the optional *info* dictionary.
+        '''
+
+        record = {"key": key,
+                  "created": datetime.datetime.now().isoformat(
+                      timespec="seconds")}
+        record.update(info or {})
+
+        with open(os.path.join(build_dir, INFO_FILE), "w") as outfile:
+            json.dump(record, outfile, indent=1)
+
+        entry = self.path(key)
+
+        if os.path.exists(entry):
+            # an incomplete entry
+            shutil.rmtree(entry)
+
+        # mkdtemp() makes the build directory private
+        _chmod(build_dir, 0o777)
+
+        os.rename(build_dir, entry)
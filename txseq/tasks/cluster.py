@@ -0,0 +1,195 @@
+'''
+cluster.py
+==========
+
+Overview
+--------
+
+Helper functions for finding out why a cluster job failed from the
+SLURM (sacct) or SGE (qacct) accounting records.
+
+These are used by :meth:`txseq.tasks.setup.setup.escalate` to decide
+whether a job that was killed for exceeding its memory (or time) limit
+should be resubmitted with a larger request.
+
+Functions
+---------
+
+'''
+
+import re
+import subprocess
+
+
+def failed_job_id(error):
+    '''
+    Return the scheduler job id from the exception raised by cgat-core
+    P.run() when a job fails, or None if it cannot be found.
+    '''
+
+    match = re.search(r"[Jj]ob (\d+(?:\.\d+)?)\b", str(error))
+
+    if match is None:
+        return(None)
+
+    return(match.group(1))
+
+
+def _command(cmd):
+    '''
+    Run an accounting command and return its output or None on failure.
+    '''
+
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True,
+                                timeout=120)
+    except (OSError, subprocess.TimeoutExpired):
+        return(None)
+
+    if result.returncode != 0:
+        return(None)
+
+    return(result.stdout)
+
+
+def parse_time(value):
+    '''
+    Return the number of seconds in a time limit given as
+    [days-]hours:minutes:seconds (or minutes:seconds), or None.
+    '''
+
+    match = re.match(r"^(?:(\d+)-)?(?:(\d+):)?(\d+):(\d+)$", value.strip())
+
+    if match is None:
+        return(None)
+
+    days, hours, minutes, seconds = [int(x) if x else 0
+                                     for x in match.groups()]
+
+    return(((days * 24 + hours) * 60 + minutes) * 60 + seconds)
+
+
+def format_time(seconds):
+    '''
+    Return the number of seconds as a days-hours:minutes:seconds string.
+    '''
+
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+
+    return("%i-%02i:%02i:%02i" % (days, hours, minutes, seconds))
+
+
+def slurm_failure(job_id):
+    '''
+    Return a dictionary with the "reason" ("memory", "time" or None)
+    that a SLURM job failed and its "time_limit" in seconds.
+    '''
+
+    out = _command(["sacct", "-j", str(job_id), "--noheader",
+                    "--parsable2", "--format=State,Timelimit"])
+
+    failure = {"reason": None, "time_limit": None}
+
+    if out is None:
+        return(failure)
+
+    for line in out.splitlines():
+
+        fields = line.strip().split("|")
+
+        if len(fields) < 2:
+            continue
+
+        state = fields[0].split(" ")[0]
+
+        if state == "OUT_OF_MEMORY":
+            failure["reason"] = "memory"
+
+        elif state == "TIMEOUT" and failure["reason"] is None:
+            failure["reason"] = "time"
+
+        if failure["time_limit"] is None:
+            failure["time_limit"] = parse_time(fields[1])
+
+    return(failure)
+
+
+def sge_failure(job_id, memory_gb=None):
+    '''
+    Return a dictionary with the "reason" ("memory", "time" or None)
+    that an SGE job failed and its "time_limit" in seconds.
+
+    SGE reports that a limit was enforced without saying which, so a job
+    is taken to have run out of memory if its peak memory reached the
+    amount requested (*memory_gb*).
+    '''
+
+    out = _command(["qacct", "-j", str(job_id)])
+
+    failure = {"reason": None, "time_limit": None}
+
+    if out is None:
+        return(failure)
+
+    acct = {}
+    for line in out.splitlines():
+        fields = line.strip().split(None, 1)
+        if len(fields) == 2:
+            acct[fields[0]] = fields[1].strip()
+
+    failed = acct.get("failed", "0").split(" ")[0]
+    exit_status = acct.get("exit_status", "0")
+
+    if failed == "0" and exit_status not in ("137", "152"):
+        return(failure)
+
+    maxvmem = acct.get("maxvmem", "0")
+    units = {"K": 1E-6, "M": 1E-3, "G": 1, "T": 1E3}
+
+    if maxvmem[-1:] in units:
+        used_gb = float(maxvmem[:-1]) * units[maxvmem[-1]]
+    else:
+        used_gb = float(maxvmem) / 1E9
+
+    if memory_gb and used_gb >= 0.95 * memory_gb:
+        failure["reason"] = "memory"
+
+    elif failed == "37" or exit_status == "152":
+        failure["reason"] = "time"
+
+    return(failure)
+
+
+def job_failure(error, queue_manager, memory_gb=None):
+    '''
+    Return a dictionary with the "job_id", the "reason" ("memory", "time"
+    or None) and the "time_limit" (seconds) of a failed job, given the
+    exception raised by P.run().
+    '''
+
+    job_id = failed_job_id(error)
+
+    failure = {"reason": None, "time_limit": None}
+
+    # cgat-core reports the final job state in the error for
+    # some executors.
+    if "OUT_OF_MEMORY" in str(error):
+        failure["reason"] = "memory"
+
+    if job_id is not None and queue_manager == "slurm":
+        failure.update({k: v for k, v in slurm_failure(job_id).items()
+                        if v is not None})
+
+    elif job_id is not None and queue_manager == "sge":
+        failure.update({k: v for k, v in sge_failure(job_id, memory_gb).items()
+                        if v is not None})
+
+    if failure["reason"] is None and "TIMEOUT" in str(error):
+        failure["reason"] = "time"
+
+    failure["job_id"] = job_id
+
+    return(failure)
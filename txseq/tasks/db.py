@@ -0,0 +1,542 @@
+'''
+db.py
+=====
+
+Overview
+--------
+
+Helper functions for loading tab-separated tables into the project
+sqlite database in process. Large tables (e.g. the per-sample salmon
+and featureCounts tables) are loaded in a cluster job by running
+python/db_concatenate_and_load.py, which calls
+:func:`concatenate_and_load`.
+
+The :class:`tableLoader` class collects the (per-sample) files of one or
+more tables and writes them to the database in a single transaction:
+
+* each file is read (with pandas) and its rows are inserted with a
+  prepared "INSERT" statement (sqlite3 executemany), so that only one
+  file is held in memory at a time
+* columns that are missing from some of the files are filled with NULL
+  and new columns are added to the table as they are found
+* the indexes are created once all of the rows have been inserted
+* the database is put in WAL mode so that readers do not block the load
+
+The size and modification time of each loaded file is recorded in a
+manifest table ("load_manifest"). In incremental mode, the rows of an
+existing table are only replaced for the files that are new or that
+have changed since they were loaded (and removed for the files that are
+no longer given) so that adding samples to a project does not reload
+the whole table. The time at which each track was (re)loaded is kept in
+the manifest so that derived tables (e.g. the wide matrices) can also be
+updated incrementally (see :func:`updated_tracks`).
+
+The tables are laid out as by cgat-core P.concatenate_and_load(): the
+values extracted from the file names by the *regex_filename* are added
+in the first column(s) (named by *cat*) and existing tables are
+replaced.
+
+Usage
+-----
+
+.. code-block:: python
+
+    import txseq.tasks.db as db
+
+    loader = db.tableLoader("csvdb")
+
+    loader.add("qc_fraction_spliced",
+               ["a.fraction.spliced", "b.fraction.spliced"],
+               regex_filename=".*/(.*).fraction.spliced",
+               cat="sample_id",
+               indexes=["sample_id"])
+
+    loader.load()
+
+Functions
+---------
+
+'''
+
+import os
+import re
+import time
+import sqlite3
+import datetime
+
+import pandas as pd
+
+
+# Values read as missing (in addition to the pandas defaults), as used
+# by cgat-core.
+NA_VALUES = ["na"]
+
+# The table in which the loaded files are recorded.
+MANIFEST_TABLE = "load_manifest"
+
+# The separator used to record the values of multiple cat columns as a
+# single track in the manifest.
+TRACK_SEP = "\t"
+
+
+def quote_table(name):
+    '''
+    Return a name that is suitable as an sqlite table name (as cgat-core
+    csv2db).
+    '''
+
+    if name[0] in "0123456789":
+        name = "_" + name
+
+    return(re.sub(r"[-(),\[\].:]", "_", name))
+
+
+def table_name(outfile):
+    '''
+    Return the table name for a ".load" file (as cgat-core
+    P.to_table()).
+    '''
+
+    if not outfile.endswith(".load"):
+        raise ValueError("Load file names must end with .load: " + outfile)
+
+    return(quote_table(os.path.basename(outfile)[:-len(".load")]))
+
+
+def _column(name):
+    return('"' + str(name).replace('"', '""') + '"')
+
+
+def _sql_type(dtype):
+
+    if pd.api.types.is_bool_dtype(dtype) or \
+       pd.api.types.is_integer_dtype(dtype):
+        return("INTEGER")
+
+    if pd.api.types.is_float_dtype(dtype):
+        return("REAL")
+
+    return("TEXT")
+
+
+def connect(database, timeout=600):
+    '''
+    Connect to the database in WAL mode. Transactions are managed
+    explicitly (isolation_level=None).
+    '''
+
+    con = sqlite3.connect(database, timeout=timeout, isolation_level=None)
+
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+
+    return(con)
+
+
+def table_exists(con, table):
+    '''
+    Return True if the *table* exists in the database.
+    '''
+
+    result = con.execute("SELECT name FROM sqlite_master "
+                         "WHERE type='table' AND name=?", (table,))
+
+    return(result.fetchone() is not None)
+
+
+def table_columns(con, table):
+    '''
+    Return the list of the column names of the *table*.
+    '''
+
+    return([x[1] for x in
+            con.execute("PRAGMA table_info(%s)" % _column(table))])
+
+
+def file_stat(path):
+    '''
+    Return the (modification time, size) of a file.
+    '''
+
+    stat = os.stat(path)
+
+    return((stat.st_mtime, stat.st_size))
+
+
+def _create_manifest(con):
+
+    con.execute("CREATE TABLE IF NOT EXISTS %s "
+                "(table_name TEXT, path TEXT, track TEXT, "
+                "mtime REAL, size INTEGER, loaded REAL)" % MANIFEST_TABLE)
+
+
+def read_manifest(con, table):
+    '''
+    Return a dictionary of the files recorded as loaded to the *table*
+    {path: (mtime, size, track, loaded)}.
+    '''
+
+    if not table_exists(con, MANIFEST_TABLE):
+        return({})
+
+    rows = con.execute("SELECT path, mtime, size, track, loaded FROM %s "
+                       "WHERE table_name=?" % MANIFEST_TABLE, (table,))
+
+    return({x[0]: tuple(x[1:]) for x in rows})
+
+
+def updated_tracks(database, table, since):
+    '''
+    Return a tuple of the lists of (i) the tracks of the *table* that
+    were (re)loaded after the time *since* (seconds since the epoch) and
+    (ii) all of the tracks currently in the table, as recorded in the
+    manifest. Returns None if the table is not in the manifest.
+    '''
+
+    con = sqlite3.connect(database)
+
+    try:
+        manifest = read_manifest(con, table)
+    finally:
+        con.close()
+
+    if len(manifest) == 0:
+        return(None)
+
+    tracks = []
+    updated = []
+
+    for mtime, size, track, loaded in manifest.values():
+        if track not in tracks:
+            tracks.append(track)
+        if loaded > since and track not in updated:
+            updated.append(track)
+
+    return(updated, tracks)
+
+
+def read_table(path, has_titles=True, names=None):
+    '''
+    Read a tab-separated table. Returns None if the file is empty.
+    '''
+
+    try:
+        df = pd.read_csv(path, sep="\t", comment="#", index_col=False,
+                         header=0 if has_titles else None, names=names,
+                         na_values=NA_VALUES)
+
+    except pd.errors.EmptyDataError:
+        return(None)
+
+    return(df)
+
+
+def track_values(path, regex_filename, n):
+    '''
+    Return the values for the *n* track columns extracted from the file
+    name with the regular expression.
+    '''
+
+    if regex_filename is None:
+        groups = (path,)
+    else:
+        match = re.search(regex_filename, path)
+
+        if match is None:
+            raise ValueError("Cannot extract the track from the file name: " +
+                             path + " using " + regex_filename)
+
+        groups = match.groups()
+
+    if len(groups) != n:
+        raise ValueError("The number of groups in regex_filename (%i) "
+                         "differs from the number of cat columns (%i)" %
+                         (len(groups), n))
+
+    return(list(groups))
+
+
+class tableLoader():
+    '''
+    Collect the files of one or more tables and load them to the sqlite
+    *database* in a single transaction.
+
+    If *incremental* is True, existing tables are only updated with the
+    rows of the files that are new or changed (by size and modification
+    time). Tables without *cat* columns are always fully reloaded.
+    '''
+
+    def __init__(self, database, incremental=False):
+
+        self.database = database
+        self.incremental = incremental
+        self.tables = []
+
+        # the tracks that were (re)loaded or removed, per table
+        self.updated = {}
+
+    def add(self, table, infiles, regex_filename=None, cat="track",
+            has_titles=True, header=None, indexes=None):
+        '''
+        Add a table to be loaded from the tab-separated *infiles*.
+
+        Arguments are as for cgat-core P.concatenate_and_load():
+
+        * regex_filename: a regular expression applied to each file name
+          to extract the values of the *cat* column(s)
+        * cat: comma-separated names of the columns holding the values
+          extracted from the file names. If None, no columns are added.
+        * has_titles: whether the files have a header line
+        * header: comma-separated names of all of the columns (including
+          the *cat* columns) when the files do not have a header line.
+        * indexes: columns to index (in addition to the *cat* columns).
+        '''
+
+        cat_columns = [] if cat is None else \
+            [x.strip() for x in cat.split(",")]
+
+        if not has_titles and header is None:
+            raise ValueError("header names are required if the files "
+                             "have no titles")
+
+        index_columns = list(cat_columns)
+
+        for index in indexes or []:
+            if index not in index_columns:
+                index_columns.append(index)
+
+        self.tables.append({"table": quote_table(table),
+                            "infiles": list(infiles),
+                            "regex_filename": regex_filename,
+                            "cat_columns": cat_columns,
+                            "has_titles": has_titles,
+                            "header": header,
+                            "indexes": index_columns})
+
+    def _stale_tracks(self, con, table, infiles, regex_filename,
+                      cat_columns, stats):
+        '''
+        Return the files that need to be loaded to an existing table and
+        the tracks for which the existing rows must be deleted.
+        '''
+
+        manifest = read_manifest(con, table)
+
+        load_files = [x for x in infiles if x not in manifest or
+                      tuple(manifest[x][:2]) != stats[x]]
+
+        stale = set([manifest[x][2] for x in manifest
+                     if x not in infiles or x in load_files])
+
+        for infile in load_files:
+            stale.add(TRACK_SEP.join(
+                track_values(infile, regex_filename, len(cat_columns))))
+
+        return(load_files, sorted(stale))
+
+    def _write_manifest(self, con, table, infiles, load_files, regex_filename,
+                        cat_columns, stats):
+
+        _create_manifest(con)
+
+        loaded = time.time()
+
+        # the entries of the unchanged files are kept
+        keep = set(infiles) - set(load_files)
+
+        con.executemany("DELETE FROM %s WHERE table_name=? AND path=?"
+                        % MANIFEST_TABLE,
+                        [(table, x) for x in read_manifest(con, table)
+                         if x not in keep])
+
+        rows = []
+
+        for infile in load_files:
+            track = TRACK_SEP.join(
+                track_values(infile, regex_filename, len(cat_columns))) \
+                if len(cat_columns) > 0 else infile
+            rows.append((table, infile, track) + stats[infile] + (loaded,))
+
+        con.executemany("INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?)"
+                        % MANIFEST_TABLE, rows)
+
+    def _load_table(self, con, table, infiles, regex_filename, cat_columns,
+                    has_titles, header, indexes):
+
+        names = None
+
+        if header is not None:
+            names = [x.strip() for x in header.split(",")]
+            if not has_titles:
+                names = names[len(cat_columns):]
+
+        stats = {x: file_stat(x) for x in infiles}
+
+        update = self.incremental and len(cat_columns) > 0 and \
+            table_exists(con, table)
+
+        if update:
+            load_files, stale = self._stale_tracks(
+                con, table, infiles, regex_filename, cat_columns, stats)
+
+            con.executemany("DELETE FROM %s WHERE %s" % (
+                _column(table),
+                " AND ".join([_column(x) + "=?" for x in cat_columns])),
+                [x.split(TRACK_SEP) for x in stale])
+
+            columns = table_columns(con, table)
+
+        else:
+            con.execute("DROP TABLE IF EXISTS " + _column(table))
+            load_files = list(infiles)
+            stale = None
+            columns = []
+
+        n_rows = 0
+
+        for infile in load_files:
+
+            df = read_table(infile, has_titles=has_titles, names=names)
+
+            if df is None:
+                continue
+
+            if has_titles and names is not None:
+                df.columns = names[len(cat_columns):]
+
+            # as cgat-core, file columns with the name of a cat column
+            # are dropped
+            df = df[[x for x in df.columns if x not in cat_columns]]
+
+            for name, value in zip(cat_columns,
+                                   track_values(infile, regex_filename,
+                                                len(cat_columns))):
+                df.insert(cat_columns.index(name), name, value)
+
+            if len(columns) == 0:
+                columns = list(df.columns)
+                con.execute("CREATE TABLE %s (%s)" % (
+                    _column(table),
+                    ", ".join([_column(x) + " " + _sql_type(df[x].dtype)
+                               for x in columns])))
+
+            for name in df.columns:
+                if name not in columns:
+                    columns.append(name)
+                    con.execute("ALTER TABLE %s ADD COLUMN %s %s" % (
+                        _column(table), _column(name),
+                        _sql_type(df[name].dtype)))
+
+            if len(df) == 0:
+                continue
+
+            file_columns = list(df.columns)
+
+            rows = df.astype(object).where(df.notna(), None)
+
+            con.executemany("INSERT INTO %s (%s) VALUES (%s)" % (
+                _column(table),
+                ", ".join([_column(x) for x in file_columns]),
+                ", ".join(["?"] * len(file_columns))),
+                rows.itertuples(index=False, name=None))
+
+            n_rows += len(df)
+
+        if len(columns) == 0:
+            raise ValueError("No data found to load to table " + table)
+
+        self._write_manifest(con, table, infiles, load_files, regex_filename,
+                             cat_columns, stats)
+
+        self.updated[table] = stale
+
+        return(columns, n_rows, not update)
+
+    def load(self):
+        '''
+        Load all of the tables. Returns a dictionary of the number of
+        rows loaded per table.
+
+        The tracks that were updated in each table are recorded in the
+        *updated* attribute (None for tables that were fully reloaded).
+        '''
+
+        con = connect(self.database)
+        loaded = {}
+
+        try:
+            con.execute("BEGIN IMMEDIATE")
+
+            created = {}
+
+            for spec in self.tables:
+                columns, n_rows, new_table = self._load_table(con, **spec)
+                if new_table:
+                    created[spec["table"]] = columns
+                loaded[spec["table"]] = n_rows
+
+            # the indexes are built once all of the rows are inserted
+            # (the indexes of updated tables are kept)
+            for spec in self.tables:
+                if spec["table"] not in created:
+                    continue
+                n = 0
+                for index in spec["indexes"]:
+                    if index not in created[spec["table"]]:
+                        continue
+                    n += 1
+                    con.execute("CREATE INDEX %s ON %s (%s)" % (
+                        _column(spec["table"] + "_index" + str(n)),
+                        _column(spec["table"]), _column(index)))
+
+            con.execute("COMMIT")
+
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+
+        finally:
+            con.close()
+
+        return(loaded)
+
+
+def write_load_log(outfile, loaded):
+    '''
+    Write the number of rows loaded per table to the ".load" file.
+    '''
+
+    with open(outfile, "w") as out_file:
+        out_file.write("# loaded %s\n" %
+                       datetime.datetime.now().isoformat(timespec="seconds"))
+        out_file.write("table\trows\n")
+        for table, n_rows in loaded.items():
+            out_file.write("%s\t%i\n" % (table, n_rows))
+
+
+def concatenate_and_load(infiles, outfile, database, regex_filename=None,
+                         cat="track", has_titles=True, header=None,
+                         indexes=None, tablename=None, incremental=False):
+    '''
+    Concatenate the tab-separated *infiles* and load them to a table of
+    the *database* named after the *outfile* (as cgat-core
+    P.concatenate_and_load(), but in process). The number of rows loaded
+    is written to the *outfile*.
+
+    If *incremental* is True, only the new or changed files are loaded
+    to an existing table (see :class:`tableLoader`).
+    '''
+
+    if tablename is None:
+        tablename = table_name(outfile)
+
+    loader = tableLoader(database, incremental=incremental)
+
+    loader.add(tablename, infiles, regex_filename=regex_filename, cat=cat,
+               has_titles=has_titles, header=header, indexes=indexes)
+
+    loaded = loader.load()
+
+    write_load_log(outfile, loaded)
+
+    return(loaded)
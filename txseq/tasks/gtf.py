@@ -0,0 +1,378 @@
+'''
+gtf.py
+======
+
+Overview
+--------
+
+Helper functions for streaming gzip compressed Ensembl GTF files.
+
+The :func:`stream_gtf` function reads a GTF file once and passes every
+record to a set of output "sinks" so that e.g. a filtered GTF, a
+transcript to gene map and a table of transcript attributes can be made
+in a single pass.
+
+Decompression (and compression) is performed in a separate thread or
+process when possible: python-isal is used if it is installed, otherwise
+pigz is used if it is on the PATH, otherwise the standard library gzip
+module is used.
+
+Functions
+---------
+
+'''
+
+import io
+import re
+import gzip
+import shutil
+import subprocess
+
+
+# ---------------------------- gzip input/output ---------------------------- #
+
+class piped():
+    '''
+    A minimal file-like wrapper for reading from or writing to a
+    compression program (e.g. pigz) via a pipe.
+    '''
+
+    def __init__(self, cmd, path, mode="rt"):
+
+        self.reading = "r" in mode
+        self.outfile = None
+
+        if self.reading:
+            self.process = subprocess.Popen(cmd + [path],
+                                            stdout=subprocess.PIPE)
+            stream = self.process.stdout
+        else:
+            self.outfile = open(path, "wb")
+            self.process = subprocess.Popen(cmd,
+                                            stdin=subprocess.PIPE,
+                                            stdout=self.outfile)
+            stream = self.process.stdin
+
+        if "b" in mode:
+            self.handle = stream
+        else:
+            self.handle = io.TextIOWrapper(stream)
+
+    def __iter__(self):
+        return iter(self.handle)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, *args):
+        return self.handle.read(*args)
+
+    def readline(self, *args):
+        return self.handle.readline(*args)
+
+    def write(self, data):
+        return self.handle.write(data)
+
+    def close(self):
+
+        self.handle.close()
+        returncode = self.process.wait()
+
+        if self.outfile is not None:
+            self.outfile.close()
+
+        # a negative return code indicates that the process was terminated
+        # by a signal, e.g. SIGPIPE when a file is closed before it has been
+        # read to the end.
+        if returncode > 0 or (returncode < 0 and not self.reading):
+            raise OSError(" ".join(self.process.args) +
+                          " failed with exit code " + str(returncode))
+
+
+def zopen(path, mode="rt", threads=4):
+    '''
+    Open a (possibly) gzip compressed file for reading or writing.
+
+    Files that do not end with ".gz" are opened with the builtin open().
+    '''
+
+    if not path.endswith(".gz"):
+        return open(path, mode)
+
+    try:
+        from isal import igzip_threaded
+        return igzip_threaded.open(path, mode, threads=threads)
+
+    except ImportError:
+        pass
+
+    pigz = shutil.which("pigz")
+
+    if pigz is not None:
+
+        if "r" in mode:
+            cmd = [pigz, "-d", "-c"]
+        else:
+            cmd = [pigz, "-c", "-p", str(threads)]
+
+        return piped(cmd, path, mode)
+
+    return gzip.open(path, mode)
+
+
+# ----------------------------- GTF attributes ------------------------------ #
+
+def attribute_parser(keys):
+    '''
+    Return a function that extracts the values of the given attribute
+    *keys* from the attribute (ninth) column of a GTF record.
+
+    The returned function yields a dictionary of key: value pairs. Keys
+    that are not present in the record are absent from the dictionary and
+    when a key occurs more than once the last value is kept.
+
+    In Ensembl GTF files key-value pairs are delimited by "; ", keys and
+    values are separated by " " and values are quoted. Values can contain
+    whitespace.
+    '''
+
+    pattern = re.compile(r'(?:^|;)\s*(' +
+                         "|".join([re.escape(k) for k in keys]) +
+                         r') ([^;]*)')
+
+    def parse(attributes):
+        return {k: v.rstrip().strip("'\"")
+                for k, v in pattern.findall(attributes)}
+
+    return(parse)
+
+
+# --------------------------- single pass engine ---------------------------- #
+
+# The GTF file format
+#
+# contig  source  feature  start  end  score  strand  frame  attributes
+#
+# Records are passed to the output "sinks" as the list of fields (split
+# on the first eight tabs) together with the original line. Each sink
+# writes a different output. Sinks with filtered=True only receive the
+# records that pass the contig and mask filters.
+
+class gtfWriter():
+    '''
+    A sink that writes the GTF records to a (gzip compressed) file.
+    '''
+
+    filtered = True
+
+    def __init__(self, outfile):
+        self.out_file = zopen(outfile, "wt")
+
+    def add(self, fields, record):
+        self.out_file.write(record)
+
+    def close(self):
+        self.out_file.close()
+
+
+class tx2geneWriter():
+    '''
+    A sink that writes a sorted, unique, tab-separated list of
+    transcript_id -> gene_id mappings (e.g. for use with Salmon).
+    '''
+
+    filtered = True
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.parse = attribute_parser(["transcript_id", "gene_id"])
+        self.pairs = set()
+
+    def add(self, fields, record):
+
+        if fields[2] != "transcript":
+            return
+
+        attrs = self.parse(fields[8])
+
+        if "transcript_id" in attrs and "gene_id" in attrs:
+            self.pairs.add(attrs["transcript_id"] + "\t" + attrs["gene_id"])
+
+    def close(self):
+
+        with zopen(self.outfile, "wt") as out_file:
+            for pair in sorted(self.pairs):
+                out_file.write(pair + "\n")
+
+
+class attributeTableWriter():
+    '''
+    A sink that writes a table of the given attributes of the records
+    of a given feature type (by default, of the transcripts). Missing
+    values are written as "NA".
+    '''
+
+    def __init__(self, outfile, attributes,
+                 feature="transcript", filtered=False):
+
+        self.attributes = attributes
+        self.feature = feature
+        self.filtered = filtered
+        self.parse = attribute_parser(attributes)
+
+        self.out_file = zopen(outfile, "wt")
+        self.out_file.write("\t".join(attributes) + "\n")
+
+    def add(self, fields, record):
+
+        if fields[2] != self.feature:
+            return
+
+        attrs = self.parse(fields[8])
+
+        self.out_file.write(
+            "\t".join([attrs.get(x, "NA") for x in self.attributes]) + "\n")
+
+    def close(self):
+        self.out_file.close()
+
+
+class hisatWriter():
+    '''
+    A sink that writes the exons and the splice sites of the transcripts
+    for hisat2-build (as the hisat2_extract_exons.py and
+    hisat2_extract_splice_sites.py scripts, but from a single pass).
+
+    The exons of each transcript are sorted and those separated by
+    introns of <= 5 bp are merged. The outputs are sorted, unique lists
+    of "contig  left  right  strand" with 0-based coordinates: the exon
+    starts and ends, or the last base of the exon before each splice
+    junction and the first base of the exon after it.
+    '''
+
+    filtered = False
+
+    def __init__(self, exons_outfile, ss_outfile):
+        self.exons_outfile = exons_outfile
+        self.ss_outfile = ss_outfile
+        self.parse = attribute_parser(["transcript_id", "gene_id"])
+        self.transcripts = {}
+
+    def add(self, fields, record):
+
+        if fields[2] != "exon":
+            return
+
+        left, right = int(fields[3]) - 1, int(fields[4]) - 1
+
+        if left >= right:
+            return
+
+        attrs = self.parse(fields[8])
+
+        if "gene_id" not in attrs or "transcript_id" not in attrs:
+            return
+
+        transcript_id = attrs["transcript_id"]
+
+        if transcript_id not in self.transcripts:
+            self.transcripts[transcript_id] = [fields[0], fields[6], []]
+
+        self.transcripts[transcript_id][2].append([left, right])
+
+    def close(self):
+
+        exons = set()
+        junctions = set()
+
+        for contig, strand, transcript_exons in self.transcripts.values():
+
+            transcript_exons.sort()
+
+            merged = [transcript_exons[0]]
+            for left, right in transcript_exons[1:]:
+                if left - merged[-1][1] <= 5:
+                    merged[-1][1] = right
+                else:
+                    merged.append([left, right])
+
+            for i, (left, right) in enumerate(merged):
+                exons.add((contig, left, right, strand))
+                if i > 0:
+                    junctions.add((contig, merged[i - 1][1], left, strand))
+
+        for outfile, rows in [(self.exons_outfile, exons),
+                              (self.ss_outfile, junctions)]:
+
+            with zopen(outfile, "wt") as out_file:
+                for row in sorted(rows):
+                    out_file.write("%s\t%i\t%i\t%s\n" % row)
+
+
+def stream_gtf(gtf_file, sinks, contigs=None, masks=None):
+    '''
+    Read the GTF file once and pass each record to all of the output
+    *sinks*.
+
+    Records on contigs that are not in the set of *contigs* or that lie
+    inside one of the *masks* (see :class:`txseq.tasks.intervals`) are
+    only passed to the sinks that are not filtered.
+
+    Returns a dictionary with the number of records skipped per excluded
+    contig ("skipped_contigs"), the number of masked records
+    ("n_masked") and the gene_ids of the masked records per contig
+    ("masked_genes").
+    '''
+
+    all_sinks = [x for x in sinks if not x.filtered]
+    filtered_sinks = [x for x in sinks if x.filtered]
+
+    parse_gene_id = attribute_parser(["gene_id"])
+
+    skipped_contigs = {}
+    masked_genes = {}
+    n_masked = 0
+
+    with zopen(gtf_file, "rt") as gtf_handle:
+
+        for record in gtf_handle:
+
+            if record.startswith("#"):
+                continue
+
+            fields = record.split("\t", 8)
+
+            for sink in all_sinks:
+                sink.add(fields, record)
+
+            contig = fields[0]
+
+            if contigs is not None and contig not in contigs:
+                skipped_contigs[contig] = skipped_contigs.get(contig, 0) + 1
+                continue
+
+            if masks is not None and masks.contains(contig,
+                                                    int(fields[3]),
+                                                    int(fields[4])):
+
+                gene = parse_gene_id(fields[8]).get("gene_id", "NA")
+
+                if contig not in masked_genes:
+                    masked_genes[contig] = {}
+                masked_genes[contig][gene] = None
+
+                n_masked += 1
+                continue
+
+            for sink in filtered_sinks:
+                sink.add(fields, record)
+
+    for sink in sinks:
+        sink.close()
+
+    return({"skipped_contigs": skipped_contigs,
+            "n_masked": n_masked,
+            "masked_genes": masked_genes})
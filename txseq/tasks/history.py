@@ -0,0 +1,397 @@
+'''
+history.py
+==========
+
+Overview
+--------
+
+A persistent, cross-run store of the resources used by pipeline jobs.
+
+Each time "txseq <pipeline> profile" is run, the jobs found in the
+pipeline log are appended to a local SQLite database. Each job is
+recorded with the pipeline, task, sample and input size, and with the
+memory, cpu and wall time it used. The input size and sample are taken
+from the information logged by :class:`txseq.tasks.setup.setup` when
+the job was set up. Records are keyed on the project folder, task, job
+id and statement, so that profiling the same log twice does not
+duplicate them.
+
+The database location is, in order of precedence:
+
+#. the TXSEQ_HISTORY environment variable
+#. the "resources_history" parameter (e.g. set in ~/.cgat.yml)
+#. ~/.txseq/history.sqlite
+
+Usage
+-----
+
+.. code-block:: python
+
+    import txseq.tasks.history as history
+
+    # how does the memory used by salmon quant scale with fastq size?
+    jobs = history.query(task="quant", pipeline="salmon")
+    jobs.plot.scatter("input_bytes", "memory_gb")
+
+Functions
+---------
+
+'''
+
+import os
+import re
+import sqlite3
+import hashlib
+import datetime
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_HISTORY = os.path.join("~", ".txseq", "history.sqlite")
+
+# The columns of the "jobs" table
+COLUMNS = [("record_id", "TEXT PRIMARY KEY"),
+           ("pipeline", "TEXT"),
+           ("task", "TEXT"),
+           ("sample", "TEXT"),
+           ("input_bytes", "INTEGER"),
+           ("project", "TEXT"),
+           ("job_id", "TEXT"),
+           ("queue_manager", "TEXT"),
+           ("job_memory", "TEXT"),
+           ("job_threads", "INTEGER"),
+           ("memory_gb", "REAL"),
+           ("percent_cpu", "REAL"),
+           ("user_t", "REAL"),
+           ("wall_t", "REAL"),
+           ("exit_status", "TEXT"),
+           ("recorded", "TEXT")]
+
+# The fields of the cgat-core job records that hold the peak memory
+# (and the factor needed to convert it to GB) and the exit status.
+QUEUE_MANAGER_FIELDS = {"slurm": {"memory": ("MaxRSS", 1E9),
+                                  "exit_status": "ExitCode"},
+                        "sge": {"memory": ("max_rss", 1E6),
+                                "exit_status": "exit_status"}}
+
+
+def history_path(PARAMS=None):
+    '''
+    Return the path of the history database.
+    '''
+
+    if os.environ.get("TXSEQ_HISTORY"):
+        path = os.environ["TXSEQ_HISTORY"]
+
+    elif PARAMS is not None and PARAMS.get("resources_history"):
+        path = PARAMS["resources_history"]
+
+    else:
+        path = DEFAULT_HISTORY
+
+    return(os.path.abspath(os.path.expanduser(path)))
+
+
+def pipeline_name(log):
+    '''
+    Return the name of the pipeline from the name of its log file,
+    e.g. "salmon" for "pipeline_salmon.log".
+    '''
+
+    name = os.path.basename(log)
+
+    if name.endswith(".log"):
+        name = name[:-len(".log")]
+
+    if name.startswith("pipeline_"):
+        name = name[len("pipeline_"):]
+
+    return(name)
+
+
+def connect(history_file):
+    '''
+    Open (and if necessary create) the history database.
+    '''
+
+    history_dir = os.path.dirname(history_file)
+
+    if history_dir != "" and not os.path.exists(history_dir):
+        os.makedirs(history_dir)
+
+    con = sqlite3.connect(history_file, timeout=60)
+
+    con.execute("CREATE TABLE IF NOT EXISTS jobs (" +
+                ", ".join([" ".join(x) for x in COLUMNS]) + ")")
+    con.execute("CREATE INDEX IF NOT EXISTS jobs_task "
+                "ON jobs (pipeline, task)")
+
+    return(con)
+
+
+def _text(value):
+    '''
+    Return a job id or exit status as text. Numeric values (which
+    :meth:`txseq.tasks.profile.recordColumns.to_frame` stores as floats)
+    are written as integers where possible, e.g. "0" rather than "0.0".
+    '''
+
+    if value is None or isinstance(value, str):
+        return(value)
+
+    if float(value).is_integer():
+        return(str(int(value)))
+
+    return(str(value))
+
+
+def _contains_path(statement, path):
+    '''
+    Return True if the path occurs in the statement and is not part
+    of a longer name (e.g. "sample1" in "sample10").
+    '''
+
+    if path not in statement:
+        return(False)
+
+    return(re.search(r"(?<![\w])" + re.escape(path) + r"(?![\w])",
+                     statement) is not None)
+
+
+def match_jobs(records, jobs):
+    '''
+    Add the sample, input_bytes, job_memory and job_threads logged by
+    :class:`txseq.tasks.setup.setup` to the cgat-core job *records*.
+
+    A job is matched to the setup of the same task whose output file
+    path occurs in the job statement. If several match, the longest
+    path is taken.
+    '''
+
+    records = records.copy()
+
+    by_task = {}
+
+    if len(jobs) > 0:
+        for job in jobs.to_dict(orient="records"):
+            # (missing values are NaN in the data frame)
+            if isinstance(job.get("out_file"), str) and job["out_file"]:
+                by_task.setdefault(job["task"], []).append(job)
+
+    matched = {"sample": [], "input_bytes": [],
+               "job_memory": [], "job_threads": []}
+
+    for task, statement in zip(records["task"].values,
+                               records["statement"].values):
+
+        best = None
+
+        for job in by_task.get(task, []):
+
+            if best is not None and len(job["out_file"]) <= len(best["out_file"]):
+                continue
+
+            if _contains_path(str(statement), job["out_file"]):
+                best = job
+
+        for key in matched.keys():
+            matched[key].append(None if best is None else best.get(key))
+
+    for key, values in matched.items():
+        records[key] = values
+
+    return(records)
+
+
+def record(records, jobs, pipeline, queue_manager,
+           history_file=None, project=None):
+    '''
+    Append the cgat-core job *records* (see
+    :func:`txseq.tasks.profile.parse_logs`) to the history database.
+
+    Returns the number of new jobs recorded.
+    '''
+
+    if queue_manager not in QUEUE_MANAGER_FIELDS:
+        raise ValueError("queue manager not supported")
+
+    if history_file is None:
+        history_file = history_path()
+
+    if project is None:
+        project = os.getcwd()
+
+    if len(records) == 0:
+        return(0)
+
+    records = match_jobs(records, jobs)
+
+    fields = QUEUE_MANAGER_FIELDS[queue_manager]
+    memory_field, memory_scale = fields["memory"]
+
+    def column(name, scale=None):
+        if name not in records.columns:
+            return([None] * len(records))
+        values = records[name].values
+        if scale is not None:
+            return([None if pd.isna(v) else float(v) / scale
+                    for v in values])
+        return([None if v is None or (isinstance(v, float) and pd.isna(v))
+                else v for v in values])
+
+    recorded = datetime.datetime.now().isoformat(timespec="seconds")
+
+    rows = []
+
+    for (task, job_id, statement, sample, input_bytes,
+         job_memory, job_threads, memory_gb, percent_cpu,
+         user_t, wall_t, exit_status) in zip(
+             column("task"), column("job_id"), column("statement"),
+             column("sample"), column("input_bytes"),
+             column("job_memory"), column("job_threads"),
+             column(memory_field, memory_scale), column("percent_cpu"),
+             column("user_t"), column("wall_t"),
+             column(fields["exit_status"])):
+
+        job_id = _text(job_id)
+
+        record_id = hashlib.blake2b(
+            "\t".join([project, str(task), str(job_id),
+                       str(statement)]).encode(),
+            digest_size=16).hexdigest()
+
+        rows.append((record_id, pipeline, task, sample,
+                     None if input_bytes is None else int(input_bytes),
+                     project, job_id, queue_manager, job_memory,
+                     None if job_threads is None else int(job_threads),
+                     memory_gb, percent_cpu, user_t, wall_t,
+                     _text(exit_status),
+                     recorded))
+
+    con = connect(history_file)
+
+    with con:
+        before = con.total_changes
+        con.executemany("INSERT OR IGNORE INTO jobs VALUES (" +
+                        ",".join(["?"] * len(COLUMNS)) + ")", rows)
+        n = con.total_changes - before
+
+    con.close()
+
+    return(n)
+
+
+def query(pipeline=None, task=None, sample=None, history_file=None):
+    '''
+    Return the recorded jobs as a data frame, optionally restricted to
+    a pipeline, a task (given either as "module.function" or as the
+    function name, e.g. "quant") and/or a sample.
+    '''
+
+    if history_file is None:
+        history_file = history_path()
+
+    conditions, values = [], []
+
+    if pipeline is not None:
+        conditions.append("pipeline = ?")
+        values.append(pipeline)
+
+    if task is not None:
+        conditions.append("(task = ? OR task LIKE ?)")
+        values += [task, "%." + task]
+
+    if sample is not None:
+        conditions.append("sample = ?")
+        values.append(sample)
+
+    sql = "SELECT * FROM jobs"
+
+    if len(conditions) > 0:
+        sql += " WHERE " + " AND ".join(conditions)
+
+    con = connect(history_file)
+    df = pd.read_sql(sql, con, params=values)
+    con.close()
+
+    return(df)
+
+
+# ---------------------------- memory prediction ---------------------------- #
+
+_models = {}
+
+
+def memory_model(task, history_file):
+    '''
+    Return the (slope, intercept, n) of a linear fit of the peak memory
+    (GB) against input size (bytes) for the successful jobs of the
+    task. The intercept is raised so that the line lies on or above all
+    of the jobs. Fits are cached per task.
+
+    Jobs are successful if they exited with status "0" (SGE) or "0:0"
+    (SLURM). The status "0.0" was recorded for SGE jobs by earlier
+    versions.
+    '''
+
+    key = (history_file, task)
+
+    if key in _models:
+        return(_models[key])
+
+    if not os.path.exists(history_file):
+        return((0, 0, 0))
+
+    con = sqlite3.connect(history_file, timeout=60)
+
+    try:
+        rows = con.execute(
+            "SELECT input_bytes, memory_gb FROM jobs "
+            "WHERE task = ? AND input_bytes > 0 AND memory_gb IS NOT NULL "
+            "AND (exit_status IS NULL OR "
+            "exit_status IN ('0', '0.0', '0:0'))",
+            (task,)).fetchall()
+
+    except sqlite3.OperationalError:
+        rows = []
+
+    con.close()
+
+    if len(rows) == 0:
+        model = (0, 0, 0)
+
+    else:
+        x = np.array([r[0] for r in rows], dtype=np.float64)
+        y = np.array([r[1] for r in rows], dtype=np.float64)
+
+        if np.ptp(x) == 0:
+            slope = 0.0
+        else:
+            slope = max(np.polyfit(x, y, 1)[0], 0.0)
+
+        intercept = np.max(y - slope * x)
+
+        model = (slope, intercept, len(rows))
+
+    _models[key] = model
+
+    return(model)
+
+
+def predict_memory(task, input_bytes, margin=1.5, min_jobs=5,
+                   history_file=None):
+    '''
+    Return the memory (GB) predicted for a job of the task with the
+    given input size, or None if the task has fewer than *min_jobs*
+    successful jobs with a known input size in the history.
+    '''
+
+    if history_file is None:
+        history_file = history_path()
+
+    slope, intercept, n = memory_model(task, history_file)
+
+    if n < min_jobs:
+        return(None)
+
+    return((slope * input_bytes + intercept) * margin)
@@ -0,0 +1,148 @@
+'''
+intervals.py
+============
+
+Overview
+--------
+
+Helpers for filtering genomic records by contig and by masked regions.
+
+Masked regions are stored per contig as arrays of interval starts
+(sorted) together with the running maximum of the interval ends. Whether
+a record falls inside any masked region can then be determined with a
+single binary search, so that masking thousands of regions costs about
+the same as masking one.
+
+Usage
+-----
+
+.. code-block:: python
+
+    from txseq.tasks.intervals import intervals, read_contigs
+
+    contigs = read_contigs("contigs")
+    masks = intervals.from_bed("Y.PAR.bed")
+
+    if contig in contigs and not masks.contains(contig, start, end):
+        ...
+
+Class and method documentation
+------------------------------
+
+'''
+
+from bisect import bisect_left
+
+
+def read_contigs(contig_file):
+    '''
+    Return the set of contig names listed, one per line, in *contig_file*.
+    '''
+
+    contigs = set()
+
+    with open(contig_file, "r") as cf:
+        for line in cf:
+            if line.strip() != "":
+                contigs.add(line.strip())
+
+    return(contigs)
+
+
+class intervals():
+    '''
+    A class for indexing genomic intervals (e.g. masked regions).
+
+    Intervals are added with :meth:`add` and the index is (re)built
+    automatically before the first query.
+    '''
+
+    def __init__(self):
+
+        self.regions = {}
+        self.starts = {}
+        self.max_ends = {}
+        self.built = False
+
+    @classmethod
+    def from_bed(cls, bed_file):
+        '''
+        Make an interval index from the first three columns of a BED file.
+        '''
+
+        index = cls()
+
+        with open(bed_file, "r") as bf:
+            for line in bf:
+                if line.strip() == "" or line.startswith(("#", "track",
+                                                          "browser")):
+                    continue
+
+                fields = line.split("\t")
+                index.add(fields[0].strip(), int(fields[1]), int(fields[2]))
+
+        return(index)
+
+    def add(self, contig, start, end):
+        '''
+        Add the interval start-end on contig.
+        '''
+
+        if contig not in self.regions:
+            self.regions[contig] = []
+
+        self.regions[contig].append((min(start, end), max(start, end)))
+        self.built = False
+
+    def build(self):
+        '''
+        Sort the intervals on each contig by start position and compute the
+        running maximum of the interval ends.
+        '''
+
+        for contig, regions in self.regions.items():
+
+            regions.sort()
+
+            starts, max_ends = [], []
+            max_end = None
+
+            for start, end in regions:
+                max_end = end if max_end is None else max(max_end, end)
+                starts.append(start)
+                max_ends.append(max_end)
+
+            self.starts[contig] = starts
+            self.max_ends[contig] = max_ends
+
+        self.built = True
+
+    def __len__(self):
+        return(sum([len(x) for x in self.regions.values()]))
+
+    def contigs(self):
+        '''
+        Return the names of the contigs that have intervals.
+        '''
+
+        return(list(self.regions.keys()))
+
+    def contains(self, contig, start, end):
+        '''
+        Return True if the region start-end lies inside one of the
+        intervals on contig, i.e. interval_start < start and
+        end < interval_end.
+        '''
+
+        if contig not in self.regions:
+            return(False)
+
+        if not self.built:
+            self.build()
+
+        x, y = min(start, end), max(start, end)
+
+        # the number of intervals that start before x.
+        n = bisect_left(self.starts[contig], x)
+
+        return(n > 0 and self.max_ends[contig][n - 1] > y)
@@ -0,0 +1,236 @@
+'''
+matrix.py
+=========
+
+Overview
+--------
+
+Helper functions for building wide (feature x sample) matrices from
+long tables of per-sample results, such as the concatenated Salmon
+quant.sf or featureCounts tables stored in the project database.
+
+The output matrix is allocated once and filled by scattering the values
+into place using integer row and column codes. In chunked mode the rows
+are streamed from the database in batches so that peak memory is bounded
+by the size of the output matrix rather than by the size of the long table.
+
+Functions
+---------
+
+'''
+
+import numpy as np
+import pandas as pd
+
+
+# The maximum number of parameters of an sqlite query (the default
+# SQLITE_MAX_VARIABLE_NUMBER of sqlite versions before 3.32.0).
+SQLITE_MAX_VARIABLES = 999
+
+
+def append_unique(index, values):
+    '''
+    Return a copy of the pandas Index *index* extended with the values
+    that it does not already contain, in order of first appearance.
+    '''
+
+    values = pd.unique(np.asarray(values))
+    new = values[index.get_indexer(values) == -1]
+
+    if len(new) > 0:
+        index = index.append(pd.Index(new))
+
+    return(index)
+
+
+def scatter(matrix, row_index, col_index, rows, cols, values):
+    '''
+    Fill *matrix* in place with *values* at the positions given by the
+    *rows* and *cols* labels, looked up in *row_index* and *col_index*.
+    '''
+
+    r = row_index.get_indexer(np.asarray(rows))
+    c = col_index.get_indexer(np.asarray(cols))
+
+    if (r == -1).any() or (c == -1).any():
+        raise ValueError("Row or column label not found in matrix index")
+
+    matrix[r, c] = np.asarray(values)
+
+
+def long_to_wide(df, index, columns, values,
+                 fill_value=np.nan, dtype="float64"):
+    '''
+    Pivot the long data frame *df* into a wide data frame with one row
+    per *index* value and one column per *columns* value.
+
+    Rows and columns are ordered by first appearance, as with the
+    previous per-sample pivot loop. Unlike df.pivot() no intermediate
+    copies of the long table are made.
+    '''
+
+    row_index = append_unique(pd.Index([]), df[index].values)
+    col_index = append_unique(pd.Index([]), df[columns].values)
+
+    matrix = np.full((len(row_index), len(col_index)),
+                     fill_value, dtype=dtype)
+
+    scatter(matrix, row_index, col_index,
+            df[index].values, df[columns].values, df[values].values)
+
+    return(pd.DataFrame(matrix, index=row_index, columns=col_index))
+
+
+def sql_to_wide(sql, con, index, columns, values,
+                chunksize=None, fill_value=np.nan, dtype="float64",
+                params=None):
+    '''
+    Run the *sql* query (with optional *params*) against the database
+    connection *con* and return the result as a wide data frame (see
+    :func:`long_to_wide`).
+
+    If *chunksize* is given, the query results are streamed in batches
+    of *chunksize* rows. A first pass collects the row and column labels,
+    the matrix is then allocated and a second pass scatters the values.
+    '''
+
+    if not chunksize:
+        df = pd.read_sql(sql, con, params=params)
+        return(long_to_wide(df, index, columns, values,
+                            fill_value=fill_value, dtype=dtype))
+
+    row_index = pd.Index([])
+    col_index = pd.Index([])
+
+    for chunk in pd.read_sql(sql, con, chunksize=chunksize, params=params):
+        row_index = append_unique(row_index, chunk[index].values)
+        col_index = append_unique(col_index, chunk[columns].values)
+
+    matrix = np.full((len(row_index), len(col_index)),
+                     fill_value, dtype=dtype)
+
+    for chunk in pd.read_sql(sql, con, chunksize=chunksize, params=params):
+        scatter(matrix, row_index, col_index,
+                chunk[index].values, chunk[columns].values,
+                chunk[values].values)
+
+    return(pd.DataFrame(matrix, index=row_index, columns=col_index))
+
+
+def update_wide(df, sql, con, index, columns, values, updated, tracks,
+                chunksize=None, fill_value=np.nan, dtype="float64",
+                max_variables=SQLITE_MAX_VARIABLES):
+    '''
+    Update the existing wide data frame *df* from the *sql* query rather
+    than rebuilding it.
+
+    The columns of the *updated* tracks (and of the *tracks* that *df*
+    does not have) are fetched from the database, the columns that are
+    not in *tracks* are removed and the other columns are left in place.
+    New columns are added after the existing ones (as they are appended
+    to the long table).
+
+    The tracks are fetched in batches of at most *max_variables* so that
+    the "IN" list stays within the sqlite limit on query parameters.
+    '''
+
+    keep = [x for x in df.columns if x in tracks and x not in updated]
+    fetch = [x for x in tracks if x not in keep]
+
+    df = df[keep]
+
+    if len(fetch) == 0:
+        return(df)
+
+    new = []
+
+    for i in range(0, len(fetch), max_variables):
+
+        batch = fetch[i:i + max_variables]
+
+        batch_sql = "SELECT * FROM (%s) WHERE %s IN (%s)" % (
+            sql, columns, ", ".join(["?"] * len(batch)))
+
+        new.append(sql_to_wide(batch_sql, con, index, columns, values,
+                               chunksize=chunksize, fill_value=fill_value,
+                               dtype=dtype, params=batch))
+
+    row_index = df.index
+    for x in new:
+        row_index = append_unique(row_index, x.index.values)
+
+    df = pd.concat([x.reindex(row_index, fill_value=fill_value)
+                    for x in [df] + new], axis=1)
+
+    return(df.astype(dtype))
+
+
+# ------------------------- columnar matrix files --------------------------- #
+
+MATRIX_FORMATS = {"parquet": ".parquet",
+                  "feather": ".feather",
+                  "hdf5": ".h5",
+                  "tsv": ".tsv.gz"}
+
+
+def matrix_path(prefix, fmt):
+    '''
+    Return the path of a matrix file written with :func:`write_matrix`.
+    '''
+
+    if fmt not in MATRIX_FORMATS:
+        raise ValueError("Matrix format not recognised: should be one of "
+                         + ", ".join(MATRIX_FORMATS.keys()))
+
+    return(prefix + MATRIX_FORMATS[fmt])
+
+
+def write_matrix(df, prefix, fmt="parquet", index_label="id"):
+    '''
+    Write the wide data frame *df* to "prefix.<ext>" in the given
+    format. Parquet and feather require pyarrow, hdf5 requires pytables.
+    Returns the path of the file written.
+    '''
+
+    path = matrix_path(prefix, fmt)
+
+    df = df.rename_axis(index_label)
+
+    if fmt == "parquet":
+        df.to_parquet(path)
+
+    elif fmt == "feather":
+        # feather does not store a (non-default) index.
+        df.reset_index().to_feather(path)
+
+    elif fmt == "hdf5":
+        df.to_hdf(path, key="matrix", mode="w")
+
+    elif fmt == "tsv":
+        df.to_csv(path, sep="\t", index=True)
+
+    return(path)
+
+
+def read_matrix(path):
+    '''
+    Read a matrix file written with :func:`write_matrix`.
+    '''
+
+    if path.endswith(".parquet"):
+        df = pd.read_parquet(path)
+
+    elif path.endswith(".feather"):
+        df = pd.read_feather(path)
+        df = df.set_index(df.columns[0])
+
+    elif path.endswith(".h5"):
+        df = pd.read_hdf(path, key="matrix")
+
+    elif path.endswith(".tsv.gz"):
+        df = pd.read_csv(path, sep="\t", index_col=0)
+
+    else:
+        raise ValueError("Matrix file type not recognised: " + path)
+
+    return(df)
@@ -0,0 +1,237 @@
+'''
+picard.py
+=========
+
+Overview
+--------
+
+A reader for the metrics files written by the Picard tools.
+
+Picard metrics files contain a "## METRICS CLASS" block (a header line
+followed by one row per metric accumulation level) and, for some tools,
+a "## HISTOGRAM" block. Blocks are separated by blank lines and other
+lines start with "#". :func:`read_metrics_file` parses both blocks in a
+single read into data frames in which numeric columns are typed (integer
+columns with missing values use the pandas nullable "Int64" type).
+
+Usage
+-----
+
+.. code-block:: python
+
+    import txseq.tasks.picard as picard
+
+    metrics, histogram = picard.read_metrics_file("sample.rna_metrics")
+
+    # write the tables loaded by pipeline_bamqc
+    picard.write_metrics("sample.rna_metrics",
+                         metrics_out="sample.rnaseq.metrics",
+                         histogram_out="sample.rnaseq.cov.hist")
+
+Functions
+---------
+
+'''
+
+import pandas as pd
+
+
+# The columns that identify the metric accumulation level. They are
+# empty for the metrics computed over all of the reads.
+LEVEL_COLUMNS = ["SAMPLE", "LIBRARY", "READ_GROUP"]
+
+
+def _typed(columns, rows):
+    '''
+    Return a data frame from the column names and rows of strings with
+    numeric columns converted.
+    '''
+
+    n = len(columns)
+    rows = [(row + [""] * n)[:n] for row in rows]
+
+    data = {}
+
+    for i, column in enumerate(columns):
+
+        values = [row[i] for row in rows]
+        present = [v for v in values if v not in ("", "?")]
+
+        series = pd.Series([None if v in ("", "?") else v for v in values],
+                           dtype=object)
+
+        try:
+            numbers = pd.to_numeric(pd.Series(present, dtype=object))
+        except (ValueError, TypeError):
+            data[column] = series
+            continue
+
+        if len(present) > 0 and pd.api.types.is_integer_dtype(numbers) and \
+           all(["." not in v for v in present]):
+            data[column] = pd.to_numeric(series).astype("Int64")
+        else:
+            data[column] = pd.to_numeric(series).astype(float)
+
+    return(pd.DataFrame(data, columns=columns))
+
+
+def read_metrics_file(path):
+    '''
+    Parse a Picard metrics file. Returns a tuple of data frames with the
+    metrics and the histogram. Either is None if the block is not
+    present (e.g. Picard does not write the CollectRnaSeqMetrics
+    histogram when there is no coverage).
+    '''
+
+    blocks = {}
+    current = None
+
+    with open(path, "r") as metrics_file:
+        for line in metrics_file:
+
+            line = line.rstrip("\n").rstrip("\r")
+
+            if line.startswith("## METRICS CLASS"):
+                current = "metrics"
+                blocks[current] = []
+                continue
+
+            if line.startswith("## HISTOGRAM"):
+                current = "histogram"
+                blocks[current] = []
+                continue
+
+            if line.startswith("#"):
+                continue
+
+            if line.strip() == "":
+                # blocks end at the first blank line
+                current = None
+                continue
+
+            if current is not None:
+                blocks[current].append(line.split("\t"))
+
+    tables = []
+
+    for name in ["metrics", "histogram"]:
+
+        lines = blocks.get(name)
+
+        if lines is None or len(lines) == 0:
+            tables.append(None)
+        else:
+            tables.append(_typed(lines[0], lines[1:]))
+
+    return(tuple(tables))
+
+
+def all_reads(metrics):
+    '''
+    Return the rows of the metrics table that were computed over all of
+    the reads (i.e. not per sample, library or read group).
+    '''
+
+    levels = [x for x in LEVEL_COLUMNS if x in metrics.columns]
+
+    if len(levels) == 0:
+        return(metrics)
+
+    return(metrics[metrics[levels].isna().all(axis=1)])
+
+
+def combine_libraries(metrics):
+    '''
+    Return a single row with the sum of the per-library metrics of
+    EstimateLibraryComplexity (picard.sam.DuplicationMetrics). The
+    PERCENT_DUPLICATION is recomputed from the summed counts (as Picard
+    computes it) and the ESTIMATED_LIBRARY_SIZE is the sum of the
+    library sizes. The LIBRARY column lists the libraries.
+    '''
+
+    if len(metrics) <= 1:
+        return(metrics)
+
+    row = {}
+
+    for column in metrics.columns:
+
+        if column == "LIBRARY":
+            row[column] = ",".join([str(x) for x in metrics[column]
+                                    if not pd.isna(x)])
+
+        elif pd.api.types.is_numeric_dtype(metrics[column]):
+            row[column] = metrics[column].sum()
+
+        else:
+            row[column] = metrics[column].iloc[0]
+
+    if "PERCENT_DUPLICATION" in metrics.columns:
+
+        examined = (row["UNPAIRED_READS_EXAMINED"] +
+                    row["READ_PAIRS_EXAMINED"] * 2)
+
+        duplicates = (row["UNPAIRED_READ_DUPLICATES"] +
+                      row["READ_PAIR_DUPLICATES"] * 2)
+
+        row["PERCENT_DUPLICATION"] = \
+            duplicates / examined if examined > 0 else 0
+
+    return(pd.DataFrame([row], columns=metrics.columns).astype(
+        metrics.dtypes.to_dict()))
+
+
+def write_table(table, path):
+    '''
+    Write a metrics or histogram table as a tab-separated file with
+    missing values left empty.
+    '''
+
+    table.to_csv(path, sep="\t", index=False, na_rep="")
+
+
+def write_metrics(path, metrics_out=None, histogram_out=None,
+                  level="all_reads", first_row=False):
+    '''
+    Parse a Picard metrics file and write the metrics and/or histogram
+    tables.
+
+    With level="all_reads" only the metrics computed over all of the
+    reads are written. With level="sample" the per-library rows are
+    combined into a single row (see :func:`combine_libraries`), and with
+    level=None all of the rows are written. If *first_row* is True only the first metrics
+    row is written (e.g. the first pair orientation of
+    CollectInsertSizeMetrics). If the file has no histogram, an empty
+    histogram file is written.
+
+    Returns the tuple of (metrics, histogram) data frames.
+    '''
+
+    metrics, histogram = read_metrics_file(path)
+
+    if metrics_out is not None:
+
+        if metrics is None:
+            raise ValueError("No metrics found in Picard output: " + path)
+
+        table = metrics
+
+        if level == "all_reads":
+            table = all_reads(table)
+
+        elif level == "sample":
+            table = combine_libraries(table)
+
+        if first_row:
+            table = table.head(1)
+
+        write_table(table, metrics_out)
+
+    if histogram_out is not None:
+
+        if histogram is None:
+            open(histogram_out, "w").close()
+        else:
+            write_table(histogram, histogram_out)
+
+    return(metrics, histogram)
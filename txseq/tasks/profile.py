@@ -8,7 +8,7 @@ summarise information on task resource usage.
 Usage
 -----
 
-After running a pipline, the resources used by the pipeline tasks can 
+After running a pipline, the resources used by the pipeline tasks can
 be summarised with the "cellhub pipeline_name profile" command, e.g.
 
 .. code-block:: bash
@@ -16,6 +16,17 @@ be summarised with the "cellhub pipeline_name profile" command, e.g.
     > cellhub cluster make full -v5 -p 100
     > cellhub cluster profile
 
+The log is read line by line and the job records are parsed with
+json (or, for older log formats, ast.literal_eval) directly into
+per-field columns. Gzip compressed and rotated logs (e.g. pipeline.log.1,
+pipeline.log.2.gz) are read, oldest first, together with the current log.
+
+With "--incremental" the parsed records and the position reached in each
+log file are saved to "<log>.profile.state" so that subsequent runs only
+parse the lines that have been added since the last profile.
+
+The jobs are also appended to the cross-run resource history database
+(see :mod:`txseq.tasks.history`) unless "--no-history" is given.
 
 Code
 ----
@@ -24,13 +35,20 @@ Code
 
 import os
 import re
+import ast
+import json
+import gzip
+import glob
+import pickle
+import hashlib
 import argparse
+import numpy as np
 import pandas as pd
 import logging
 import sys
 from shutil import which
 
-import cgatcore.pipeline as P
+import txseq.tasks.history as history
 
 # https://stackoverflow.com/questions/11210104/check-if-a-program-exists-from-a-python-script/34177358
 def is_tool(name):
@@ -48,53 +66,317 @@ def setupLogger():
     log_handler.setLevel(logging.INFO)
     L.addHandler(log_handler)
     L.setLevel(logging.INFO)
-    
+
     return L
 
 def setupParser():
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--log", default="pipeline.log", type=str,
-                    help="File with reduced dimensions")
+                    help="The pipeline log file")
     parser.add_argument("--save-table", default=False, action="store_true",
                     help="Save the per-task tsv table.")
-    
-    
+    parser.add_argument("--incremental", default=False, action="store_true",
+                    help="Only parse the log lines added since the last run.")
+    parser.add_argument("--no-history", default=False, action="store_true",
+                    help="Do not add the jobs to the resource history.")
+
     return parser
 
 
-def profile(log, save_table=False, show_fields=True):
+# ------------------------------ log parsing -------------------------------- #
+
+# the tag that precedes the task setup information in the log
+# (see txseq.tasks.setup).
+JOB_TAG = "txseq job - "
+JOB_TAG_BYTES = JOB_TAG.encode()
+
+
+def log_files(log):
+    '''
+    Return the paths of the log file and its rotated copies, oldest
+    first, e.g. [pipeline.log.2.gz, pipeline.log.1, pipeline.log].
+    '''
+
+    rotated = []
+
+    for path in glob.glob(glob.escape(log) + ".*"):
+
+        suffix = path[len(log) + 1:]
+
+        if suffix.endswith(".gz"):
+            suffix = suffix[:-len(".gz")]
+
+        if suffix.isdigit():
+            rotated.append((int(suffix), path))
+
+    paths = [x[1] for x in sorted(rotated, reverse=True)]
+
+    if os.path.exists(log + ".gz"):
+        paths.append(log + ".gz")
+
+    if os.path.exists(log):
+        paths.append(log)
+
+    return(paths)
+
+
+def parse_record(line):
+    '''
+    Return the dictionary of job information from a pipeline.log line
+    or None if the line does not contain a job record.
+
+    Records are logged as json by cgat-core. The python dictionary
+    representation used by older versions is parsed with
+    ast.literal_eval.
+    '''
+
+    if '"task"' not in line or '"statement"' not in line:
+        return(None)
+
+    text = line[line.find("{"):].rstrip()
+
+    try:
+        record = json.loads(text)
+
+    except ValueError:
+        try:
+            record = ast.literal_eval(
+                re.sub(r"\bnull\b", "None",
+                       re.sub(r"\btrue\b", "True",
+                              re.sub(r"\bfalse\b", "False", text))))
+
+        except (ValueError, SyntaxError):
+            return(None)
+
+    if not isinstance(record, dict):
+        return(None)
+
+    return(record)
+
+
+class recordColumns():
+    '''
+    Accumulate job records as one list of values per field. Fields that
+    are missing from a record are filled with None.
+    '''
+
+    def __init__(self):
+
+        self.columns = {}
+        self.digests = set()
+        self.n = 0
+
+    def add(self, record, digest=None):
+        '''
+        Add a record. Records with a digest that has already been seen
+        (e.g. from a log that has since been rotated) are ignored.
+        '''
+
+        if digest is not None:
+            if digest in self.digests:
+                return(False)
+            self.digests.add(digest)
+
+        for key, value in record.items():
+            if key not in self.columns:
+                self.columns[key] = [None] * self.n
+            self.columns[key].append(value)
+
+        self.n += 1
+
+        for values in self.columns.values():
+            if len(values) < self.n:
+                values.append(None)
+
+        return(True)
+
+    def to_frame(self):
+        '''
+        Return the records as a data frame. Numeric fields are stored
+        as float64 arrays and other fields as object arrays.
+        '''
+
+        data = {}
+
+        for key, values in self.columns.items():
+
+            if all([isinstance(v, (int, float)) and not isinstance(v, bool)
+                    for v in values if v is not None]):
+                data[key] = np.array([np.nan if v is None else v
+                                      for v in values], dtype=np.float64)
+            else:
+                data[key] = np.array(values, dtype=object)
+
+        return(pd.DataFrame(data, index=pd.RangeIndex(self.n)))
+
+
+def parse_job(line):
+    '''
+    Return the dictionary of job information logged by
+    :class:`txseq.tasks.setup.setup` (i.e. the task, sample and input
+    size) or None if the line does not contain this information.
+    '''
+
+    start = line.find(JOB_TAG)
+
+    if start == -1:
+        return(None)
+
+    try:
+        job = json.loads(line[start + len(JOB_TAG):])
+
+    except ValueError:
+        return(None)
+
+    return(job)
+
+
+def read_log(path, records, offset=0, jobs=None):
+    '''
+    Add the job records from the log file *path* to *records* (a
+    :class:`recordColumns` instance), starting at byte *offset* of the
+    (uncompressed) file. Only complete lines are read. If *jobs* is
+    given, the task setup information is added to it.
+
+    Returns the offset reached.
+    '''
+
+    if path.endswith(".gz"):
+        handle = gzip.open(path, "rb")
+    else:
+        handle = open(path, "rb")
+
+    with handle:
+
+        if offset > 0:
+            handle.seek(offset)
+
+        for line in handle:
+
+            if not line.endswith(b"\n"):
+                # the line is still being written.
+                break
+
+            offset += len(line)
+
+            if jobs is not None and JOB_TAG_BYTES in line:
+                line = line.decode("utf-8", errors="replace")
+                job = parse_job(line)
+                if job is not None:
+                    jobs.add(job, hashlib.blake2b(line.encode(),
+                                                  digest_size=16).digest())
+                continue
+
+            if b'"statement"' not in line:
+                continue
+
+            line = line.decode("utf-8", errors="replace")
+            record = parse_record(line)
+
+            if record is not None:
+                digest = hashlib.blake2b(line[line.find("{"):].encode(),
+                                         digest_size=16).digest()
+                records.add(record, digest)
+
+    return(offset)
+
+
+def parse_logs(log, state_file=None, jobs=False):
+    '''
+    Parse the job records from the log and its rotated copies and return
+    them as a data frame.
+
+    If a *state_file* is given the parsed records and the offset reached
+    in each file are saved to it, and are used to pick up where the last
+    run left off.
+
+    If *jobs* is True, a second data frame with the task setup
+    information (see :class:`txseq.tasks.setup.setup`) is also returned.
+    '''
+
+    state = {"files": {}, "records": recordColumns(), "jobs": recordColumns()}
+
+    if state_file is not None and os.path.exists(state_file):
+        with open(state_file, "rb") as sf:
+            state = pickle.load(sf)
+
+        if "jobs" not in state:
+            state["jobs"] = recordColumns()
+
+    files = {}
+
+    for path in log_files(log):
+
+        stat = os.stat(path)
+
+        # files are identified by inode so that a log that has been
+        # rotated (renamed) is not read again.
+        key = (stat.st_dev, stat.st_ino)
+        seen = state["files"].get(key)
+
+        offset = 0
+
+        if seen is not None:
+            if path.endswith(".gz") == seen["gz"]:
+                if stat.st_size == seen["size"]:
+                    files[key] = seen
+                    continue
+
+                if not seen["gz"] and stat.st_size > seen["size"]:
+                    offset = seen["offset"]
+
+        offset = read_log(path, state["records"], offset,
+                          jobs=state["jobs"])
+
+        files[key] = {"gz": path.endswith(".gz"),
+                      "size": stat.st_size,
+                      "offset": offset}
+
+    state["files"] = files
+
+    if state_file is not None:
+        with open(state_file, "wb") as sf:
+            pickle.dump(state, sf, protocol=pickle.HIGHEST_PROTOCOL)
+
+    if jobs:
+        return(state["records"].to_frame(), state["jobs"].to_frame())
+
+    return(state["records"].to_frame())
+
+
+def profile(log, save_table=False, show_fields=True, incremental=False,
+            save_history=True):
 
     L = setupLogger()
 
+    # imported here so that "import txseq.tasks.profile" (and so the
+    # "txseq <pipeline> profile" command) does not load cgat-core.
+    import cgatcore.pipeline as P
+
     PARAMS = P.get_parameters()
     queue_manager = PARAMS["cluster_queue_manager"]
-    
+
     if queue_manager not in ["slurm", "sge"]:
         raise ValueError("queue manager not supported")
 
-    task_pattern = re.compile("[^{]*execution - {(.*)}$")
-
-    tasks = {}
-    n = 0
-    with open (log, "r") as lf:
-
-        for line in lf:
+    if incremental:
+        state_file = log + ".profile.state"
+    else:
+        state_file = None
 
-            if '"task"' in line and '"statement"' in line:
+    x, jobs = parse_logs(log, state_file=state_file, jobs=True)
 
-                t = task_pattern.match(line).group(1)
-                t = t.replace("{","\{")
-                t = t.replace("}","\}")
-                t = t.replace(" null",'" null"')
-
-                tasks[n] = eval("{" + t + "}")
+    L.info("Parsing of log file complete")
 
-                n+=1
+    if save_history:
+        history_file = history.history_path(PARAMS)
 
-    L.info("Parsing of log file complete")
+        n = history.record(x, jobs, history.pipeline_name(log),
+                           queue_manager, history_file=history_file)
 
-    x = pd.DataFrame.from_dict(tasks, orient="index")
+        L.info("Added " + str(n) + " jobs to the resource history: " +
+               history_file)
 
     if show_fields:
         L.info("Avaliable fields:")
@@ -116,7 +398,7 @@ def profile(log, save_table=False, show_fields=True):
             "slots", "percent_cpu",
             "max_vmem","max_rss","average_rss", "ru_nswap",
             "user_t","cpu_t", "wall_t", "exit_status"]]
-        
+
         for mem_task in ["max_vmem", "max_rss","average_rss"]:
             # we want this in GB
             x[mem_task] = x[mem_task] / 1E6 #1000000000000000
@@ -132,11 +414,11 @@ def profile(log, save_table=False, show_fields=True):
 
     print("-----")
     L.info("Average job resource usage:")
-    print(x.groupby(['task']).mean().round(2))
+    print(x.groupby(['task']).mean(numeric_only=True).round(2))
 
     print("-----")
     L.info("Maximum job resource usage:")
-    print(x.groupby(['task']).max().round(2))
+    print(x.groupby(['task']).max(numeric_only=True).round(2))
 
     if save_table:
         x.to_csv("task.info.tsv.gz", sep="\t")
@@ -148,9 +430,11 @@ def main(argv=sys.argv):
 
     parser = setupParser()
     args = parser.parse_args()
-        
-    profile(args.log, save_table=args.save_table)
+
+    profile(args.log, save_table=args.save_table,
+            incremental=args.incremental,
+            save_history=not args.no_history)
 
 
 if __name__ == "__main__":
-    sys.exit(main(sys.argv))
\ No newline at end of file
+    sys.exit(main(sys.argv))
@@ -6,6 +6,17 @@ and processing the information from the fastqc_ tool.
 
 This script is forked from https://github.com/cgat-developers/cgat-flow
 
+The FastQC results are read from the "fastqc_data.txt" file inside the
+"<name>_fastqc.zip" archives that FastQC writes, so FastQC does not need
+to be run with "--extract" (which leaves many small files on disk per
+FASTQ file). Extracted "<name>_fastqc/fastqc_data.txt" files can also be
+read.
+
+Each result is parsed once: the parsed sections are remembered (by path,
+size and modification time) by :func:`read_fastqc_sections` and can be
+saved with :func:`parse_fastqc` and shared between tasks with
+:func:`load_fastqc_sections`.
+
 Reference
 ---------
 
@@ -14,13 +25,65 @@ Reference
 import os
 import re
 import glob
+import gzip
+import pickle
+import zipfile
 import collections
 from io import StringIO
 import pandas as pd
 from pathlib import Path
-from cgatcore import pipeline as P
-import cgatcore.iotools as iotools
-import cgatcore.csv2db as csv2db
+
+
+# The parsed sections of the FastQC results, by (path, size, mtime).
+_SECTIONS = {}
+
+
+def snip(filename, extension):
+    """return *filename* without the *extension* (as cgatcore
+    iotools.snip()).
+
+    Raises a ValueError if *filename* does not end in *extension*.
+    """
+    if not filename.endswith(extension):
+        raise ValueError("'%s' expected to end in '%s'" %
+                         (filename, extension))
+
+    return filename[:-len(extension)]
+
+
+def fastqc_track(infile):
+    """return the track of a task output, i.e. the file name without
+    the ".sentinel" (or ".fastqc") suffix.
+    """
+    name = os.path.basename(infile)
+
+    for extension in [".sentinel", ".fastqc"]:
+        if name.endswith(extension):
+            return snip(name, extension)
+
+    raise ValueError("'%s' expected to end in '.sentinel' or '.fastqc'" %
+                     name)
+
+
+def fastqc_result_name(fn):
+    """return the name ("<name>_fastqc") of a FastQC result.
+
+    *fn* is either a FastQC zip archive or an extracted fastqc_data.txt
+    file.
+    """
+    if fn.endswith(".zip"):
+        return snip(os.path.basename(fn), ".zip")
+
+    return os.path.basename(os.path.dirname(fn))
+
+
+def fastqc_result_dir(fn):
+    """return the directory that contains a FastQC result."""
+
+    if fn.endswith(".zip"):
+        return os.path.dirname(fn)
+
+    return os.path.dirname(os.path.dirname(fn))
 
 
 def fastqc_filename2track(fn):
@@ -29,17 +92,125 @@ def fastqc_filename2track(fn):
     Because we deal with both paired end (track.fastq.1_fastqc
     and single end data (track_fastqc), this is a bit cumbersome.
     """
-    return re.sub(".fastq.", "-", iotools.snip(os.path.basename(os.path.dirname(fn)),
+    return re.sub(".fastq.", "-", snip(fastqc_result_name(fn),
                                                "_fastqc"))
 
 
+def find_fastqc_files(prefix):
+    """return the FastQC results that match "<prefix>*_fastqc".
+
+    The zip archives are returned or, if there are none, the extracted
+    fastqc_data.txt files.
+    """
+    files = glob.glob(prefix + "*_fastqc.zip")
+
+    if len(files) == 0:
+        files = glob.glob(os.path.join(prefix + "*_fastqc",
+                                       "fastqc_data.txt"))
+
+    return sorted(files)
+
+
+def read_fastqc_data(fn):
+    """return the lines of the fastqc_data.txt file of a FastQC result.
+
+    For zip archives the file is read from the archive without
+    extracting it.
+    """
+    if fn.endswith(".gz"):
+        with gzip.open(fn, "rt") as inf:
+            return inf.readlines()
+
+    if not fn.endswith(".zip"):
+        with open(fn, "r") as inf:
+            return inf.readlines()
+
+    with zipfile.ZipFile(fn) as archive:
+
+        members = [x for x in archive.namelist()
+                   if os.path.basename(x) == "fastqc_data.txt"]
+
+        if len(members) == 0:
+            raise ValueError("fastqc_data.txt not found in " + fn)
+
+        # the top level file, i.e. <name>_fastqc/fastqc_data.txt
+        member = min(members, key=lambda x: x.count("/"))
+
+        return archive.read(member).decode().splitlines(keepends=True)
+
+
+def _stat_key(fn):
+
+    stat = os.stat(fn)
+
+    return (os.path.abspath(fn), stat.st_size, stat.st_mtime_ns)
+
+
+def read_fastqc_sections(fn):
+    """return the sections of a FastQC result.
+
+    The result is parsed once: the sections are remembered until the
+    file changes.
+
+    Returns
+    -------
+    sections : list
+        List of (name, status, header, data) tuples, see
+        :func:`FastqcSectionIterator`.
+    """
+    key = _stat_key(fn)
+
+    if key not in _SECTIONS:
+        _SECTIONS[key] = list(FastqcSectionIterator(read_fastqc_data(fn)))
+
+    return _SECTIONS[key]
+
+
+def parse_fastqc(infiles, outfile):
+    """parse the FastQC results and save the sections to *outfile*.
+
+    The sections of results that have not changed since *outfile* was
+    last written are reused rather than parsed again.
+
+    Arguments
+    ---------
+    infiles : list
+        List of FastQC results (zip archives or fastqc_data.txt files).
+    outfile : string
+        Output filename (a pickle, see :func:`load_fastqc_sections`).
+    """
+    if os.path.exists(outfile):
+        load_fastqc_sections(outfile)
+
+    results = {}
+    for fn in infiles:
+        key = _stat_key(fn)
+        results[key] = read_fastqc_sections(fn)
+
+    tmp = outfile + ".tmp"
+    with open(tmp, "wb") as outf:
+        pickle.dump(results, outf, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, outfile)
+
+
+def load_fastqc_sections(infile):
+    """load the sections saved by :func:`parse_fastqc`.
+
+    The sections of results that are unchanged are then used by
+    :func:`read_fastqc_sections` (and the functions that read FastQC
+    results in this module) rather than parsed again.
+    """
+    with open(infile, "rb") as inf:
+        _SECTIONS.update(pickle.load(inf))
+
+
 def fastqscreen_filename2track(fn):
     """extract track name from fastqc filename.
 
     Because we deal with both paired end (track.fastq.1_fastqc
     and single end data (track_fastqc), this is a bit cumbersome.
     """
-    return re.sub(".fastq.", "-", iotools.snip(os.path.basename(fn),
+    return re.sub(".fastq.", "-", snip(os.path.basename(fn),
                                                "_screen.txt"))
 
 
@@ -92,7 +263,8 @@ def collectFastQCSections(infiles, section, datadir):
     section : string
         Section name to extract
     datadir : string
-        Location of actual Fastqc output to be parsed.
+        Location of actual Fastqc output to be parsed: the results for
+        "<track>.sentinel" are read from "<datadir>/<track>/".
 
     Returns
     -------
@@ -103,11 +275,9 @@ def collectFastQCSections(infiles, section, datadir):
     '''
     results = []
     for infile in infiles:
-        track = P.snip(os.path.basename(infile), ".fastqc")
-        filename = os.path.join(datadir, track + "*_fastqc", "fastqc_data.txt")
-        for fn in glob.glob(filename):
-            for name, status, header, data in FastqcSectionIterator(
-                    iotools.open_file(fn)):
+        track = fastqc_track(infile)
+        for fn in find_fastqc_files(os.path.join(datadir, track, "")):
+            for name, status, header, data in read_fastqc_sections(fn):
                 if name == section:
                     results.append((track, status, header, data))
     return results
@@ -122,11 +292,16 @@ def loadFastqc(filename,
     Arguments
     ----------
     filename : string
-        Filename with FASTQC data
+        Filename (or glob pattern) of the FastQC results (zip archives
+        or fastqc_data.txt files)
     database_url : string
         Database backend.
     '''
 
+    # imported here so that the FastQC results can be read without
+    # cgat-core.
+    import cgatcore.csv2db as csv2db
+
     parser = csv2db.buildParser()
     (options, args) = parser.parse_args([])
 
@@ -135,11 +310,10 @@ def loadFastqc(filename,
     options.allow_empty = True
 
     for fn in glob.glob(filename):
-        prefix = os.path.basename(os.path.dirname(fn))
+        prefix = fastqc_result_name(fn)
         results = []
 
-        for name, status, header, data in FastqcSectionIterator(
-                iotools.open_file(fn)):
+        for name, status, header, data in read_fastqc_sections(fn):
             # do not collect basic stats, see loadFastQCSummary
             if name == "Basic Statistics":
                 continue
@@ -169,24 +343,23 @@ def buildFastQCSummaryStatus(infiles, outfile, datadir):
     outfile : list
         Output filename in :term:`tsv` format.
     datadir : string
-        Location of actual Fastqc output to be parsed.
-    track_regex : string
-        Regular expression to extract track from filename.
+        Location of actual Fastqc output to be parsed: the results for
+        "<track>.sentinel" are read from "<datadir>/<track>/".
     '''
 
+    # imported here so that the FastQC results can be read without
+    # cgat-core.
+    import cgatcore.iotools as iotools
+
     outf = iotools.open_file(outfile, "w")
     names = set()
     results = []
     for infile in infiles:
-        base_track = iotools.snip(os.path.basename(infile), ".sentinel")
-        filename = os.path.join(datadir,
-                                base_track + "*_fastqc",
-                                "fastqc_data.txt")
+        base_track = fastqc_track(infile)
         # there can be missing sections
-        for fn in glob.glob(filename):
+        for fn in find_fastqc_files(os.path.join(datadir, base_track, "")):
             stats = collections.defaultdict(str)
-            for name, status, header, data in FastqcSectionIterator(
-                    iotools.open_file(fn)):
+            for name, status, header, data in read_fastqc_sections(fn):
                 stats[name] = status
             track = fastqc_filename2track(fn)
             results.append((track, fn, stats))
@@ -196,7 +369,7 @@ def buildFastQCSummaryStatus(infiles, outfile, datadir):
     outf.write("track\tfilename\t%s\n" % "\t".join(names))
     for track, fn, stats in results:
         outf.write("%s\t%s\t%s\n" %
-                   (track, os.path.dirname(fn),
+                   (track, fastqc_result_dir(fn),
                     "\t".join(stats[x] for x in names)))
     outf.close()
 
@@ -242,6 +415,10 @@ def buildExperimentReadQuality(infiles, outfile, datadir):
     df_out = pd.DataFrame(df_out.sum(axis=1))
     df_out.columns = ["_".join(T.split("-")[:-1]), ]
 
+    # imported here so that the FastQC results can be read without
+    # cgat-core.
+    import cgatcore.iotools as iotools
+
     df_out.to_csv(iotools.open_file(outfile, "w"), sep="\t")
 
 
@@ -250,12 +427,8 @@ def read_fastqc(infiles):
 
     Arguments
     ---------
-    infiles : string
-        Input filename with fastqscreen output.
-    regex_track: string
-        Regular expression to extract track name from filename.
-    sep: char
-        Separator for merging multiple capture groups in regex.
+    infiles : list
+        List of FastQC results (zip archives or fastqc_data.txt files).
 
     Returns
     -------
@@ -265,14 +438,13 @@ def read_fastqc(infiles):
     dfs, tracks = collections.defaultdict(list), []
     for infile in infiles:
         track = fastqc_filename2track(infile)
-        sample_id = Path(infile).parts[-3]
+        sample_id = Path(fastqc_result_dir(infile)).name
         tracks.append(track)
-        with iotools.open_file(infile) as inf:
-            for name, status, header, data in FastqcSectionIterator(inf):
-                records = (x.split("\t") for x in data)
-                df = pd.DataFrame.from_records(records, columns=header.split("\t"))
-                df["sample_id"] = sample_id
-                dfs[name].append(df)
+        for name, status, header, data in read_fastqc_sections(infile):
+            records = (x.split("\t") for x in data)
+            df = pd.DataFrame.from_records(records, columns=header.split("\t"))
+            df["sample_id"] = sample_id
+            dfs[name].append(df)
 
     result = {}
     for key, dd in dfs.items():
@@ -296,6 +468,10 @@ def read_fastq_screen(infiles):
     multiple dataframes
     """
 
+    # imported here so that the FastQC results can be read without
+    # cgat-core.
+    import cgatcore.iotools as iotools
+
     dfs, tracks, summaries = [], [], []
     for infile in infiles:
         track = fastqscreen_filename2track(infile)
@@ -0,0 +1,299 @@
+'''
+registry.py
+===========
+
+Overview
+--------
+
+A registry of the txseq pipelines for the txseq command.
+
+The registry maps each command name (e.g. "salmon_index") to the path
+of its pipeline module together with a short description (the first
+paragraph of the "Overview" section of the module docstring) and the
+pipeline targets (the functions decorated as ruffus tasks). The
+information is read from the source of the modules with the ast module
+so that the pipelines (and their dependencies) are not imported.
+
+The registry is saved as a json file in ~/.cache/txseq (or
+$XDG_CACHE_HOME/txseq) when it is first built, for example at install
+time with::
+
+    python -m txseq.tasks.registry
+
+The saved registry is used while the modification times of the pipeline
+directories are unchanged, i.e. until pipelines are added, removed or
+renamed, so that listing the pipelines only needs one stat() call per
+directory. The entry of a pipeline is refreshed when the modification
+time of its module has changed.
+
+Usage
+-----
+
+.. code-block:: python
+
+    import txseq.tasks.registry as registry
+
+    pipelines = registry.pipelineRegistry([pipeline_dir])
+
+    info = pipelines.get("salmon")
+    print(info["path"], info["description"], info["targets"])
+
+Functions
+---------
+
+'''
+
+import os
+import re
+import ast
+import sys
+import json
+import glob
+import hashlib
+
+
+# The prefix of the name of the saved registry.
+REGISTRY_FILE = "pipelines.registry"
+
+# Increment when the format of the saved registry changes.
+REGISTRY_VERSION = 1
+
+
+def _mtime(path):
+    '''return the modification time (in ns) of a path or None.'''
+
+    try:
+        return(os.stat(path).st_mtime_ns)
+    except OSError:
+        return(None)
+
+
+def describe(docstring):
+    '''
+    Return the first paragraph of the "Overview" section of a pipeline
+    docstring (or, if there is no such section, the first paragraph
+    that is not part of the title) as a single line of plain text.
+    '''
+
+    if docstring is None:
+        return("")
+
+    lines = docstring.splitlines()
+
+    start = 0
+    for i, line in enumerate(lines[:-1]):
+        if line.strip() == "Overview" and re.match("^-+$",
+                                                   lines[i + 1].strip()):
+            start = i + 2
+            break
+
+    paragraph = []
+
+    for line in lines[start:]:
+
+        line = line.strip()
+
+        if line == "":
+            if paragraph:
+                break
+            continue
+
+        if re.match(r"^[=\-^~]+$", line) or line.startswith(":"):
+            # a title underline or a field (e.g. ":Author:")
+            paragraph = []
+            continue
+
+        paragraph.append(line)
+
+    # `text <url>`_ links are shown as text
+    return(re.sub(r"`([^`<]*?)\s*<[^>]*>`_+", r"\1", " ".join(paragraph)))
+
+
+def pipeline_info(path):
+    '''
+    Return the registry entry for the pipeline module at *path*.
+    '''
+
+    with open(path, "r") as infile:
+        tree = ast.parse(infile.read(), filename=path)
+
+    # ruffus tasks are the module level functions with decorators
+    targets = [node.name for node in tree.body
+               if isinstance(node, ast.FunctionDef)
+               and len(node.decorator_list) > 0]
+
+    module = os.path.basename(path)[:-len(".py")]
+
+    return({"command": module[len("pipeline_"):],
+            "module": module,
+            "path": os.path.abspath(path),
+            "mtime": _mtime(path),
+            "description": describe(ast.get_docstring(tree)),
+            "targets": targets})
+
+
+def default_registry_file(paths):
+    '''
+    Return the path of the saved registry of the pipelines in *paths*.
+
+    The registry is not saved alongside the pipelines as this would
+    change the modification time of their directory. The name includes
+    a hash of the *paths* that exist so that each installation has its
+    own registry (and missing paths, e.g. relative to the working
+    directory, do not make new registries).
+    '''
+
+    cache_dir = os.environ.get("XDG_CACHE_HOME",
+                               os.path.join(os.path.expanduser("~"), ".cache"))
+
+    paths = [os.path.abspath(x) for x in paths if os.path.isdir(x)]
+
+    digest = hashlib.sha256("\n".join(paths).encode()).hexdigest()[:16]
+
+    return(os.path.join(cache_dir, "txseq",
+                        REGISTRY_FILE + "." + digest + ".json"))
+
+
+class pipelineRegistry():
+    '''
+    The registry of the pipeline_*.py modules in the directories
+    *paths*. When a command is found in more than one directory, the
+    module in the first directory is used.
+
+    The registry is saved to (and loaded from) *registry_file* (by
+    default, see :func:`default_registry_file`) unless *save* is False.
+    '''
+
+    def __init__(self, paths, registry_file=None, save=True):
+
+        self.paths = [os.path.abspath(x) for x in paths if os.path.isdir(x)]
+
+        if save and registry_file is None:
+            registry_file = default_registry_file(self.paths)
+
+        self.registry_file = registry_file if save else None
+
+        stamp = self.stamp()
+        self.pipelines = self.read(stamp)
+
+        if self.pipelines is None:
+            self.pipelines = self.build()
+            self.write(stamp)
+
+    def stamp(self):
+        '''
+        Return the modification times of the pipeline directories.
+        '''
+
+        return({"version": REGISTRY_VERSION,
+                "paths": [[x, _mtime(x)] for x in self.paths]})
+
+    def build(self):
+        '''
+        Return the registry entries of the pipelines in the directories.
+        '''
+
+        pipelines = {}
+
+        for path in self.paths:
+            for module in sorted(glob.glob(os.path.join(path,
+                                                        "pipeline_*.py"))):
+
+                info = pipeline_info(module)
+
+                if info["command"] not in pipelines:
+                    pipelines[info["command"]] = info
+
+        return(pipelines)
+
+    def read(self, stamp):
+        '''
+        Return the saved registry entries or None if there is no saved
+        registry for the current *stamp*.
+        '''
+
+        if self.registry_file is None:
+            return(None)
+
+        try:
+            with open(self.registry_file, "r") as infile:
+                saved = json.load(infile)
+        except (OSError, ValueError):
+            return(None)
+
+        if saved.get("stamp") != stamp:
+            return(None)
+
+        return(saved["pipelines"])
+
+    def write(self, stamp):
+        '''
+        Save the registry. Errors (e.g. a read only file system) are
+        ignored: the registry is then rebuilt on the next invocation.
+        '''
+
+        if self.registry_file is None:
+            return
+
+        tmp = self.registry_file + ".tmp." + str(os.getpid())
+
+        try:
+            os.makedirs(os.path.dirname(self.registry_file), exist_ok=True)
+
+            with open(tmp, "w") as outfile:
+                json.dump({"stamp": stamp, "pipelines": self.pipelines},
+                          outfile, indent=1)
+
+            os.replace(tmp, self.registry_file)
+
+        except OSError:
+            pass
+
+    def commands(self):
+        '''
+        Return the sorted list of pipeline commands.
+        '''
+
+        return(sorted(self.pipelines))
+
+    def get(self, command):
+        '''
+        Return the registry entry of the pipeline *command* (or None if
+        there is no such pipeline). The entry is refreshed if the module
+        has changed since the registry was saved.
+        '''
+
+        info = self.pipelines.get(command)
+
+        if info is None:
+            return(None)
+
+        if _mtime(info["path"]) != info["mtime"]:
+
+            if not os.path.exists(info["path"]):
+                return(None)
+
+            info = pipeline_info(info["path"])
+            self.pipelines[command] = info
+            self.write(self.stamp())
+
+        return(info)
+
+
+def main(argv=None):
+    '''build and save the registry of the txseq pipelines.'''
+
+    import txseq.entry
+
+    pipelines = pipelineRegistry(txseq.entry.pipeline_paths())
+
+    # rebuild, e.g. after the pipelines have been edited in place
+    pipelines.pipelines = pipelines.build()
+    pipelines.write(pipelines.stamp())
+
+    print("saved the registry of %i pipelines to %s" %
+          (len(pipelines.pipelines), pipelines.registry_file))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
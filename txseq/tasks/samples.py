@@ -7,6 +7,18 @@ Overview
 
 This module contains a class that is used to model sample properties and attributes.
 
+The FASTQ paths listed in the library table are checked with a single
+concurrent pass of os.stat() calls. If a manifest file is given, the
+size, modification time and inode of each FASTQ file are cached in it
+together with the modification times of their directories. On later
+invocations only the files in directories that have changed (i.e. in
+which files have been added, removed or renamed) are stat'ed again.
+
+The validated model can be persisted with :func:`load_samples`, which
+saves it (as a pickle) keyed on a hash of the sample and library table
+contents so that later pipeline invocations load it rather than parse
+and validate the tables again.
+
 Usage
 -----
 
@@ -18,14 +30,16 @@ Class and method documentation
 
 '''
 
-import yaml
 import os
 import shutil
 import re
 import copy
 import re
-import pandas as pd
+import sys
+import pickle
+import hashlib
 from pprint import pprint
+from concurrent.futures import ThreadPoolExecutor
 
 # ------------------------------ utility functions -------------------------------- #
 
@@ -44,6 +58,239 @@ def check_values(pd_frame, col, allowed):
         raise ValueError("Only the following values are allowed in column '"
                          + col + "': " + ",".join(allowed))
 
+
+# The supported read 1 FASTQ file suffixes and the (substring)
+# replacements that give the read 2 paths, in order of precedence.
+READ2_SUFFIXES = [(("1.fastq.gz",), "1.fastq.gz", "2.fastq.gz"),
+                  (("1.fq.gz",), "1.fq.gz", "2.fq.gz"),
+                  (("fastq.1.gz", "fq.1.gz"), "1.gz", "2.gz")]
+
+
+def build_fastq_table(library_table, sample_types):
+    '''
+    Return the table of FASTQ files (indexed by "seq_id") and a
+    dictionary of the read 1 and read 2 FASTQ paths of each sample, given
+    the library table and a dictionary of the sample types ("SE" or
+    "PE").
+
+    The "end" and a unique "seq_id" (sample_id_flow_cell_lane_end)
+    columns are added to the *library_table*. For paired end samples the
+    read 2 rows are derived from the read 1 rows and follow them in the
+    table.
+    '''
+
+    # pandas is imported where it is needed to keep "import txseq.tasks"
+    # (and so the txseq command) fast.
+    import pandas as pd
+
+    unknown = set(library_table["sample_id"]) - set(sample_types)
+
+    if len(unknown) > 0:
+        raise ValueError("The library table contains sample_ids that are "
+                         "not in the sample table: " +
+                         ", ".join(sorted([str(x) for x in unknown])))
+
+    # construct a unique "seq_id" for each fastq file.
+    library_table["end"] = "END1"
+    library_table["seq_id"] = (library_table["sample_id"].astype(str) + "_" +
+                               library_table["flow_cell"].astype(str) + "_" +
+                               library_table["lane"].astype(str) + "_" +
+                               library_table["end"])
+
+    if not library_table["seq_id"].is_unique:
+        raise ValueError("Non-unique sample_id, flow_cell and lane "
+                         "combinations in the library table")
+
+    read1 = library_table.copy()
+    read1.index = read1["seq_id"].values
+    read1.index.name = None
+
+    # when data is SE, 'read2' will not be used
+    paired = (read1["sample_id"].map(sample_types) == "PE").values
+
+    r1_paths = read1["fastq_path"][paired]
+    r2_paths = pd.Series(None, index=r1_paths.index, dtype=object)
+
+    for suffixes, old, new in READ2_SUFFIXES:
+        todo = r2_paths.isna() & r1_paths.str.endswith(suffixes)
+        r2_paths[todo] = r1_paths[todo].str.replace(old, new, regex=False)
+
+    if r2_paths.isna().any():
+        raise ValueError("Read 1 FASTQ file end suffix not recognised. "
+                         "The following suffixes are supported: "
+                         "1.fastq.gz, 1.fq.gz, fastq.1.gz, fq.1.gz")
+
+    read2 = read1[paired].copy()
+    read2["end"] = "END2"
+    read2["seq_id"] = read2["seq_id"].str[:-len("END1")] + "END2"
+    read2["fastq_path"] = r2_paths.values
+    read2.index = read2["seq_id"].values
+
+    fastq_table = pd.concat([read1, read2])
+
+    # the fastq paths of each sample
+    sample_fastqs = {}
+
+    for sid, r1p in zip(read1["sample_id"], read1["fastq_path"]):
+        if sid not in sample_fastqs:
+            sample_fastqs[sid] = {"read1": [], "read2": []}
+        sample_fastqs[sid]["read1"].append(r1p)
+
+    for sid, r2p in zip(read2["sample_id"], read2["fastq_path"]):
+        sample_fastqs[sid]["read2"].append(r2p)
+
+    return(fastq_table, sample_fastqs)
+
+
+def _stat(path):
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return(None)
+
+    return((st.st_size, st.st_mtime_ns, st.st_ino))
+
+
+def stat_paths(paths, threads=16):
+    '''
+    Return a dictionary of {path: (size, mtime_ns, inode)} for the
+    given paths, which are stat'ed concurrently. Missing paths map to None.
+    '''
+
+    paths = list(dict.fromkeys(paths))
+
+    if len(paths) == 0:
+        return({})
+
+    with ThreadPoolExecutor(max_workers=max(1, min(threads,
+                                                   len(paths)))) as pool:
+        stats = list(pool.map(_stat, paths))
+
+    return(dict(zip(paths, stats)))
+
+
+class fastqManifest():
+    '''
+    A cache of the (size, mtime_ns, inode) of the FASTQ files, stored in
+    the tab-separated *manifest* file.
+    '''
+
+    columns = ["kind", "path", "size", "mtime", "inode"]
+
+    def __init__(self, manifest, threads=16):
+
+        self.manifest = manifest
+        self.threads = threads
+
+    def read(self):
+        '''
+        Return the dictionaries of the cached directory and file stats.
+        '''
+
+        dirs, files = {}, {}
+
+        if self.manifest is None or not os.path.exists(self.manifest):
+            return(dirs, files)
+
+        import pandas as pd
+
+        try:
+            table = pd.read_csv(self.manifest, sep="\t", dtype={"path": str})
+        except (pd.errors.EmptyDataError, pd.errors.ParserError):
+            return(dirs, files)
+
+        if list(table.columns) != self.columns:
+            return(dirs, files)
+
+        for kind, path, size, mtime, inode in table.itertuples(index=False):
+            entry = (int(size), int(mtime), int(inode))
+            if kind == "dir":
+                dirs[path] = entry
+            else:
+                files[path] = entry
+
+        return(dirs, files)
+
+    def write(self, dirs, files):
+
+        rows = [("dir", path) + entry for path, entry in dirs.items()
+                if entry is not None]
+        rows += [("file", path) + entry for path, entry in files.items()
+                 if entry is not None]
+
+        import pandas as pd
+
+        # the temporary file is private to this process as pipelines
+        # that share the manifest may be started together.
+        tmp = self.manifest + ".tmp." + str(os.getpid())
+        pd.DataFrame(rows, columns=self.columns).to_csv(
+            tmp, sep="\t", index=False)
+        os.replace(tmp, self.manifest)
+
+    def stat(self, paths):
+        '''
+        Return a dictionary of {path: (size, mtime_ns, inode)} for the
+        given paths (None for missing paths).
+
+        The cached entries are used for the files in the directories
+        whose (size, mtime, inode) are unchanged. The other files are
+        stat'ed and the manifest is updated.
+        '''
+
+        paths = list(dict.fromkeys(paths))
+
+        if self.manifest is None:
+            return(stat_paths(paths, self.threads))
+
+        cached_dirs, cached_files = self.read()
+
+        dirs = stat_paths([os.path.dirname(os.path.abspath(x))
+                           for x in paths], self.threads)
+
+        stats = {}
+        changed = []
+
+        for path in paths:
+            directory = os.path.dirname(os.path.abspath(path))
+
+            if dirs[directory] is not None and \
+               cached_dirs.get(directory) == dirs[directory] and \
+               path in cached_files:
+                stats[path] = cached_files[path]
+            else:
+                changed.append(path)
+
+        stats.update(stat_paths(changed, self.threads))
+
+        if len(changed) > 0 or set(cached_dirs) != set(dirs):
+            self.write(dirs, stats)
+
+        return(stats)
+
+
+def check_fastqs(fastq_table, manifest=None, threads=16):
+    '''
+    Check that all of the FASTQ files in the *fastq_table* exist (see
+    :class:`fastqManifest`). Raises a ValueError for the first missing
+    file.
+    '''
+
+    fastq_stats = fastqManifest(manifest, threads).stat(
+        [x.strip() for x in fastq_table["fastq_path"]])
+
+    for sid, path, end in zip(fastq_table["sample_id"],
+                              fastq_table["fastq_path"],
+                              fastq_table["end"]):
+        if fastq_stats[path.strip()] is None:
+            if end == "END1":
+                raise ValueError("fastq_path for sample '" + sid +
+                                 "' does not exist: " + path)
+            else:
+                raise ValueError("Read 2 file : " + path +
+                                 " does not exist")
+
+
 # ------------------------------------ classes --------------------------------------- #
 
 class sample():
@@ -51,7 +298,7 @@ class sample():
     A class for modelling samples.
     '''
 
-    def __init__(self, attributes, fastq=True):
+    def __init__(self, attributes, fastq=True, check_paths=True):
 
         mandatory_attributes = ["type", "strand"]
         
@@ -80,13 +327,13 @@ class sample():
                 
                 for x in [x.strip() for x in self.fastq["read1"]]:
                     fq_count += 1 
-                    if not os.path.exists(x):
+                    if check_paths and not os.path.exists(x):
                         raise ValueError("Read 1 file : " + x + " does not "
                                             "exist")
 
                 for x in [x.strip() for x in self.fastq["read2"]]:
                     fq_count -= 1
-                    if not os.path.exists(x):
+                    if check_paths and not os.path.exists(x):
                         raise ValueError("Read 2 file : " + x + " does not "
                                             "exist")
                 
@@ -99,7 +346,7 @@ class sample():
 
             if fastq:            
                 for x in [x.strip() for x in self.fastq["read1"]]:
-                    if not os.path.exists(x):
+                    if check_paths and not os.path.exists(x):
                         raise ValueError("Fastq file : " + x + " does not "
                                             "exist")
             
@@ -159,11 +406,19 @@ class samples():
     '''
     A class for modelling a set of samples and their associated
     FASTQ files
+
+    The FASTQ files are checked in a single concurrent pass (using
+    *threads* threads), with stats cached in the *manifest* file if
+    one is given (see :class:`fastqManifest`).
     '''
 
     def __init__(self, 
                  sample_tsv, 
-                 library_tsv=None):
+                 library_tsv=None,
+                 manifest=None,
+                 threads=16):
+
+        import pandas as pd
     
         # Parse and sanity check the sample table
         
@@ -200,78 +455,124 @@ class samples():
             check_cols(library_table, lt_req_cols, "libraries.tsv")
         
         
-            # construct a unique "seq_id" for each fastq file.
-            library_table["end"] = 'END1'        
-            library_table["seq_id"] = library_table[["sample_id","flow_cell","lane","end"
-                                                    ]].astype(str).T.apply(
-                                                    lambda c: c.str.cat(sep='_'))
-            
-            fastqs = library_table.copy(deep=True)
-            fastqs.index = fastqs["seq_id"]
-            fastqs = fastqs.to_dict(orient='index')
-            
-                    # set up fastq attribute
-            # when data is SE, 'read2' will not be used
-                
-            for seq_id in list(fastqs):
-            
-                entry = fastqs[seq_id]
-            
-                fqp = fastqs[seq_id]["fastq_path"]
-                sid = fastqs[seq_id]["sample_id"]
-                
-                paired = True if samples[sid]["type"] == "PE" else False    
-                
-                if not os.path.exists(fqp):
-                    raise ValueError("fastq_path for sample '" + sid +"' does not "
-                                    "exist: " + fqp)
-            
-                if not "fastq" in samples[sid].keys():
-                    samples[sid]["fastq"] = {'read1':[], 'read2':[]}
-                                
-                if paired:
-                
-                    if fqp.endswith("1.fastq.gz"):
-                        r2p = fqp.replace("1.fastq.gz","2.fastq.gz")
-                    elif fqp.endswith("1.fq.gz"):
-                        r2p = fqp.replace("1.fq.gz","2.fq.gz")
-                    elif fqp.endswith("fastq.1.gz") or fqp.endswith("fq.1.gz"):
-                        r2p = fqp.replace("1.gz", "2.gz")
-                    else:
-                        raise ValueError("Read 1 FASTQ file end suffix not recognised. "
-                                        "The following suffixes are supported: " 
-                                        "1.fastq.gz, 1.fq.gz, fastq.1.gz, fq.1.gz")
-                    
-                    # add the fastq paths to the sample objects
-                    samples[sid]["fastq"]["read1"].append(fqp)
-                    samples[sid]["fastq"]["read2"].append(r2p)
-                        
-                    # add the read 2 fastq entries to the fastq dictionary
-                    r2_seq_id = re.sub("_END1$", "_END2", seq_id)
-                    r2_entry = copy.deepcopy(entry)
-                    r2_entry["seq_id"] = r2_seq_id
-                    r2_entry["fastq_path"] = r2p
-                    r2_entry["end"] = "END2"
-                    fastqs[r2_seq_id] = r2_entry
-                    
-                else:
-                    
-                    samples[sid]["fastq"]["read1"].append(fqp)
-                    
+            fastq_table, sample_fastqs = build_fastq_table(
+                library_table,
+                {sid: attrs["type"] for sid, attrs in samples.items()})
+
+            for sid, paths in sample_fastqs.items():
+                samples[sid]["fastq"] = paths
+
+            # check that all of the FASTQ files exist
+            check_fastqs(fastq_table, manifest, threads)
+
             self.library_table = library_table
-            self.fastqs = copy.deepcopy(fastqs)
-            self.fastq_table = pd.DataFrame.from_dict(fastqs, 
-                                                  orient='index')
+            self.fastqs = fastq_table.to_dict(orient='index')
+            self.fastq_table = fastq_table
             
         self.samples = {}
         for sid, attrs in samples.items():
-            self.samples[sid] = sample(attrs, fastq=fastq)
+            # the FASTQ paths were checked above
+            self.samples[sid] = sample(attrs, fastq=fastq, check_paths=False)
         
         self.sample_table = sample_table
         
         self.npaired = len([x for x in sample_table["type"].values if x == "PE"])
-        
-        
 
-        
+
+# -------------------------------- cached models ------------------------------------- #
+
+# Increment to invalidate existing cached sample models when the
+# samples class changes. (The cached models are also invalidated when
+# this module is edited, see samples_key()).
+CACHE_VERSION = 1
+
+# The prefix of the name of the cached sample models.
+CACHE_PREFIX = "samples.cache"
+
+
+def samples_key(sample_tsv, library_tsv=None, manifest=None):
+    '''
+    Return a key for the sample model from a hash of the contents of the
+    sample and library tables and of this module (together with the
+    arguments and the python, pandas and cache versions).
+    '''
+
+    import pandas as pd
+
+    digest = hashlib.sha256()
+
+    digest.update(repr((CACHE_VERSION, sys.version, pd.__version__,
+                        sample_tsv, library_tsv, manifest)).encode())
+
+    for path in [__file__, sample_tsv, library_tsv]:
+        if path is not None:
+            with open(path, "rb") as infile:
+                digest.update(infile.read())
+
+    return(digest.hexdigest())
+
+
+def cache_path(sample_tsv, library_tsv=None, manifest=None):
+    '''
+    Return the name of the cached sample model for the given arguments,
+    e.g. "samples.cache.<hash>.pickle". Pipelines that load the samples
+    with different arguments (e.g. without a library table) use
+    different files so that they do not replace each other's model.
+    '''
+
+    digest = hashlib.sha256(
+        repr((sample_tsv, library_tsv, manifest)).encode()).hexdigest()
+
+    return(CACHE_PREFIX + "." + digest[:16] + ".pickle")
+
+
+def load_samples(sample_tsv, library_tsv=None, manifest=None, threads=16,
+                 cache=True, cache_file=None):
+    '''
+    Return a :class:`samples` model, loading it from the *cache_file*
+    if it was saved for the same sample and library table contents.
+    Otherwise the model is built and saved to the *cache_file* (by
+    default, named by :func:`cache_path`).
+
+    The FASTQ files of cached models are still checked (see
+    :func:`check_fastqs`). If *cache* is False, the model is always
+    built.
+    '''
+
+    if not cache:
+        return(samples(sample_tsv, library_tsv=library_tsv,
+                       manifest=manifest, threads=threads))
+
+    if cache_file is None:
+        cache_file = cache_path(sample_tsv, library_tsv, manifest)
+
+    key = samples_key(sample_tsv, library_tsv, manifest)
+
+    if os.path.exists(cache_file):
+
+        try:
+            with open(cache_file, "rb") as infile:
+                cached_key, model = pickle.load(infile)
+        except Exception:
+            # e.g. an incomplete or incompatible cache file
+            cached_key, model = None, None
+
+        if cached_key == key:
+
+            if library_tsv is not None:
+                check_fastqs(model.fastq_table, manifest, threads)
+
+            return(model)
+
+    model = samples(sample_tsv, library_tsv=library_tsv,
+                    manifest=manifest, threads=threads)
+
+    tmp = cache_file + ".tmp." + str(os.getpid())
+
+    with open(tmp, "wb") as outfile:
+        pickle.dump((key, model), outfile, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.replace(tmp, cache_file)
+
+    return(model)
 
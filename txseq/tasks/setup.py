@@ -8,12 +8,47 @@ pipelines. The class is used to obtain a task object that:
 * defines job resource requirements
 * provides access to variables (by name or via a .var dictionary)
 * creates an outfolder based on the outfile name
+* logs the task, sample and input size so that the resources used by
+  the job can be recorded (see :mod:`txseq.tasks.history`)
+* optionally, predicts the memory needed from the input size and the
+  resources used by previous jobs of the same task
+
+Memory prediction is enabled by setting "resources_predict" to True (e.g.
+in ~/.cgat.yml or in the "resources" section of the pipeline yml). The
+memory used by previous jobs of the task is fitted against their input
+size. The fit is raised to cover every previous job and multiplied by
+"resources_margin" (default 1.5). The result is capped at
+"resources_ceiling" if one is given. The configured memory is used when the
+task has fewer than "resources_min_jobs" (default 5) previous jobs or has
+no input files.
+
+Jobs that are killed by the cluster for exceeding their memory limit can
+be resubmitted automatically with more memory. This is enabled by setting
+"resources_escalate" to True. Tasks then run their statements with: ::
+
+    t.run(statement, PARAMS)
+
+instead of ``P.run(statement, **t.resources)`` (see :meth:`setup.run`).
+
+Each time the memory is multiplied by "resources_escalate_factor" (default
+2), up to "resources_escalate_cap" (default 256G). At most
+"resources_escalate_retries" (default 3) resubmissions are made. On SLURM,
+jobs that reach their time limit are resubmitted with the time limit
+multiplied by the same factor. Other failures are raised as before.
 
 """
 
 import os
+import sys
 import math
-import pandas as pd
+import json
+import logging
+
+L = logging.getLogger(__name__)
+
+# the tag that precedes the job information in the pipeline log
+# (see txseq.tasks.profile)
+JOB_TAG = "txseq job - "
 
 class setup():
     '''
@@ -31,17 +66,24 @@ class setup():
         expose_var: True|False. 
             Should the self.var dictionary be created from self.__dict__.
             Default = True.
+        sample: The sample_id, if the task processes a single sample.
+        inputs: A list of the input file paths (e.g. FASTQ files). By default
+            the infile (or for sentinels, the file that it marks) is used.
 
     Attributes:
         job_threads: The number of threads that will be requested
         job_memory: The amount of memory that will be requested per thread
         resources: A dictionary with keys "job_threads" and "job_memory" for populating
             the P.run() kwargs, e.g. ``P.run(statement, **t.resources)``
+            (or see :meth:`run`)
         outname: The os.path.basename of outfile
         outdir: The os.path.dirname of outfile
         indir: If an infile path is given, the os.path.dirname of the  infile.
         inname: If an infile path is given, the os.path.basename of the infile.
         log_file: If the outfile path ends with ".sentinel"
+        input_bytes: The total size of the input files
+        job_sample: The sample_id (if given)
+        job_task: The name of the calling task ("module.function")
 
     '''
     
@@ -79,12 +121,50 @@ class setup():
         return(G)
     
     
-    def set_resources(self, PARAMS, memory="4G", cpu=1):
+    def predict_memory(self, PARAMS, memory):
+        '''
+        Return the memory predicted from the resource history or, if
+        prediction is not enabled or not possible, the given memory.
+        '''
+
+        if not PARAMS.get("resources_predict") or not self.input_bytes:
+            return(memory)
+
+        # imported here so that the history is only read when needed.
+        import txseq.tasks.history as history
+
+        predicted = history.predict_memory(
+            self.job_task, self.input_bytes,
+            margin=float(PARAMS.get("resources_margin") or 1.5),
+            min_jobs=int(PARAMS.get("resources_min_jobs") or 5),
+            history_file=history.history_path(PARAMS))
+
+        if predicted is None:
+            return(memory)
+
+        if PARAMS.get("resources_ceiling"):
+            predicted = min(predicted,
+                            self.parse_mem(PARAMS["resources_ceiling"]))
+
+        predicted = str(int(math.ceil(predicted))) + "G"
+
+        L.info("%s: predicted memory %s (configured %s) for %i input bytes" %
+               (self.job_task, predicted, memory, self.input_bytes))
+
+        return(predicted)
+
+
+    def set_resources(self, PARAMS, memory="4G", cpu=1, predict=True):
         '''
         calculate the resource requirements and return a
         dictionary that can be used to update the local variables
         '''
 
+        if predict:
+            memory = self.predict_memory(PARAMS, memory)
+
+        self.job_cpu = cpu
+
         gb_requested = self.parse_mem(memory)
 
         # CGAT-core expects memory to be specified per core
@@ -118,13 +198,172 @@ class setup():
                           "job_threads": self.job_threads}
 
 
+    def escalate(self, error, PARAMS):
+        '''
+        Handle the *error* raised by P.run() when a job fails.
+
+        If resubmission is enabled ("resources_escalate") and the cluster
+        accounting shows that the job was killed for exceeding its memory
+        (or on SLURM, its time) limit, the request is escalated and the
+        method returns so that the job can be resubmitted with the new
+        ``t.resources`` (as done by :meth:`run`). Otherwise the error is
+        raised.
+        '''
+
+        if not PARAMS.get("resources_escalate"):
+            raise error
+
+        retries = int(PARAMS.get("resources_escalate_retries") or 3)
+
+        if self.job_escalations >= retries:
+            raise error
+
+        # imported here as it is only needed when a job fails.
+        import txseq.tasks.cluster as cluster
+
+        queue_manager = PARAMS.get("cluster_queue_manager")
+        memory_gb = self.r_memory / 1000
+
+        failure = cluster.job_failure(error, queue_manager,
+                                      memory_gb=memory_gb)
+
+        factor = float(PARAMS.get("resources_escalate_factor") or 2)
+
+        if failure["reason"] == "memory":
+
+            cap = self.parse_mem(PARAMS.get("resources_escalate_cap")
+                                 or "256G")
+
+            new_memory = min(math.ceil(memory_gb * factor), cap)
+
+            if new_memory <= memory_gb:
+                L.warning("%s: job %s ran out of memory (%gG) but the "
+                          "escalation cap (%gG) has been reached" %
+                          (self.job_task, failure["job_id"],
+                           memory_gb, cap))
+                raise error
+
+            job_options = self.resources.get("job_options")
+
+            self.set_resources(PARAMS, memory=str(new_memory) + "G",
+                               cpu=self.job_cpu, predict=False)
+
+            if job_options is not None:
+                self.resources["job_options"] = job_options
+
+            L.warning("%s: job %s ran out of memory, resubmitting with "
+                      "%gG (was %gG)" % (self.job_task, failure["job_id"],
+                                         new_memory, memory_gb))
+
+        elif (failure["reason"] == "time" and queue_manager == "slurm"
+              and failure["time_limit"]):
+
+            time_limit = cluster.format_time(failure["time_limit"] * factor)
+
+            self.resources["job_options"] = " ".join(
+                [x for x in [PARAMS.get("cluster_options"),
+                             "--time=" + time_limit] if x])
+
+            L.warning("%s: job %s reached its time limit, resubmitting with "
+                      "a limit of %s" % (self.job_task, failure["job_id"],
+                                         time_limit))
+
+        else:
+            raise error
+
+        self.job_escalations += 1
+
+
+    def run(self, statement, PARAMS, **kwargs):
+        '''
+        Run the *statement* with P.run() using the task resources. If
+        the job is killed for exceeding its memory (or time) limit it is
+        resubmitted with a larger request when this is enabled (see
+        :meth:`escalate`). Other keyword arguments are passed to P.run().
+        '''
+
+        # imported here so that txseq.tasks can be imported (e.g. by the
+        # txseq command) without loading cgat-core.
+        from cgatcore import pipeline as P
+
+        while True:
+            try:
+                return(P.run(statement, **dict(self.resources, **kwargs)))
+            except (OSError, RuntimeError) as error:
+                self.escalate(error, PARAMS)
+
+
+    def input_size(self, infile, inputs=None):
+        '''
+        Return the total size in bytes of the input files.
+        '''
+
+        if inputs is None:
+            inputs = [] if infile is None else [infile]
+
+        if isinstance(inputs, str):
+            inputs = [inputs]
+
+        size = 0
+
+        for path in inputs:
+
+            if path.endswith(".sentinel") and \
+               os.path.exists(path[:-len(".sentinel")]):
+                path = path[:-len(".sentinel")]
+
+            if os.path.isfile(path):
+                size += os.path.getsize(path)
+
+        return(size)
+
+
+    def calling_task(self):
+        '''
+        Return the name of the task function ("module.function") that
+        is being set up, as it is named by cgat-core.
+        '''
+
+        # skip the __init__ methods of this class and of classes that
+        # extend it.
+        frame = sys._getframe(1)
+        while frame.f_code.co_name == "__init__" and frame.f_back is not None:
+            frame = frame.f_back
+
+        return(frame.f_globals.get("__name__") + "." + frame.f_code.co_name)
+
+
+    def log_job(self):
+        '''
+        Write the task, sample, input size and requested resources to the
+        pipeline log.
+        '''
+
+        L.info(JOB_TAG + json.dumps({"task": self.job_task,
+                                     "out_file": self.job_outstem,
+                                     "sample": self.job_sample,
+                                     "input_bytes": self.input_bytes,
+                                     "job_memory": self.job_memory,
+                                     "job_threads": self.job_threads}))
+
+
     def __init__(self, infile, outfile, PARAMS,
                  memory="4G", cpu=1,
                  make_outdir=True,
-                 expose_var=True):
+                 expose_var=True,
+                 sample=None,
+                 inputs=None):
     
+        self.job_task = self.calling_task()
+        self.job_sample = sample
+        self.input_bytes = self.input_size(infile, inputs)
+        self.job_outstem = outfile.replace(".sentinel", "")
+        self.job_escalations = 0
+
         self.set_resources(PARAMS, memory=memory, cpu=cpu)
 
+        self.log_job()
+
         # self.outfile = os.path.relpath(outfile)
         # self.var["outfile"] = self.outfile
 